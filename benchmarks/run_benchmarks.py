@@ -0,0 +1,322 @@
+"""Benchmarks for ecm_runner, its logs, delete_finished and EcmServer.
+
+Runs against tests/fake_ecm.py so no GMP-ECM is needed, writes one
+JSON file of results and optionally compares with the results of an
+earlier version.
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --sizes 1e3,1e5,1e7 --compare old.json
+"""
+
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+
+import delete_finished
+from client import ecm_output
+from client import ecm_runner
+from ecmdb.ecmserver import EcmServer
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_ECM = os.path.join(BENCH_DIR, "..", "tests", "fake_ecm.py")
+RUNNER = os.path.join(BENCH_DIR, "..", "client", "ecm_runner.py")
+
+# 52 digits, no small factors
+N = 10 ** 51 + 7
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='ecm-db benchmarks.')
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+                        help='file to write results to')
+    parser.add_argument('--compare',
+                        help='earlier results file to compare against')
+    parser.add_argument('--sizes', default='1e3,1e4,1e5',
+                        help='EcmServer curve counts (up to 1e7)')
+    parser.add_argument('--dispatch_curves', type=int, default=1000,
+                        help='curves per ecm_runner dispatch benchmark')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='ecm_runner threads for dispatch benchmark')
+    parser.add_argument('--log_records', type=int, default=20000,
+                        help='records per log writer benchmark')
+    parser.add_argument('--resume_lines', type=int, default=200000,
+                        help='resume lines for delete_finished benchmark')
+    parser.add_argument('--readers', type=int, default=8,
+                        help='EcmServer read connections (and threads) for concurrent benchmark')
+    parser.add_argument('--only',
+                        help='comma separated benchmark groups to run '
+                             '(dispatch,parse,log,delete_finished,server)')
+    return parser
+
+
+class Results:
+    def __init__(self):
+        self.results = {}
+
+
+    def add(self, name, value, unit):
+        self.results[name] = {"value": value, "unit": unit}
+        print(f"\t{name:50} {value:14.1f} {unit}")
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.perf_counter()
+    value = f(*args, **kwargs)
+    return value, time.perf_counter() - t0
+
+
+def fake_ecm_env(**settings):
+    env = dict(os.environ)
+    env.update({f"FAKE_ECM_{k.upper()}": str(v) for k, v in settings.items()})
+    return env
+
+
+def fake_output(output_lines, factor_rate=0, curves=1):
+    """stdout of one fake ecm run"""
+    return subprocess.run(
+        [sys.executable, FAKE_ECM, "-v", "-c", str(curves), "11000"], input=str(N), text=True,
+        capture_output=True, env=fake_ecm_env(output_lines=output_lines, factor_rate=factor_rate))
+
+
+def write_resume_file(fn, lines, numbers=1):
+    ns = [N + 2 * i for i in range(numbers)]
+    with open(fn, "w") as f:
+        for i in range(lines):
+            n = ns[i % numbers]
+            f.write(f"METHOD=ECM; PARAM=1; SIGMA={1000000 + i}; B1=11000; N={n}; "
+                    f"X=0x{random.getrandbits(160):x}; CHECKSUM={i}; PROGRAM=GMP-ECM 7.0.5; "
+                    f"Y=0x0; X0=0x0; Y0=0x0; WHO=bench@host; TIME=Thu Jan  1 00:00:00 2026;\n")
+    return ns
+
+
+def bench_dispatch(args, results, tmp):
+    """Whole runner: curves/sec with instant fake curves, vs running the fake directly"""
+    resume_fn = os.path.join(tmp, "dispatch.resume")
+    write_resume_file(resume_fn, args.dispatch_curves)
+
+    # Baseline: interpreter start of the fake ecm itself.
+    count = 20
+    _, seconds = timed(lambda: [fake_output(10) for _ in range(count)])
+    spawn_ms = 1000 * seconds / count
+    results.add("fake_ecm.spawn_ms", spawn_ms, "ms")
+
+    for mode, extra in [("multiprocessing", []), ("asyncio", ["--asyncio"])]:
+        for fn in os.listdir(tmp):
+            if fn.startswith("dispatch.resume."):
+                os.remove(os.path.join(tmp, fn))
+        command = [sys.executable, RUNNER, "-b", FAKE_ECM, "-r", resume_fn, "--B1", "11000",
+                   "-t", str(args.threads), *extra]
+        _, seconds = timed(subprocess.run, command, cwd=tmp, capture_output=True,
+                           check=True, env=fake_ecm_env())
+        rate = args.dispatch_curves / seconds
+        results.add(f"runner.{mode}.curves_per_sec", rate, "curves/s")
+        # Runner time per curve beyond what the ecm processes themselves take
+        parallel = min(args.threads, os.cpu_count() or 1)
+        overhead = 1000 * seconds * parallel / args.dispatch_curves - spawn_ms
+        results.add(f"runner.{mode}.overhead_ms", overhead, "ms")
+
+
+def bench_parse(args, results, tmp):
+    for lines in (10, 1000):
+        output = fake_output(lines)
+        count = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < 1:
+            for _ in range(100):
+                ecm_runner.process_output(output, 0.1)
+            count += 100
+        results.add(f"process_output.{lines}_lines.per_sec",
+                    count / (time.perf_counter() - t0), "outputs/s")
+
+    batch = fake_output(10, curves=100)
+    parsed, seconds = timed(lambda: [ecm_runner.process_batch_output(batch, 1) for _ in range(100)])
+    results.add("process_batch_output.curves_per_sec",
+                sum(map(len, parsed)) / seconds, "curves/s")
+
+    # Many ecm runs concatenated, as when re-parsing old logs
+    log_fn = os.path.join(tmp, "parse.log")
+    with open(log_fn, "w") as f:
+        for _ in range(100):
+            f.write(batch.stdout)
+    curves, seconds = timed(lambda: sum(1 for _ in ecm_output.parse_log(log_fn)))
+    results.add("parse_log.curves_per_sec", curves / seconds, "curves/s")
+
+
+def bench_log(args, results, tmp):
+    output = fake_output(10)
+    result = ecm_runner.process_output(output, 0.1)
+    wu = ecm_runner.WorkUnit(1, str(N), ("-v",), "11000", None)
+    # Distinct curves so compression isn't flattered
+    variants = []
+    for i in range(1000):
+        sigma = f"1:{random.randint(10 ** 9, 2 ** 32 - 1)}"
+        variants.append(dataclasses.replace(
+            result, sigma=sigma, using=result.using.replace(result.sigma, sigma),
+            output=result.output.replace(result.sigma, sigma),
+            timings=(random.randint(20, 40), random.randint(10, 30)), runtime=random.random()))
+
+    for log_format, fns in [("text", ["bench.log", "bench.json.log"]), ("binary", ["bench.rlog"])]:
+        fns = [os.path.join(tmp, fn) for fn in fns]
+        writer = ecm_runner.LogWriter(fns, log_format, "w")
+
+        t0 = time.perf_counter()
+        for i in range(args.log_records):
+            writer.put(wu, variants[i % len(variants)])
+        put_seconds = time.perf_counter() - t0
+        writer.close()
+        seconds = time.perf_counter() - t0
+
+        results.add(f"log.{log_format}.put_per_sec", args.log_records / put_seconds, "records/s")
+        results.add(f"log.{log_format}.write_per_sec", args.log_records / seconds, "records/s")
+        results.add(f"log.{log_format}.bytes_per_record",
+                    sum(os.path.getsize(fn) for fn in fns) / args.log_records, "bytes")
+        for fn in fns:
+            os.remove(fn)
+
+
+def bench_delete_finished(args, results, tmp):
+    resume_fn = os.path.join(tmp, "delete.resume")
+    ns = write_resume_file(resume_fn, args.resume_lines, numbers=1000)
+
+    log_fn = os.path.join(tmp, "delete.json.log")
+    with open(log_fn, "w") as f:
+        for n in ns[::2]:
+            f.write(json.dumps([{"n": str(n)}, {"output": f"Input number is {n} ({len(str(n))} digits)"}]))
+            f.write("\n")
+
+    finished, seconds = timed(delete_finished.read_logs, [log_fn])
+    options = argparse.Namespace(dry_run=False)
+    _, seconds = timed(delete_finished.remove_matched, options, resume_fn,
+                       resume_fn + ".filtered", delete_finished.FinishedFilter(finished))
+    results.add("delete_finished.lines_per_sec", args.resume_lines / seconds, "lines/s")
+
+
+def bench_server(args, results, tmp):
+    for size in (int(float(size)) for size in args.sizes.split(",")):
+        db_fn = os.path.join(tmp, f"bench_{size}.db")
+        server = EcmServer(db_fn)
+
+        # Ten curves per number
+        ns = [N + 2 * i for i in range(max(1, size // 10))]
+        _, seconds = timed(lambda: [server.add_numbers(ns[i:i + 10000], processes=1)
+                                    for i in range(0, len(ns), 10000)])
+        results.add(f"server.{size}.add_numbers_per_sec", len(ns) / seconds, "numbers/s")
+
+        curves = [{"n": ns[i % len(ns)], "B1": 11000, "B2": 1873422,
+                   "stage1_ms": 30, "stage2_ms": 20} for i in range(size)]
+        _, seconds = timed(lambda: [server.record_curves(curves[i:i + 10000])
+                                    for i in range(0, size, 10000)])
+        results.add(f"server.{size}.record_curves_per_sec", size / seconds, "curves/s")
+
+        # Fresh instance so lookups aren't answered by the num_id cache
+        server = EcmServer(db_fn)
+        lookups = random.choices(ns, k=min(10000, 10 * len(ns)))
+        _, seconds = timed(lambda: [server.find_number(n) for n in lookups])
+        results.add(f"server.{size}.find_number_per_sec", len(lookups) / seconds, "lookups/s")
+
+        _, seconds = timed(lambda: [server.stats(n) for n in lookups[:1000]])
+        results.add(f"server.{size}.stats_per_sec", min(1000, len(lookups)) / seconds, "queries/s")
+
+        # Concurrent mode: reader threads querying while another thread ingests
+        server = EcmServer(db_fn, readers=args.readers)
+        stop = threading.Event()
+        def ingest():
+            while not stop.is_set():
+                server.record_curves(curves[:100])
+        def read(reads):
+            for n in lookups[:1000]:
+                server.stats(n)
+                reads.append(1)
+
+        reads = []
+        writer = threading.Thread(target=ingest)
+        writer.start()
+        readers = [threading.Thread(target=read, args=(reads,)) for _ in range(args.readers)]
+        t0 = time.perf_counter()
+        for thread in readers:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        seconds = time.perf_counter() - t0
+        stop.set()
+        writer.join()
+        server.close()
+        results.add(f"server.{size}.concurrent_stats_per_sec", len(reads) / seconds, "queries/s")
+
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fn + suffix):
+                os.remove(db_fn + suffix)
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "parse": bench_parse,
+    "log": bench_log,
+    "delete_finished": bench_delete_finished,
+    "server": bench_server,
+}
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_fn, results):
+    with open(old_fn) as f:
+        old = json.load(f)
+    print(f"\nCompared to {old['version']} ({old_fn!r}):")
+    for name, result in results.items():
+        if name in old["results"] and old["results"][name]["value"]:
+            ratio = result["value"] / old["results"][name]["value"]
+            print(f"\t{name:50} {ratio:8.2f}x")
+
+
+def main(args):
+    # Quiet 'Creating db' warnings
+    logging.getLogger().setLevel(logging.ERROR)
+
+    groups = args.only.split(",") if args.only else list(BENCHMARKS)
+    results = Results()
+    with tempfile.TemporaryDirectory() as tmp:
+        for group in groups:
+            print(f"{group}:")
+            BENCHMARKS[group](args, results, tmp)
+
+    report = {
+        "version": git_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results.results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output!r}")
+
+    if args.compare:
+        compare(args.compare, results.results)
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)
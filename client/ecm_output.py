@@ -0,0 +1,469 @@
+"""Single pass parser of GMP-ECM output.
+
+One regex picks out the lines that matter and a small state machine sorts
+them into curves:
+
+    invocation  "GMP-ECM ..." version line, starts a new ecm run
+    header      "Resuming ...", "Input number is ..."
+    curve       "Using B1=..." up to the next "Run k out of K:", header or curve
+
+Works on the output of a single curve, of `ecm -c K` and on whole log files
+holding the output of many ecm runs. Fields ecm didn't print are None and
+listed in Curve.errors so callers decide what is fatal.
+
+Only uses the standard library so ecm_runner.py stays a copy-and-run client.
+"""
+
+import dataclasses
+import json
+import math
+import re
+from typing import List, Optional, Tuple
+
+
+# lastgroup of a match names the line type (for multi group lines the last group)
+RE_LINE = re.compile(
+    r"^(?:"
+    r"(?P<version>GMP-ECM [0-9].*)"
+    r"|(?P<resuming>Resuming .*)"
+    r"|Input number is (?P<input_number>\S+) \((?P<digits>[0-9]+) digits\)"
+    r"|(?P<run>Run [0-9]+ out of [0-9]+:\n?)"
+    r"|(?P<using>Using .*B1=.*)"
+    r"|Step 1 took (?P<step1_ms>[0-9]+)ms"
+    r"|Step 2 took (?P<step2_ms>[0-9]+)ms"
+    r"|Estimated memory usage: (?P<memory>[0-9.]+)(?P<unit>[KMGT]?)"
+    r"|x=(?P<residue>\S+)"
+    r"|\*+ Factor found in step (?P<factor_step>[0-9]+): (?P<factor>[0-9]+)"
+    # -q prints "factor cofactor"
+    r"|(?P<quiet_factor>[0-9]+) [0-9()+*/#!-]"
+    r")", re.MULTILINE)
+
+RE_USING_FIELD = re.compile(r"\b(B1|B2|sigma)=([^,\s]+)")
+RE_POLYNOMIAL = re.compile(r"\bpolynomial ([^,]+)")
+# B1 (or the end of a B1 range) and B2 of a "Using B1=..." line
+RE_USING_BOUNDS = re.compile(r"\bB1=(?:[0-9]+-)?([0-9]+), B2=([0-9]+)")
+
+# N field of a resume line, ecm writes N as the input expression or in hex
+RE_RESUME_N = re.compile(r"(?:^|[;\s])N=([^;]*);")
+# For tools that stream resume files as bytes
+RE_RESUME_N_BYTES = re.compile(RE_RESUME_N.pattern.encode())
+
+RE_EXPR_TOKEN = re.compile(r"[0-9]+|\S")
+# Largest value parse_number builds, GMP-ECM inputs are far smaller
+MAX_EXPR_BITS = 1 << 22
+
+MEMORY_UNITS = {"": 1024 ** -2, "K": 1024 ** -1, "M": 1, "G": 1024, "T": 1024 ** 2}
+
+# Line each field comes from, for errors
+FIELD_LINES = {
+    "version": "'GMP-ECM ...' version line",
+    "input_number": "'Input number is' line",
+    "using": "'Using B1=...' line",
+    "step1_ms": "'Step 1 took' line",
+    "step2_ms": "'Step 2 took' line",
+}
+
+BUFFER_SIZE = 1 << 20
+
+
+def normalize_number(n: str) -> str:
+    """Decimal for decimal or hex numbers, expressions without whitespace"""
+    n = "".join(n.split())
+    if re.fullmatch(r"0[xX][0-9a-fA-F]+", n):
+        return str(int(n, 16))
+    if n.isdigit():
+        return str(int(n))
+    return n
+
+
+def parse_number(expr: str) -> int:
+    """Value of a decimal or hex number or of a GMP-ECM input expression.
+
+    Expressions are integers with + - * / % ^ ! and parentheses, e.g.
+    "(2^349-1)/1779973928671". Anything else raises ValueError.
+    """
+    n = normalize_number(expr)
+    if n.isdigit():
+        return int(n)
+    return _ExprParser(n).parse()
+
+
+class _ExprParser:
+    """Recursive descent over
+
+        expr    = term (("+" | "-") term)*
+        term    = unary (("*" | "/" | "%") unary)*
+        unary   = "-" unary | power
+        power   = postfix ("^" unary)?
+        postfix = atom "!"*
+        atom    = digits | "(" expr ")"
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.tokens = RE_EXPR_TOKEN.findall(expr)
+        self.pos = 0
+
+
+    def parse(self) -> int:
+        value = self._expr()
+        if self.pos != len(self.tokens):
+            self._error(f"unexpected {self.tokens[self.pos]!r}")
+        return value
+
+
+    def _error(self, message):
+        raise ValueError(f"Bad expression {self.expr!r}: {message}")
+
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+
+    def _take(self, token):
+        if self._peek() != token:
+            return False
+        self.pos += 1
+        return True
+
+
+    def _checked(self, value):
+        if value.bit_length() > MAX_EXPR_BITS:
+            self._error("value too large")
+        return value
+
+
+    def _expr(self):
+        value = self._term()
+        while self._peek() in ("+", "-"):
+            if self._take("+"):
+                value += self._term()
+            else:
+                self._take("-")
+                value -= self._term()
+        return value
+
+
+    def _term(self):
+        value = self._unary()
+        while self._peek() in ("*", "/", "%"):
+            op = self.tokens[self.pos]
+            self.pos += 1
+            rhs = self._unary()
+            if op == "*":
+                value = self._checked(value * rhs)
+            elif rhs == 0:
+                self._error("division by zero")
+            elif op == "/":
+                value //= rhs
+            else:
+                value %= rhs
+        return value
+
+
+    def _unary(self):
+        if self._take("-"):
+            return -self._unary()
+        return self._power()
+
+
+    def _power(self):
+        base = self._postfix()
+        if not self._take("^"):
+            return base
+        exponent = self._unary()
+        if exponent < 0:
+            self._error("negative exponent")
+        if abs(base) > 1 and exponent * (abs(base).bit_length() - 1) > MAX_EXPR_BITS:
+            self._error("value too large")
+        return self._checked(base ** exponent)
+
+
+    def _postfix(self):
+        value = self._atom()
+        while self._take("!"):
+            if value < 0 or value * value.bit_length() > MAX_EXPR_BITS:
+                self._error("factorial too large")
+            value = math.factorial(value)
+        return value
+
+
+    def _atom(self):
+        token = self._peek()
+        if token is None:
+            self._error("unexpected end")
+        self.pos += 1
+        if token.isdigit():
+            return int(token)
+        if token == "(":
+            value = self._expr()
+            if not self._take(")"):
+                self._error("missing ')'")
+            return value
+        self._error(f"unexpected {token!r}")
+
+
+def memory_mb(size: str, unit: str) -> float:
+    """MB of ecm's "Estimated memory usage: <size><unit>B" """
+    return float(size) * MEMORY_UNITS[unit]
+
+
+@dataclasses.dataclass(frozen=True)
+class ParseError:
+    field: str
+    message: str
+    # Line (1 based) of the input where the curve started
+    line: int
+
+
+class EcmOutputError(ValueError):
+    """ecm output missing fields (or with an exit status) the caller can't do without"""
+
+    def __init__(self, errors: List[ParseError], output: str = ""):
+        self.errors = errors
+        self.output = output
+        super().__init__("; ".join(f"{e.field}: {e.message} (line {e.line})" for e in errors))
+
+
+@dataclasses.dataclass()
+class Curve:
+    version: Optional[str] = None
+    input_number: Optional[str] = None
+    digits: Optional[int] = None
+    # Stage 1 was resumed from a save file
+    resumed: bool = False
+    using: Optional[str] = None
+    # "11000" or "5000-11000" when resumed
+    B1: Optional[str] = None
+    B2: Optional[str] = None
+    polynomial: Optional[str] = None
+    param: Optional[int] = None
+    # "<param>:<sigma>" as printed by ecm
+    sigma: Optional[str] = None
+    step1_ms: Optional[int] = None
+    step2_ms: Optional[int] = None
+    memory_mb: Optional[float] = None
+    # x coordinate after stage 1 (printed with -v -v)
+    residue: Optional[str] = None
+    factors: Tuple[int] = ()
+    factor_step: Optional[int] = None
+    # Header and lines of this curve, when the parser keeps output
+    output: str = ""
+    line: int = 0
+    errors: Tuple[ParseError] = ()
+
+
+def _skips_stage2(curve: Curve) -> bool:
+    if curve.factor_step == 1:
+        return True
+    try:
+        return int(curve.B2) <= int(curve.B1.rsplit("-", 1)[-1])
+    except (TypeError, ValueError):
+        return False
+
+
+def check(curve: Curve) -> Tuple[ParseError]:
+    """Errors for fields ecm always prints (stage 2 timing only if stage 2 ran)"""
+    fields = ["version", "input_number", "using", "step1_ms"]
+    if curve.step2_ms is None and not _skips_stage2(curve):
+        fields.append("step2_ms")
+    return tuple(ParseError(field, f"missing {FIELD_LINES[field]}", curve.line)
+                 for field in fields if getattr(curve, field) is None)
+
+
+class OutputParser:
+    """Turns chunks of ecm output into Curves.
+
+    feed() takes any text made of whole lines (one line, a full stdout, a
+    block of a log file) and returns the curves it finished. The last curve
+    only ends with the next curve or close().
+    """
+
+    def __init__(self, keep_output=True):
+        self.keep_output = keep_output
+        # Current ecm invocation
+        self.version = None
+        self.input_number = None
+        self.digits = None
+        self.resumed = False
+        # Header seen but no curve yet
+        self.pending = False
+        # Output up to "Input number is", repeated for each curve of -c K
+        self.header = ""
+
+        self.curve = None
+        self.factors = []
+        # Output of the current curve before self.cut
+        self.pieces = []
+        self.cut = 0
+        # Lines before the current feed() chunk / before self.counted
+        self.lines = 0
+        self.counted = 0
+        self.finished = []
+
+
+    def _take(self, text, end):
+        if self.keep_output and end > self.cut:
+            self.pieces.append(text[self.cut:end])
+        self.cut = end
+
+
+    def _line_number(self, text, pos):
+        self.lines += text.count("\n", self.counted, pos)
+        self.counted = pos
+        return self.lines + 1
+
+
+    def _open(self, line):
+        self.curve = Curve(
+            version=self.version, input_number=self.input_number, digits=self.digits,
+            resumed=self.resumed, line=line)
+        self.factors = []
+        self.pending = False
+
+
+    def _finish(self):
+        curve = self.curve
+        if curve is not None:
+            curve.factors = tuple(sorted(set(self.factors)))
+            curve.output = "".join(self.pieces)
+            curve.errors = check(curve)
+            self.finished.append(curve)
+            self.curve = None
+        self.pieces = []
+
+
+    def _end_curve(self, text, start):
+        """Previous curve ends before this line, which starts a new one."""
+        if self.curve is not None:
+            self._take(text, start)
+            self._finish()
+            # Later curves of -c K repeat the header
+            if self.keep_output and self.header:
+                self.pieces.append(self.header)
+
+
+    def feed(self, text: str) -> List[Curve]:
+        self.cut = 0
+        self.counted = 0
+        for m in RE_LINE.finditer(text):
+            kind = m.lastgroup
+            start = m.start()
+
+            if kind == "using":
+                curve = self.curve
+                if curve is not None and curve.using is not None:
+                    self._end_curve(text, start)
+                    self.cut = start
+                    curve = None
+                if curve is None:
+                    self._open(self._line_number(text, start))
+                    curve = self.curve
+                using = curve.using = m.group("using")
+                for key, value in RE_USING_FIELD.findall(using):
+                    if key == "sigma":
+                        curve.sigma = value
+                        param, _, _ = value.rpartition(":")
+                        # Before GMP-ECM 7 sigma had no param prefix (Suyama, 0)
+                        curve.param = int(param) if param.isdigit() else 0
+                    else:
+                        setattr(curve, key, value)
+                poly = RE_POLYNOMIAL.search(using)
+                if poly:
+                    curve.polynomial = poly.group(1)
+                continue
+
+            if kind == "run":
+                self._end_curve(text, start)
+                self.cut = m.end()
+                continue
+
+            if kind in ("version", "resuming", "digits"):
+                if self.curve is not None:
+                    self._take(text, start)
+                    self._finish()
+                    self.cut = start
+                if kind == "version":
+                    # Drop anything between ecm runs that wasn't part of a curve
+                    self.pieces = []
+                    self.cut = start
+                    self.version = m.group("version")
+                    self.input_number = self.digits = None
+                    self.resumed = False
+                    self.header = ""
+                elif kind == "resuming":
+                    self.resumed = True
+                    self.header = ""
+                else:
+                    self.input_number = m.group("input_number")
+                    self.digits = int(m.group("digits"))
+                    end = m.end() + 1
+                    self._take(text, end)
+                    self.header = "".join(self.pieces)
+                self.pending = True
+                continue
+
+            if self.curve is None:
+                self._open(self._line_number(text, start))
+            curve = self.curve
+
+            if kind == "step1_ms":
+                curve.step1_ms = int(m.group(kind))
+            elif kind == "step2_ms":
+                curve.step2_ms = int(m.group(kind))
+            elif kind == "unit":
+                curve.memory_mb = memory_mb(m.group("memory"), m.group("unit"))
+            elif kind == "residue":
+                # Before stage 1 -v -v prints the starting point
+                if curve.step1_ms is not None:
+                    curve.residue = m.group(kind)
+            elif kind == "factor":
+                self.factors.append(int(m.group("factor")))
+                if curve.factor_step is None:
+                    curve.factor_step = int(m.group("factor_step"))
+            elif kind == "quiet_factor":
+                self.factors.append(int(m.group(kind)))
+
+        self._take(text, len(text))
+        self.lines += text.count("\n", self.counted)
+        finished, self.finished = self.finished, []
+        return finished
+
+
+    def close(self) -> List[Curve]:
+        """Curves still open at the end of the output"""
+        if self.curve is None and self.pending:
+            # ecm printed a header but no curve, report what's missing
+            self._open(self.lines + 1)
+        self._finish()
+        finished, self.finished = self.finished, []
+        return finished
+
+
+def parse_output(stdout: str, keep_output=True) -> List[Curve]:
+    """Curves in the output of one ecm run (-c K or not)"""
+    parser = OutputParser(keep_output)
+    return parser.feed(stdout) + parser.close()
+
+
+def parse_log(fn: str, keep_output=False):
+    """Yields the Curves in a file of ecm output, an ecm_runner text log or .json.log"""
+    parser = OutputParser(keep_output)
+    with open(fn) as f:
+        if fn.endswith(".json.log"):
+            for line in f:
+                _, result = json.loads(line)
+                output = result["output"]
+                yield from parser.feed(output if output.endswith("\n") else output + "\n")
+        else:
+            rest = ""
+            while True:
+                chunk = f.read(BUFFER_SIZE)
+                if not chunk:
+                    break
+                chunk = rest + chunk
+                end = chunk.rfind("\n") + 1
+                rest = chunk[end:]
+                yield from parser.feed(chunk[:end])
+            yield from parser.feed(rest)
+    yield from parser.close()
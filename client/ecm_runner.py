@@ -1,19 +1,39 @@
 """Takes a Work Unit and runs some quantum of with ecm. """
 
 import argparse
+import asyncio
+import bisect
+import hashlib
+import http.client
+import http.server
 import json
 import multiprocessing as mp
 import os
 import pprint
+import queue
 import random
 import re
+import shutil
+import signal
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import urllib.error
+import urllib.request
 
 import dataclasses
-from collections import defaultdict
+import math
+from collections import defaultdict, deque
 from datetime import datetime
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ecm_output
+import result_log
 
 
 @dataclasses.dataclass(frozen=True)
@@ -24,15 +44,18 @@ class WorkUnit:
     B1: str
     B2: str
     resume_line: str = ""
+    # Curves run by one ecm process (-c)
+    curves: int = 1
 
 
 @dataclasses.dataclass(frozen=True)
 class Env:
     ecm_path: str
     extra_params: Tuple[str]
+    # Each work unit checkpoints stage 1 to <checkpoint_dir>/<key>.chkpnt
+    checkpoint_dir: str = ""
 
 
-# TODO should this include sigma?
 @dataclasses.dataclass()
 class EcmOutput:
     factors: Tuple[str]
@@ -43,16 +66,16 @@ class EcmOutput:
     output: str
     timings: Tuple[int]
     runtime: float
+    sigma: str = ""
 
 
-RE_FACTORS_FMT1 = re.compile(r"factor found.*: ([0-9]+)$", re.I | re.MULTILINE)
-RE_FACTORS_FMT2 = re.compile(r"^([0-9]+) [0-9()+*/#!-]", re.I | re.MULTILINE)
-RE_USING = re.compile(r"Using .*B1=.*$", re.I | re.MULTILINE)
-RE_VERSION = re.compile(r"^GMP-ECM [0-9].*$", re.I | re.MULTILINE)
-RE_RESUME_N = re.compile(r"\bN=([0-9]+)\b")
 RE_B1_B2 = re.compile(r"\bB1=([0-9]+)\b(.*B2=([0-9]+))?")
-RE_STEP1_TIMING = re.compile(r"Step 1 took ([0-9]+)ms", re.I | re.MULTILINE)
-RE_STEP2_TIMING = re.compile(r"Step 2 took ([0-9]+)ms", re.I | re.MULTILINE)
+RE_INPUT_DIGITS = re.compile(r"^Input number is .* \(([0-9]+) digits\)")
+RE_MEMORY_USAGE = re.compile(r"^Estimated memory usage: ([0-9.]+)([KMGT]?)B?")
+
+# Longest line run_async reads from ecm, "Input number is" echoes the whole input
+# and -v -v prints residues as long as it.
+STREAM_LIMIT = 1 << 26
 
 ECM_ACCEPTED_ARGS = (
     'x0', 'y0', 'param', 'A', 'torsion', 'k', 'power', 'dickson',
@@ -86,12 +109,47 @@ def get_argparser():
     parser.add_argument('--B1', '--b1', help='B1 param')
     parser.add_argument('--B2', '--b2', help='B2 param')
     parser.add_argument('-r', '--resume', help='Resume residues from file')
+    parser.add_argument('-s', '--server',
+                        help='ecm-db work server url (e.g. http://localhost:8419)')
     parser.add_argument('-b', '--ecm_binary', help='Path to ecm binary',
                         required=True)
+    parser.add_argument('--asyncio', action='store_true',
+                        help='event driven runner (asyncio subprocesses, no worker processes)')
+    parser.add_argument('--batch_seconds', type=float, default=0,
+                        help=('pack curves into one `ecm -c K` run of about this many '
+                              'seconds (-N only, not with --pipeline)'))
+    parser.add_argument('--max_batch_curves', type=int, default=100,
+                        help='largest K with --batch_seconds')
+    parser.add_argument('--checkpoint_dir',
+                        help=('give each work unit a -chkpnt file in this directory, '
+                              'restarted runs continue stage 1 from it'))
+    parser.add_argument('--ram_budget', type=int, default=0,
+                        help=('MB of RAM for all ecm processes (--asyncio), stage 2 runs '
+                              'are queued to fit and passed -maxmem'))
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('run stage 1 (-save) and stage 2 (-resume) in separate pools '
+                              '(--asyncio), --threads and --ram_budget apply to stage 1'))
+    parser.add_argument('--stage2_threads', type=int, default=1,
+                        help='stage 2 processes with --pipeline')
+    parser.add_argument('--stage2_ram_budget', type=int, default=0,
+                        help='MB of RAM for stage 2 with --pipeline (default --ram_budget)')
+    parser.add_argument('--stage2_backlog', type=int, default=1000,
+                        help='max residues waiting for stage 2 with --pipeline')
+    parser.add_argument('--progress_interval', type=float, default=300,
+                        help='seconds between stage progress reports (--asyncio)')
     parser.add_argument('--log_name',
                         default=None,
                         help=('log name, default: <resume>.json.log or '
                         'ecm_runner_<RAND>.json.log in the current directory.'))
+    parser.add_argument('--log_format', choices=('text', 'binary'), default='text',
+                        help=('text: <log>.log and <log>.json.log, binary: compact <log>.rlog '
+                              'with ecm output only for factors'))
+    parser.add_argument('--metrics_file',
+                        help='rewrite runner metrics (Prometheus text format) to this file')
+    parser.add_argument('--metrics_port', type=int, default=0,
+                        help='serve metrics on http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics_interval', type=float, default=60,
+                        help='seconds between --metrics_file rewrites')
     parser.add_argument('ecm_args', nargs=argparse.REMAINDER,
                         help='arguments to pass through to ecm')
     return parser
@@ -102,9 +160,18 @@ def validate_args(args):
     assert os.path.exists(path), f"ecm_path({path}) doesn't exist"
     assert os.path.isfile(path), f"ecm_path({path}) isn't a file"
 
-    if not args.resume:
-        assert args.B1, "B1 must be specified (unless resuming)"
-        assert args.N, "N must be specified (unless resuming)"
+    assert not (args.resume and args.server), "--resume and --server are exclusive"
+    assert args.asyncio or not args.ram_budget, "--ram_budget requires --asyncio"
+    assert args.asyncio or not args.pipeline, "--pipeline requires --asyncio"
+    assert not (args.pipeline and args.resume), "--resume work is already past stage 1"
+    assert not (args.pipeline and '-save' in args.ecm_args), "--pipeline uses -save itself"
+    assert not (args.pipeline and args.batch_seconds), "--batch_seconds doesn't work with --pipeline"
+    if args.checkpoint_dir:
+        assert '-chkpnt' not in args.ecm_args, "--checkpoint_dir sets -chkpnt itself"
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+    if not args.resume and not args.server:
+        assert args.B1, "B1 must be specified (unless resuming or using --server)"
+        assert args.N, "N must be specified (unless resuming or using --server)"
 
     for bound in [args.B1, args.B2]:
         if bound:
@@ -131,7 +198,54 @@ def validate_args(args):
 
 
 def get_env(args):
-    return Env(args.ecm_binary, ('-v',) + tuple(args.ecm_args))
+    return Env(args.ecm_binary, ('-v',) + tuple(args.ecm_args), args.checkpoint_dir or "")
+
+
+def work_unit_key(wu: WorkUnit) -> str:
+    """Stable name for a WorkUnit across restarts.
+
+    Resume lines are keyed by content so an edited resume file still matches.
+    """
+    if wu.resume_line:
+        return hashlib.blake2b(wu.resume_line.strip().encode(), digest_size=12).hexdigest()
+    return str(wu.uid)
+
+
+def checkpoint_fn(wu: WorkUnit, env: Env) -> str:
+    """Checkpoint file of wu, "" if not checkpointing"""
+    if not env.checkpoint_dir or wu.curves > 1:
+        return ""
+    return os.path.join(env.checkpoint_dir, work_unit_key(wu) + ".chkpnt")
+
+
+def read_checkpoint(fn: str) -> str:
+    """Resume line ecm last wrote to a -chkpnt file, "" if none"""
+    try:
+        with open(fn) as f:
+            lines = [line for line in f if ecm_output.RE_RESUME_N.search(line)]
+    except FileNotFoundError:
+        return ""
+    return lines[-1] if lines else ""
+
+
+def remove_checkpoint(wu: WorkUnit, env: Env):
+    fn = checkpoint_fn(wu, env)
+    if fn and os.path.exists(fn):
+        os.remove(fn)
+
+
+def checkpointed_work_units(args, env: Env) -> List[WorkUnit]:
+    """-N work units whose ecm was killed part way through stage 1"""
+    units = []
+    N = ecm_output.normalize_number(args.N)
+    for fn in sorted(os.listdir(env.checkpoint_dir)):
+        uid, ext = os.path.splitext(fn)
+        if ext != ".chkpnt" or not uid.isdigit():
+            continue
+        match = ecm_output.RE_RESUME_N.search(read_checkpoint(os.path.join(env.checkpoint_dir, fn)))
+        if match and ecm_output.normalize_number(match.group(1)) == N:
+            units.append(WorkUnit(int(uid), args.N, ("-v", "-timestamp"), B1=args.B1, B2=args.B2))
+    return units
 
 
 def get_command(wu: WorkUnit, env: Env) -> List[str]:
@@ -142,12 +256,23 @@ def get_command(wu: WorkUnit, env: Env) -> List[str]:
     cmd.extend(wu.params)
     cmd.extend(env.extra_params)
 
-    if wu.resume_line:
-        stdin = wu.resume_line
+    chkpnt = checkpoint_fn(wu, env)
+    resume_line = read_checkpoint(chkpnt) if chkpnt else ""
+    if chkpnt:
+        cmd.extend(["-chkpnt", chkpnt])
+
+    # Continue from the last checkpoint of a killed run
+    resume_line = resume_line or wu.resume_line
+    if resume_line:
+        stdin = resume_line
         # Reads the resume line from stdin
         cmd.extend(["-resume", "-"])
 
         assert wu.B1
+        assert wu.curves == 1
+
+    if wu.curves > 1:
+        cmd.extend(["-c", str(wu.curves)])
 
     if wu.B1:
         cmd.append(wu.B1)
@@ -158,22 +283,145 @@ def get_command(wu: WorkUnit, env: Env) -> List[str]:
     return (stdin, cmd)
 
 
-def get_work_units(args, count: int) -> List[WorkUnit]:
+class WorkClient:
+    """Leases work units from and uploads results to an ecm-db work server."""
+
+    # Tries per request, transient errors are retried after
+    # RETRY_SECONDS, 2 * RETRY_SECONDS, ...
+    ATTEMPTS = 3
+    RETRY_SECONDS = 1
+    # After a failed lease no request is made for LEASE_BACKOFF seconds,
+    # doubling with each failure up to LEASE_MAX_BACKOFF
+    LEASE_BACKOFF = 30
+    LEASE_MAX_BACKOFF = 30 * 60
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_failures = 0
+        self.next_lease = 0
+
+
+    def _post(self, path, obj):
+        data = json.dumps(obj).encode()
+        for attempt in range(WorkClient.ATTEMPTS):
+            request = urllib.request.Request(
+                self.url + path, data=data, headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    return json.load(response)
+            except urllib.error.HTTPError as e:
+                # Bad requests won't get better
+                if e.code < 500 or attempt + 1 == WorkClient.ATTEMPTS:
+                    raise
+            except (OSError, http.client.HTTPException):
+                if attempt + 1 == WorkClient.ATTEMPTS:
+                    raise
+            time.sleep(WorkClient.RETRY_SECONDS * 2 ** attempt)
+
+
+    def lease_wait(self) -> float:
+        """Seconds until lease() asks the server again"""
+        return max(0, self.next_lease - time.monotonic())
+
+
+    def lease(self, count: int) -> Optional[List[WorkUnit]]:
+        """Up to count work units, None while backing off from a failed lease"""
+        if self.lease_wait():
+            return None
+        try:
+            response = self._post("/lease", {"owner": self.owner, "count": count})
+        except Exception as e:
+            if not upload_error(e):
+                raise
+            self.lease_failures += 1
+            backoff = min(WorkClient.LEASE_MAX_BACKOFF,
+                          WorkClient.LEASE_BACKOFF * 2 ** (self.lease_failures - 1))
+            self.next_lease = time.monotonic() + backoff
+            print(f"Lease failed ({e}), retrying in {backoff}s")
+            return None
+
+        self.lease_failures = 0
+        return [WorkUnit(**dict(wu, params=tuple(wu["params"]))) for wu in response["work"]]
+
+
+    def upload(self, results) -> int:
+        """Upload a batch of (wu, result) pairs"""
+        if not results:
+            return 0
+        pairs = [[dataclasses.asdict(wu), dataclasses.asdict(result)] for wu, result in results]
+        return self.upload_json(pairs)
+
+
+    def upload_json(self, pairs) -> int:
+        """Upload [wu, result] dicts as in a .json.log, safe to repeat (see /results)"""
+        return self._post("/results", {"results": pairs})["recorded"]
+
+
+def upload_error(e: BaseException) -> bool:
+    """True for errors talking to the work server that may go away on their own"""
+    return isinstance(e, (OSError, http.client.HTTPException, ValueError))
+
+
+def get_work_units(args, count: int, client: WorkClient = None,
+                   curves: int = 1) -> Optional[List[WorkUnit]]:
+    """Up to count new work units.
+
+    [] when there's no more work, None when the work server can't be reached
+    right now (see WorkClient.lease).
+    """
     assert not args.resume
 
+    if client:
+        return client.lease(count)
+
     if args.N:
         units = []
         for _ in range(count):
             uid = random.randint(0, 10**9)
             assert args.N
             assert args.B1
-            wu = WorkUnit(uid, args.N, ("-v", "-timestamp"), B1=args.B1, B2=args.B2)
+            wu = WorkUnit(uid, args.N, ("-v", "-timestamp"), B1=args.B1, B2=args.B2,
+                          curves=curves)
             units.append(wu)
         return units
 
     return []
 
 
+class CurveBatcher:
+    """Picks curves per ecm process so each run takes about target seconds.
+
+    Small B1 curves are dominated by process start up, packing K curves in
+    one `ecm -c K` amortizes it. K adapts to measured time per curve.
+    """
+
+    def __init__(self, target_seconds: float, max_curves: int):
+        self.target = target_seconds
+        self.max_curves = max_curves
+        # Exponential moving average of seconds per curve
+        self.per_curve = None
+
+
+    def curves(self) -> int:
+        if not self.target:
+            return 1
+        if self.per_curve is None:
+            # Measure with a single curve first
+            return 1
+        return max(1, min(self.max_curves, round(self.target / max(self.per_curve, 1e-3))))
+
+
+    def observe(self, results: List["EcmOutput"]):
+        if not results:
+            return
+        per_curve = sum(r.runtime for r in results) / len(results)
+        if self.per_curve is None:
+            self.per_curve = per_curve
+        else:
+            self.per_curve = 0.8 * self.per_curve + 0.2 * per_curve
+
+
 def resume_to_work_units(args) -> List[WorkUnit]:
     last_B1 = None
     with open(args.resume) as f:
@@ -182,9 +430,9 @@ def resume_to_work_units(args) -> List[WorkUnit]:
             if not line:
                 continue
 
-            match = RE_RESUME_N.search(line)
+            match = ecm_output.RE_RESUME_N.search(line)
             assert match, "N not found in resume line: " + repr(line)
-            N = match.group(1)
+            N = match.group(1).strip()
 
             match = RE_B1_B2.search(line)
             assert match, "B1, B2 not found in resume line"
@@ -216,53 +464,71 @@ def parse_returncode(code: int):
     return code & 1, (code >> 1) & 1, (code >> 2) & 1, (code >> 3) & 1
 
 
-def _get_match(regexp, stdout):
-    match = regexp.search(stdout)
-    assert match, (regexp, stdout)
-    if regexp.groups == 1:
-      return match.group(1)
-    return match.group()
-
-
-def process_output(output: subprocess.CompletedProcess, runtime: float):
-    is_error, found_factor, prime_factor, prime_cofactor = (
-            parse_returncode(output.returncode))
-    assert not is_error
-
-    factors = tuple()
-    if found_factor:
-        factors1 = RE_FACTORS_FMT1.findall(output.stdout)
-        factors2 = RE_FACTORS_FMT2.findall(output.stdout)
-        factors = tuple(sorted(set(map(int, factors1 + factors2))))
-        # TODO very verbose flag
-        if False:
-            print("-" * 80)
-            print(output.stdout)
-            print("-" * 80)
-            print(f"Return: {output.returncode} | {is_error = }, {found_factor = }, {prime_factor = } {prime_cofactor =}")
-            print("Factor(s):", " ".join(map(str, factors)))
-            print("-" * 80)
-
-    version = _get_match(RE_VERSION, output.stdout)
-    using = _get_match(RE_USING, output.stdout)
-    step1_timing = int(_get_match(RE_STEP1_TIMING, output.stdout))
-    # Not present if factor found in step 1
-    if found_factor and "Factor found in step 1" in output.stdout:
-        step2_timing = 0
-    else:
-        step2_timing = int(_get_match(RE_STEP2_TIMING, output.stdout))
+# Fields process_output can't do without, step2_ms only when stage 2 ran
+REQUIRED_FIELDS = ("version", "using", "step1_ms", "step2_ms")
 
-    result = EcmOutput(
-        factors,
-        output.returncode,
-        resume_line="",
-        using=using,
-        version=version,
-        output=output.stdout,
-        timings=(step1_timing, step2_timing),
-        runtime=runtime)
 
-    return result
+def curve_result(curve: ecm_output.Curve, returncode: int, runtime: float,
+                 stage2: bool = True) -> EcmOutput:
+    """EcmOutput of one parsed curve, EcmOutputError if fields are missing"""
+    is_error, found_factor, prime_factor, prime_cofactor = parse_returncode(returncode)
+    errors = [e for e in curve.errors
+              if e.field in REQUIRED_FIELDS and (stage2 or e.field != "step2_ms")]
+    if is_error:
+        errors.append(ecm_output.ParseError(
+            "exit_status", f"ecm exited with error status {returncode}", curve.line))
+    if errors:
+        raise ecm_output.EcmOutputError(errors, curve.output)
+
+    return EcmOutput(
+        curve.factors if found_factor else (),
+        returncode,
+        resume_line="",
+        using=curve.using,
+        version=curve.version,
+        output=curve.output,
+        # Not present if factor found in step 1 or stage 2 was skipped
+        timings=(curve.step1_ms, (curve.step2_ms or 0) if stage2 else 0),
+        runtime=runtime,
+        sigma=curve.sigma or "")
+
+
+def process_output(output: subprocess.CompletedProcess, runtime: float, stage2: bool = True):
+    """EcmOutput of a single curve ecm run"""
+    results = process_batch_output(output, runtime, stage2)
+    if len(results) != 1:
+        raise ecm_output.EcmOutputError(
+            [ecm_output.ParseError("curves", f"expected 1 curve, found {len(results)}", 1)],
+            output.stdout)
+    return results[0]
+
+
+def split_output(stdout: str) -> List[str]:
+    """Split `ecm -c K` output into K outputs that each look like a single curve"""
+    return [curve.output for curve in ecm_output.parse_output(stdout)] or [stdout]
+
+
+def process_batch_output(output: subprocess.CompletedProcess, runtime: float,
+                         stage2: bool = True) -> List[EcmOutput]:
+    """EcmOutput for each curve of a (possibly -c K) ecm run"""
+    curves = ecm_output.parse_output(output.stdout)
+    if not curves:
+        raise ecm_output.EcmOutputError(
+            [ecm_output.ParseError("using", "no curves in output", 1)], output.stdout)
+    if len(curves) == 1:
+        return [curve_result(curves[0], output.returncode, runtime, stage2)]
+
+    results = []
+    for curve in curves:
+        # Exit status describes the factor, keep only the error bit elsewhere.
+        returncode = output.returncode if curve.factor_step else output.returncode & 1
+        results.append(curve_result(curve, returncode, 0, stage2))
+
+    # Split wall time in proportion to ecm's own timings
+    total_ms = sum(sum(r.timings) for r in results)
+    for r in results:
+        r.runtime = runtime * (sum(r.timings) / total_ms if total_ms else 1 / len(results))
+    return results
 
 
 def run(wu: WorkUnit, env: Env) -> subprocess.CompletedProcess:
@@ -275,14 +541,67 @@ def run(wu: WorkUnit, env: Env) -> subprocess.CompletedProcess:
     return output
 
 
+async def run_async(wu: WorkUnit, env: Env, on_line=None, on_start=None) -> subprocess.CompletedProcess:
+    """Run a WorkUnit in Env as an asyncio subprocess, killed if cancelled
+
+    on_line (if given) is called with each line of stdout as ecm prints it.
+    on_start (if given) is called with the process once it's started.
+    """
+    stdin, command = get_command(wu, env)
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=STREAM_LIMIT)
+    if on_start:
+        on_start(proc)
+    stderr = asyncio.create_task(proc.stderr.read())
+    try:
+        proc.stdin.write(stdin.encode())
+        await proc.stdin.drain()
+        proc.stdin.close()
+
+        lines = []
+        while line := await proc.stdout.readline():
+            line = line.decode()
+            lines.append(line)
+            if on_line:
+                on_line(line)
+
+        await proc.wait()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr.cancel()
+        raise
+    return subprocess.CompletedProcess(
+        command, proc.returncode, "".join(lines), (await stderr).decode())
+
+
+def curve_stage(line: str, stage: str) -> str:
+    """Update a curve's stage from one line of ecm -v output"""
+    if "Factor found" in line:
+        return "factor"
+    if line.startswith("Step 1 took"):
+        return "stage 2"
+    if line.startswith("Step 2 took"):
+        return "done"
+    return stage
+
+
 def ecm_worker(name, env, work, results):
+    # terminate() raises SystemExit here, subprocess.run then kills the running ecm
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     while True:
         wu = work.get()
+        # (wu, None) tells the main process wu started, for the journal
+        results.put((wu, None))
         t0 = time.time()
         out = run(wu, env)
         t1 = time.time()
-        result = process_output(out, t1-t0)
-        results.put((wu, result))
+        results.put((wu, process_batch_output(out, t1-t0)))
 
 
 def start_workers(env: Env, work: mp.Queue, results: mp.Queue, num_workers: int):
@@ -306,10 +625,10 @@ def print_nth_curve(n):
 def short_repr(n):
     n = str(n)
     if len(n) < 20:
-      return n
+        return n
 
     if n.isnumeric():
-      return f"{n[:5]}...{n[-5:]}<{len(n)}>"
+        return f"{n[:5]}...{n[-5:]}<{len(n)}>"
 
     return n
 
@@ -355,52 +674,553 @@ def get_log_fn(args):
     return fn + ".log"
 
 
-class ProcessResults:
-  def __init__(self, log_fn):
-    self.pp = pprint.PrettyPrinter(width=80, compact=True)
-    self.results = defaultdict(list)
+def get_journal_fn(log_fn):
+    """Journal lives next to the logs: <log name>.journal"""
+    assert log_fn.endswith(".log")
+    return log_fn[:-len(".log")] + ".journal"
+
+
+def _truncate_partial_line(fn):
+    """Drop a final line cut short by a crash so appended records parse."""
+    with open(fn, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        pos = size
+        while pos > 0:
+            step = min(pos, 64 * 1024)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                pos = pos - step + newline + 1
+                break
+            pos -= step
+        if pos != size:
+            f.truncate(pos)
+
+
+class Journal:
+    """Append only record of started (D) and completed (C) work units.
+
+    Each line is "<D|C> <key>". Records are written straight away but only
+    fsynced every sync_every completions or sync_seconds. Completions a
+    crash loses are recovered from the logs (see add_logged), only units
+    whose results never reached the log are rerun.
+    """
+
+    def __init__(self, fn, sync_every=100, sync_seconds=10):
+        self.fn = fn
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+
+        self.dispatched = set()
+        self.completed = set()
+        self.restarted = os.path.exists(fn)
+        if self.restarted:
+            _truncate_partial_line(fn)
+            with open(fn) as f:
+                for line in f:
+                    kind, key = line.split()
+                    if kind == "C":
+                        self.completed.add(key)
+                    else:
+                        assert kind == "D", line
+                        self.dispatched.add(key)
+
+        self.f = open(fn, "a")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+
+    def unfinished(self, units: List[WorkUnit]) -> List[WorkUnit]:
+        """Filter out units completed in a previous run"""
+        if not self.completed:
+            return units
+        todo = [wu for wu in units if work_unit_key(wu) not in self.completed]
+        interrupted = len(self.dispatched - self.completed)
+        print(f"Journal {self.fn!r}: skipping {len(units) - len(todo)} completed work units, "
+              f"{len(todo)} left ({interrupted} were started)")
+        return todo
+
+
+    def add_logged(self, keys):
+        """Count work units whose results are in the log as completed"""
+        missing = set(keys) - self.completed
+        if missing:
+            print(f"Journal {self.fn!r}: {len(missing)} logged work units weren't journaled "
+                  "as completed")
+        for key in sorted(missing):
+            self.f.write(f"C {key}\n")
+        self.completed |= missing
+
+
+    def dispatch(self, wu: WorkUnit):
+        """wu's ecm was started"""
+        self.f.write(f"D {work_unit_key(wu)}\n")
+
+
+    def complete(self, wu: WorkUnit):
+        self.f.write(f"C {work_unit_key(wu)}\n")
+        self.unsynced += 1
+
+
+    def sync_due(self) -> bool:
+        return self.unsynced >= self.sync_every or (
+            self.unsynced and time.monotonic() - self.last_sync >= self.sync_seconds)
 
-    assert log_fn.endswith(".log") and not log_fn.endswith(".json.log")
-    self.log_fn_text = log_fn
-    self.log_fn_json = log_fn.replace(".log", ".json.log")
-    assert not os.path.exists(self.log_fn_text), f"{self.log_fn_text!r} already exists!"
-    assert not os.path.exists(self.log_fn_json), f"{self.log_fn_json!r} already exists!"
-    print(f"Logging results to {self.log_fn_text!r}")
-    print(f"Logging results to {self.log_fn_json!r}")
-    self.log_f_text = None
-    self.log_f_json = None
 
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
 
-  def _save_result(self, wu, result):
-    if not self.log_f_text:
-      self.log_f_text = open(self.log_fn_text, "w")
-      self.log_f_json = open(self.log_fn_json, "w")
 
-    self.log_f_text.write(verbose_result_format(wu, result, self.pp))
-    self.log_f_text.write("\n")
-    self.log_f_text.flush()
+    def close(self):
+        self.sync()
+        self.f.close()
 
-    self.log_f_json.write(json_result_format(wu, result))
-    self.log_f_json.write("\n")
-    self.log_f_json.flush()
 
+def logged_work_unit_keys(log_fns, log_format):
+    """work_unit_key of every result in the logs ProcessResults writes"""
+    keys = set()
+    if log_format == "binary":
+        if os.path.exists(log_fns[0]) and result_log.valid_length(log_fns[0]):
+            for record in result_log.iter_records(log_fns[0]):
+                keys.add(work_unit_key(WorkUnit(
+                    record.uid, record.n, (), record.B1, record.B2,
+                    resume_line=record.wu_resume_line or "")))
+    elif os.path.exists(log_fns[1]):
+        with open(log_fns[1]) as f:
+            for line in f:
+                wu, _ = json.loads(line)
+                keys.add(work_unit_key(WorkUnit(**dict(wu, params=tuple(wu["params"])))))
+    return keys
 
-  def process(self, wu, result):
-    self.results[wu.n].append(result)
-    count_n = len(self.results[wu.n])
 
-    self._save_result(wu, result)
+class LogWriter(threading.Thread):
+    """Formats and writes results on its own thread.
 
-    if print_nth_curve(count_n):
-        n = short_repr(wu.n)
-        total_curves = sum(len(v) for v in self.results.values())
-        print(f"Result: {total_curves}, Curve: {count_n} N: {n} @ {datetime.now().isoformat()}")
+    Records are flushed to the OS every flush_records records or
+    flush_seconds, flush() waits until everything queued so far is written.
+    A binary log ends its compressed block on each flush, so blocks hold
+    flush_records records (fewer when flushed early).
+    """
+
+    # Queue item asking for a flush, (FLUSH, fsync, done event)
+    FLUSH = object()
+
+    def __init__(self, log_fns, log_format, log_mode, max_queue=10000,
+                 flush_records=1000, flush_seconds=10):
+        super().__init__(name="LogWriter", daemon=True)
+        self.log_fns = log_fns
+        self.log_format = log_format
+        self.log_mode = log_mode
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pp = pprint.PrettyPrinter(width=80, compact=True)
+        self.files = None
+        self.unflushed = 0
+        # Exception from the writer thread, raised on the main thread
+        self.error = None
+        self.start()
+
+
+    def _open(self):
+        if self.log_format == "binary":
+            self.files = [result_log.ResultLogWriter(self.log_fns[0], block_records=self.flush_records)]
+        else:
+            self.files = [open(fn, self.log_mode) for fn in self.log_fns]
+
+
+    def _write(self, wu, result):
+        if not self.files:
+            self._open()
+
+        if self.log_format == "binary":
+            self.files[0].write(wu, result)
+        else:
+            log_f_text, log_f_json = self.files
+            log_f_text.write(verbose_result_format(wu, result, self.pp))
+            log_f_text.write("\n")
+            log_f_json.write(json_result_format(wu, result))
+            log_f_json.write("\n")
+        self.unflushed += 1
+
+
+    def _flush(self, fsync=False):
+        for f in self.files or ():
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+
+    def run(self):
+        self.last_flush = time.monotonic()
+        try:
+            while True:
+                timeout = None
+                if self.unflushed:
+                    timeout = max(0, self.last_flush + self.flush_seconds - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    self._flush()
+                    continue
+
+                if item is None:
+                    break
+                if item[0] is LogWriter.FLUSH:
+                    _, fsync, done = item
+                    self._flush(fsync)
+                    done.set()
+                    continue
+
+                self._write(*item)
+                if self.unflushed >= self.flush_records:
+                    self._flush()
+        except BaseException as e:
+            self.error = e
+            # Don't leave the main thread waiting on a flush
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item and item[0] is LogWriter.FLUSH:
+                    item[2].set()
+        finally:
+            for f in self.files or ():
+                f.close()
+
+
+    def _check(self):
+        if self.error:
+            raise RuntimeError("log writer failed") from self.error
+
+
+    def put(self, wu, result):
+        self._check()
+        # Blocks when the writer is max_queue records behind
+        self.queue.put((wu, result))
+
+
+    def flush(self, fsync=False):
+        """Write and flush everything queued so far."""
+        self._check()
+        done = threading.Event()
+        self.queue.put((LogWriter.FLUSH, fsync, done))
+        while not done.wait(1):
+            if not self.is_alive():
+                break
+        self._check()
+
+
+    def close(self):
+        """Drain the queue, flush and close the logs."""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        self._check()
+
+
+class Metrics:
+    """Runner counters and histograms in Prometheus text format.
+
+    Rendered to a periodically rewritten file and/or served on
+    http://127.0.0.1:<port>/metrics by MetricsReporter.
+    """
+
+    # Histogram buckets (ms), powers of 2 up to ~4.6 hours
+    BUCKETS_MS = tuple(2 ** i for i in range(25))
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.curves_n = defaultdict(int)
+        self.curves_B1 = defaultdict(int)
+        self.factors = 0
+        # name -> [bucket counts..., +Inf count], sum
+        self.histograms = {name: [[0] * (len(Metrics.BUCKETS_MS) + 1), 0]
+                           for name in ("stage1_ms", "stage2_ms", "overhead_ms")}
+        # Seconds of ecm subprocess wall time
+        self.busy_seconds = 0.0
+        self.queued = 0
+        self.running = 0
+
+
+    def _observe(self, name, ms):
+        counts, _ = self.histograms[name]
+        counts[bisect.bisect_left(Metrics.BUCKETS_MS, ms)] += 1
+        self.histograms[name][1] += ms
+
+
+    def observe(self, wu, result):
+        with self.lock:
+            self.curves_n[short_repr(wu.n)] += 1
+            self.curves_B1[wu.B1] += 1
+            self.factors += bool(result.factors)
+            self._observe("stage1_ms", result.timings[0])
+            self._observe("stage2_ms", result.timings[1])
+            # Process start up, parsing and anything else ecm doesn't time itself
+            self._observe("overhead_ms", max(0, 1000 * result.runtime - sum(result.timings)))
+            self.busy_seconds += result.runtime
+
+
+    def set_queue(self, queued, running):
+        with self.lock:
+            self.queued = queued
+            self.running = running
+
+
+    def render(self) -> str:
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start, 1e-6)
+            lines = [
+                f"ecm_runner_uptime_seconds {elapsed:.1f}",
+                f"ecm_runner_factors_total {self.factors}",
+                f"ecm_runner_queue_depth {self.queued}",
+                f"ecm_runner_running {self.running}",
+                f"ecm_runner_utilization {self.busy_seconds / (elapsed * self.threads):.4f}",
+            ]
+            for label, counts in (("n", self.curves_n), ("B1", self.curves_B1)):
+                for value, count in sorted(counts.items()):
+                    lines.append(f'ecm_runner_curves_total{{{label}="{value}"}} {count}')
+                    lines.append(f'ecm_runner_curves_per_hour{{{label}="{value}"}} {3600 * count / elapsed:.1f}')
+
+            for name, (counts, total) in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(Metrics.BUCKETS_MS + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f'ecm_runner_{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"ecm_runner_{name}_sum {total:.0f}")
+                lines.append(f"ecm_runner_{name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter(threading.Thread):
+    """Rewrites a metrics file every interval and optionally serves /metrics on localhost."""
+
+    def __init__(self, metrics, fn=None, port=0, interval=60):
+        super().__init__(name="MetricsReporter", daemon=True)
+        self.metrics = metrics
+        self.fn = fn
+        self.interval = interval
+        self.stopped = threading.Event()
+
+        self.httpd = None
+        if port:
+            reporter = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = reporter.metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, name="MetricsHTTP", daemon=True).start()
+            print(f"Serving metrics on http://127.0.0.1:{self.httpd.server_address[1]}/metrics")
+        self.start()
+
+
+    def write(self):
+        if not self.fn:
+            return
+        tmp_fn = self.fn + ".tmp"
+        with open(tmp_fn, "w") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp_fn, self.fn)
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+
+    def close(self):
+        self.stopped.set()
+        self.write()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def get_metrics(args):
+    """(Metrics, MetricsReporter) or (None, None) if not asked for"""
+    if not (args.metrics_file or args.metrics_port):
+        return None, None
+    metrics = Metrics(args.threads + (args.stage2_threads if args.pipeline else 0))
+    return metrics, MetricsReporter(metrics, args.metrics_file, args.metrics_port,
+                                    args.metrics_interval)
 
-    if result.factors:
-        print(verbose_result_format(wu, result, self.pp))
-        print("Curve count:", count_n)
-        print("Factor(s):", ", ".join(map(str, result.factors)))
-    return result.factors
+
+class ProcessResults:
+    # Seconds to wait before retrying a failed upload, doubling up to UPLOAD_MAX_BACKOFF
+    UPLOAD_BACKOFF = 30
+    UPLOAD_MAX_BACKOFF = 30 * 60
+
+    def __init__(self, log_fn, client=None, upload_batch=1, journal=None, log_format="text",
+                 metrics=None):
+        self.pp = pprint.PrettyPrinter(width=80, compact=True)
+        self.metrics = metrics
+        # N -> curves
+        self.counts = defaultdict(int)
+        self.total_curves = 0
+
+        # Results not yet uploaded to the server, kept while it can't be reached
+        self.client = client
+        self.upload_batch = upload_batch
+        self.pending = []
+        self.pending_factor = False
+        self.upload_failures = 0
+        self.next_upload = 0
+        self.unsent_fn = log_fn[:-len(".log")] + ".unsent.json.log"
+
+        # Completed work units are journaled after their results are logged
+        self.journal = journal
+        restarted = journal and journal.restarted
+
+        assert log_fn.endswith(".log") and not log_fn.endswith(".json.log")
+        if log_format == "binary":
+            log_fns = [log_fn[:-len(".log")] + ".rlog"]
+        else:
+            assert log_format == "text", log_format
+            log_fns = [log_fn, log_fn.replace(".log", ".json.log")]
+
+        log_mode = "w"
+        if restarted:
+            # Continue the logs of the interrupted run
+            log_mode = "a"
+            if log_format == "text":
+                for fn in log_fns:
+                    if os.path.exists(fn):
+                        _truncate_partial_line(fn)
+            # Results logged just before a crash may not have been journaled
+            journal.add_logged(logged_work_unit_keys(log_fns, log_format))
+        else:
+            for fn in log_fns:
+                assert not os.path.exists(fn), f"{fn!r} already exists!"
+        for fn in log_fns:
+            print(f"Logging results to {fn!r}")
+        self.writer = LogWriter(log_fns, log_format, log_mode)
+
+
+    def process(self, wu, result):
+        self.counts[wu.n] += 1
+        self.total_curves += 1
+        count_n = self.counts[wu.n]
+
+        self.writer.put(wu, result)
+        if self.metrics:
+            self.metrics.observe(wu, result)
+        if result.factors:
+            # Factors are on disk before anything else happens
+            self.writer.flush()
+
+        if print_nth_curve(count_n):
+            n = short_repr(wu.n)
+            print(f"Result: {self.total_curves}, Curve: {count_n} N: {n} @ {datetime.now().isoformat()}")
+
+        if self.client:
+            self.pending.append((wu, result))
+            self.pending_factor |= bool(result.factors)
+
+        if result.factors:
+            print(verbose_result_format(wu, result, self.pp))
+            print("Curve count:", count_n)
+            print("Factor(s):", ", ".join(map(str, result.factors)))
+        return result.factors
+
+
+    def finished(self, wu):
+        """All results of wu were processed"""
+        # Uploads hold whole work units, the server skips units it already has
+        if self.client and (self.pending_factor or len(self.pending) >= self.upload_batch):
+            self.upload()
+
+        if self.journal:
+            self.journal.complete(wu)
+            if self.journal.sync_due():
+                self._sync_logs()
+                self.journal.sync()
+
+
+    def _sync_logs(self):
+        # Logs reach disk before the journal says their work units are done
+        self.writer.flush(fsync=True)
+
+
+    def upload(self, force=False):
+        """Upload pending results, returns False (keeping them) if that failed.
+
+        After a failure uploads are skipped (unless force) for an exponentially
+        growing backoff so a server outage doesn't stall the runner.
+        """
+        if not (self.client and self.pending):
+            return True
+        if not force and time.monotonic() < self.next_upload:
+            return False
+
+        try:
+            self.client.upload(self.pending)
+        except Exception as e:
+            if not upload_error(e):
+                raise
+            self.upload_failures += 1
+            backoff = min(ProcessResults.UPLOAD_MAX_BACKOFF,
+                          ProcessResults.UPLOAD_BACKOFF * 2 ** (self.upload_failures - 1))
+            self.next_upload = time.monotonic() + backoff
+            print(f"Upload of {len(self.pending)} results failed ({e}), retrying in {backoff}s")
+            return False
+
+        self.pending.clear()
+        self.pending_factor = False
+        self.upload_failures = 0
+        self.next_upload = 0
+        return True
+
+
+    def _save_unsent(self):
+        """Append results the server never got to <log>.unsent.json.log"""
+        with open(self.unsent_fn, "a") as f:
+            for wu, result in self.pending:
+                f.write(json_result_format(wu, result))
+                f.write("\n")
+        print(f"Saved {len(self.pending)} results that weren't uploaded to {self.unsent_fn!r}, "
+              f"upload them with tools/upload_results.py")
+        self.pending.clear()
+
+
+    def close(self):
+        # Logs and journal are on disk before (and whatever happens with) the last upload
+        try:
+            if self.journal:
+                self._sync_logs()
+                self.journal.close()
+        finally:
+            self.writer.close()
+
+        try:
+            self.upload(force=True)
+        finally:
+            if self.pending:
+                self._save_unsent()
 
 
 def main_loop(args):
@@ -415,33 +1235,72 @@ def main_loop(args):
     total_work = 0
     total_finished = 0
     seen = set()
+    # Queued or running, their checkpoints go if another curve factors N
+    unfinished = set()
+
+    client = WorkClient(args.server) if args.server else None
+    batcher = CurveBatcher(args.batch_seconds, args.max_batch_curves)
 
     workers = start_workers(env, work, results, num_workers=args.threads)
     time.sleep(0.02)
 
+    log_name = get_log_fn(args)
+    journal = Journal(get_journal_fn(log_name)) if args.resume else None
+    metrics, reporter = get_metrics(args)
+    process_results = ProcessResults(log_name, client, upload_batch=args.threads,
+                                     journal=journal, log_format=args.log_format,
+                                     metrics=metrics)
+
     if args.resume:
-        units = resume_to_work_units(args)
+        units = journal.unfinished(resume_to_work_units(args))
         for wu in units:
             work.put(wu)
+            unfinished.add(wu)
         total_work = len(units)
         stop_on_factor = False
         add_more = False
         print(f"Added {len(units)} work units from -resume {args.resume}")
-
-    log_name = get_log_fn(args)
-    process_results = ProcessResults(log_name)
+    elif env.checkpoint_dir and args.N:
+        units = checkpointed_work_units(args, env)
+        for wu in units:
+            work.put(wu)
+            unfinished.add(wu)
+        total_work = len(units)
+        if units:
+            print(f"Added {len(units)} work units from checkpoints in {env.checkpoint_dir}")
 
     try:
         while True:
             time.sleep(0.02)
+            if metrics:
+                outstanding = total_work - total_finished
+                running = min(args.threads, outstanding)
+                metrics.set_queue(outstanding - running, running)
             while not results.empty():
-                total_finished += 1
-                wu, result = results.get_nowait()
-                process_results.process(wu, result)
+                wu, wu_results = results.get_nowait()
+                if wu_results is None:
+                    # A worker started wu
+                    if journal:
+                        journal.dispatch(wu)
+                    continue
 
-                if result.factors and stop_on_factor:
+                total_finished += 1
+                unfinished.discard(wu)
+                batcher.observe(wu_results)
+                for result in wu_results:
+                    process_results.process(wu, result)
+                process_results.finished(wu)
+                remove_checkpoint(wu, env)
+
+                if any(result.factors for result in wu_results) and stop_on_factor:
                     for worker in workers:
                         worker.terminate()
+                    for worker in workers:
+                        worker.join()
+                    # Like cancelled siblings in AsyncRunner, their checkpoints aren't needed
+                    for other in unfinished:
+                        if other.n == wu.n:
+                            remove_checkpoint(other, env)
                     return
 
             for worker in workers:
@@ -449,23 +1308,23 @@ def main_loop(args):
 
             if work.empty():
                 if add_more:
-                    # TODO get real WorkUnits from server
-                    added = 0
-                    for wu in get_work_units(args, 2 * args.threads):
-                        added += 1
+                    # None while the work server can't be reached, asked again after a backoff
+                    units = get_work_units(args, 2 * args.threads, client, batcher.curves())
+                    for wu in units or ():
                         work.put(wu)
+                        unfinished.add(wu)
                         if wu.n not in seen:
                             seen.add(wu.n)
                             print("New N:", short_repr(wu.n))
-                    total_work += added
+                    total_work += len(units or ())
 
-                    if added:
-                        print(f"Added {added} work units, finished {total_finished}")
-                    else:
+                    if units:
+                        print(f"Added {len(units)} work units, finished {total_finished}")
+                    elif units is not None:
                         add_more = False
                         print(f"No work to add: {total_finished}/{total_work}")
 
-                if total_work == total_finished:
+                if total_work == total_finished and not (add_more and client and client.lease_wait()):
                     # No new work, all work finished
                     assert work.empty()
                     assert results.empty()
@@ -488,6 +1347,430 @@ def main_loop(args):
                 worker.terminate()
         raise
 
+    finally:
+        process_results.close()
+        if reporter:
+            reporter.close()
+
+
+def peak_rss_mb(pid: int) -> float:
+    """Peak resident memory (VmHWM) of a running process in MB, 0 if unknown"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class MemoryModel:
+    """Estimates MB used by an ecm run, learning from finished runs.
+
+    Stage 2 stores O(sqrt(B2)) residues of size N so the estimate is
+    BASE_MB + COEF * sqrt(B2) * bytes(N), scaled up by a high percentile
+    of the ratio of observed to estimated memory over recent runs. One
+    outlier can't shrink parallelism for the rest of the run.
+    """
+
+    BASE_MB = 16
+    COEF = 4
+    # Used when N is an expression not yet seen in ecm's output.
+    DEFAULT_DIGITS = 300
+    # Observations kept and the percentile of their ratios used as scale
+    WINDOW = 50
+    PERCENTILE = 0.9
+
+    def __init__(self):
+        self.scale = 1.0
+        self.ratios = deque(maxlen=MemoryModel.WINDOW)
+        self.digits = {}
+
+
+    def _digits(self, wu: WorkUnit) -> int:
+        if wu.n.isdigit():
+            return len(wu.n)
+        return self.digits.get(wu.n, MemoryModel.DEFAULT_DIGITS)
+
+
+    def _raw_estimate(self, wu: WorkUnit) -> float:
+        B1 = float(wu.B1)
+        # Roughly GMP-ECM's default B2 if not given
+        B2 = float(wu.B2) if wu.B2 else 4 * B1 ** 1.4
+        n_bytes = self._digits(wu) * 0.415 + 16
+        return MemoryModel.BASE_MB + MemoryModel.COEF * B2 ** 0.5 * n_bytes / 2 ** 20
+
+
+    def estimate(self, wu: WorkUnit) -> int:
+        return math.ceil(self._raw_estimate(wu) * self.scale)
+
+
+    def observe_line(self, wu: WorkUnit, line: str):
+        """Learn N's size and ecm's own memory estimate from output"""
+        match = RE_INPUT_DIGITS.match(line)
+        if match:
+            self.digits[wu.n] = int(match.group(1))
+            return
+
+        match = RE_MEMORY_USAGE.match(line)
+        if match:
+            self.observe(wu, ecm_output.memory_mb(*match.groups()))
+
+
+    def observe(self, wu: WorkUnit, mb: float):
+        """Learn from the real (peak) memory use of a run"""
+        if mb > 0:
+            self.ratios.append(mb / self._raw_estimate(wu))
+            ratios = sorted(self.ratios)
+            # Never below the model itself, small stage 1 runs share it
+            self.scale = max(1.0, ratios[min(len(ratios) - 1,
+                                             int(MemoryModel.PERCENTILE * len(ratios)))])
+
+
+class MemoryBudget:
+    """Admits runs while their reserved MB fit in the budget"""
+
+    def __init__(self, budget_mb: int):
+        self.budget = budget_mb
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+
+    async def acquire(self, mb: int):
+        async with self.condition:
+            # A run larger than the budget is admitted alone.
+            await self.condition.wait_for(
+                lambda: self.used == 0 or self.used + mb <= self.budget)
+            self.used += mb
+
+
+    async def release(self, mb: int):
+        async with self.condition:
+            self.used -= mb
+            self.condition.notify_all()
+
+
+class AsyncRunner:
+    """Runs work units as asyncio subprocesses, at most --threads at a time.
+
+    Completions are handled as soon as they happen, there are no worker
+    processes or result queues to poll.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.env = get_env(args)
+        self.client = WorkClient(args.server) if args.server else None
+
+        # TODO configure with arg?
+        self.stop_on_factor = not args.resume
+        self.add_more = not args.resume
+
+        self.work = deque()
+        self.seen = set()
+        self.running = set()
+        self.semaphore = asyncio.Semaphore(args.threads)
+
+        self.batcher = CurveBatcher(args.batch_seconds, args.max_batch_curves)
+        self.memory = MemoryModel()
+        self.budget = MemoryBudget(args.ram_budget) if args.ram_budget else None
+
+        if args.pipeline:
+            self.stage2_pool = asyncio.Semaphore(args.stage2_threads)
+            stage2_budget = args.stage2_ram_budget or args.ram_budget
+            self.stage2_budget = MemoryBudget(stage2_budget) if stage2_budget else None
+            self.save_dir = tempfile.mkdtemp(prefix="ecm_runner_stage1_")
+        # Pipelined curves in (or queued for) stage 2
+        self.in_stage2 = 0
+        self.stage1_finished = asyncio.Event()
+        # Let ecm size stage 2 to what was reserved unless the user set it.
+        self.set_maxmem = bool(self.budget or args.stage2_ram_budget) and not any(
+            arg.strip('-') == 'maxmem' for arg in args.ecm_args)
+
+        # task -> (wu, stage) of started curves
+        self.curves = {}
+        # N that had a factor printed
+        self.factored = set()
+
+        self.total_work = 0
+        self.total_finished = 0
+        # Set by run()
+        self.process_results = None
+
+
+    def _add_work(self, units):
+        self.work.extend(units)
+        self.total_work += len(units)
+        for wu in units:
+            if wu.n not in self.seen:
+                self.seen.add(wu.n)
+                print("New N:", short_repr(wu.n))
+
+
+    def _can_start(self):
+        if self.args.pipeline:
+            # Stage 1 keeps going while residues wait for stage 2.
+            return (len(self.running) - self.in_stage2 < 2 * self.args.threads and
+                    self.in_stage2 < self.args.stage2_threads + self.args.stage2_backlog)
+        return len(self.running) < 2 * self.args.threads
+
+
+    def _refill(self):
+        """Get more work units if queue is empty, returns False when out of work"""
+        if self.work:
+            return True
+
+        if self.add_more:
+            units = get_work_units(
+                self.args, 2 * self.args.threads, self.client, self.batcher.curves())
+            if units:
+                self._add_work(units)
+                print(f"Added {len(units)} work units, finished {self.total_finished}")
+            elif units is not None:
+                self.add_more = False
+                print(f"No work to add: {self.total_finished}/{self.total_work}")
+
+        return bool(self.work)
+
+
+    def _lease_wait(self):
+        """Seconds until more work may be leased, None if not waiting on the work server"""
+        if self.add_more and not self.work and self.client and self.client.lease_wait():
+            return self.client.lease_wait()
+        return None
+
+
+    async def _run_stage(self, wu, pool, budget, stage):
+        """Run wu once a slot in pool and its memory in budget are free"""
+        task = asyncio.current_task()
+        n = self.curves[task][0].n
+
+        def on_line(line):
+            self.memory.observe_line(wu, line)
+            self.curves[task] = (wu, curve_stage(line, self.curves[task][1]))
+            if self.curves[task][1] == "factor" and self.stop_on_factor:
+                self._cancel_siblings(task, n)
+
+        pids = []
+        started = asyncio.Event()
+        def on_start(proc):
+            pids.append(proc.pid)
+            started.set()
+
+        async def watch_memory():
+            """Peak RSS of ecm, sampled as soon as it starts then polled less often"""
+            peak = 0
+            try:
+                await started.wait()
+                delay = 0.05
+                while True:
+                    peak = max(peak, peak_rss_mb(pids[0]))
+                    await asyncio.sleep(delay)
+                    delay = min(1, 2 * delay)
+            except asyncio.CancelledError:
+                return peak
+
+        async with pool:
+            reserved = 0
+            env = self.env
+            journal = self.process_results and self.process_results.journal
+            if budget:
+                reserved = self.memory.estimate(wu)
+                self.curves[task] = (wu, f"{stage} waiting for memory")
+                await budget.acquire(reserved)
+                if self.set_maxmem:
+                    env = dataclasses.replace(
+                        env, extra_params=env.extra_params + ("-maxmem", str(reserved)))
+
+            watcher = asyncio.create_task(watch_memory())
+            try:
+                if journal:
+                    journal.dispatch(wu)
+                self.curves[task] = (wu, stage)
+                t0 = time.time()
+                out = await run_async(wu, env, on_line, on_start)
+                t1 = time.time()
+            finally:
+                watcher.cancel()
+                if reserved:
+                    await budget.release(reserved)
+
+        self.memory.observe(wu, await watcher)
+        return out, t1 - t0
+
+
+    async def _run_one(self, wu):
+        if self.args.pipeline:
+            return await self._run_pipelined(wu)
+
+        out, runtime = await self._run_stage(wu, self.semaphore, self.budget, "stage 1")
+        return wu, process_batch_output(out, runtime)
+
+
+    async def _run_pipelined(self, wu):
+        """Stage 1 (-save) in the stage 1 pool, then -resume in the stage 2 pool."""
+        task = asyncio.current_task()
+        save_fn = os.path.join(self.save_dir, f"{wu.uid}_{id(task)}.save")
+        stage1_wu = dataclasses.replace(wu, B2="1", params=wu.params + ("-save", save_fn))
+
+        out, runtime1 = await self._run_stage(stage1_wu, self.semaphore, self.budget, "stage 1")
+        result1 = process_output(out, runtime1, stage2=False)
+        if result1.factors:
+            return wu, [result1]
+
+        with open(save_fn) as f:
+            resume_line = f.readline()
+        os.remove(save_fn)
+
+        # Waiters on stage2_pool are the queue of residues for stage 2.
+        stage2_wu = dataclasses.replace(wu, resume_line=resume_line)
+        self.curves[task] = (wu, "stage 2 queued")
+        self.in_stage2 += 1
+        self.stage1_finished.set()
+        try:
+            out, runtime2 = await self._run_stage(
+                stage2_wu, self.stage2_pool, self.stage2_budget, "stage 2")
+        finally:
+            self.in_stage2 -= 1
+
+        result = process_output(out, runtime1 + runtime2)
+        result.timings = (result1.timings[0], result.timings[1])
+        return wu, [result]
+
+
+    def _cancel_siblings(self, task, n):
+        """Cancel all other curves on n, as soon as a factor is printed"""
+        if n in self.factored:
+            return
+        self.factored.add(n)
+        # Runner stops once this result is processed, don't fetch more work.
+        self.add_more = False
+
+        siblings = [other for other in self.running
+                    if other is not task and self.curves[other][0].n == n]
+        if siblings:
+            print(f"Factor found for {short_repr(n)}, cancelling {len(siblings)} other curves")
+        for other in siblings:
+            other.cancel()
+
+        queued = len(self.work)
+        self.work = deque(wu for wu in self.work if wu.n != n)
+        self.total_work -= queued - len(self.work)
+
+
+    def print_progress(self):
+        stages = defaultdict(int)
+        for _, stage in self.curves.values():
+            stages[stage] += 1
+        running = ", ".join(f"{count} {stage}" for stage, count in sorted(stages.items()))
+        print(f"Finished {self.total_finished}/{self.total_work}, running: {running} "
+              f"@ {datetime.now().isoformat()}")
+
+
+    async def _cancel_running(self):
+        for task in self.running:
+            task.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+        self.running.clear()
+        self.curves.clear()
+
+
+    async def run(self, process_results):
+        self.process_results = process_results
+        journal = process_results.journal
+        metrics = process_results.metrics
+        if self.args.resume:
+            units = resume_to_work_units(self.args)
+            if journal:
+                units = journal.unfinished(units)
+            self._add_work(units)
+            print(f"Added {len(units)} work units from -resume {self.args.resume}")
+        elif self.env.checkpoint_dir and self.args.N:
+            units = checkpointed_work_units(self.args, self.env)
+            self._add_work(units)
+            if units:
+                print(f"Added {len(units)} work units from checkpoints in {self.env.checkpoint_dir}")
+
+        next_progress = time.monotonic() + self.args.progress_interval
+        try:
+            while True:
+                # Keep a few more tasks than threads so a slot never waits on Python.
+                while self._can_start() and self._refill():
+                    wu = self.work.popleft()
+                    task = asyncio.create_task(self._run_one(wu))
+                    self.curves[task] = (wu, "waiting")
+                    self.running.add(task)
+
+                lease_wait = self._lease_wait()
+                if not self.running and lease_wait is None:
+                    # No new work, all work finished
+                    return
+
+                if metrics:
+                    waiting = sum(stage == "waiting" for _, stage in self.curves.values())
+                    metrics.set_queue(len(self.work) + waiting, len(self.curves) - waiting)
+
+                # Also wake up when a pipelined curve moves on to stage 2.
+                # Or when the work server may be asked for work again.
+                timeout = max(0, next_progress - time.monotonic())
+                if lease_wait is not None:
+                    timeout = min(timeout, lease_wait)
+                wakeup = asyncio.create_task(self.stage1_finished.wait())
+                done, _ = await asyncio.wait(
+                    self.running | {wakeup}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                wakeup.cancel()
+                self.stage1_finished.clear()
+                # On a timer, curves finishing more often than the interval don't hide it
+                if time.monotonic() >= next_progress:
+                    self.print_progress()
+                    next_progress = time.monotonic() + self.args.progress_interval
+                done.discard(wakeup)
+
+                for task in done:
+                    self.running.discard(task)
+                    cancelled_wu, _ = self.curves.pop(task)
+                    if task.cancelled():
+                        # Sibling of a found factor, its checkpoint isn't needed
+                        remove_checkpoint(cancelled_wu, self.env)
+                        self.total_work -= 1
+                        continue
+                    wu, results = task.result()
+                    self.total_finished += 1
+                    self.batcher.observe(results)
+                    for result in results:
+                        process_results.process(wu, result)
+                    process_results.finished(wu)
+                    remove_checkpoint(wu, self.env)
+
+                    if any(result.factors for result in results) and self.stop_on_factor:
+                        return
+        finally:
+            try:
+                await self._cancel_running()
+            finally:
+                if self.args.pipeline:
+                    shutil.rmtree(self.save_dir, ignore_errors=True)
+
+
+def async_main_loop(args):
+    runner = AsyncRunner(args)
+
+    log_name = get_log_fn(args)
+    journal = Journal(get_journal_fn(log_name)) if args.resume else None
+    metrics, reporter = get_metrics(args)
+    process_results = ProcessResults(log_name, runner.client, upload_batch=args.threads,
+                                     journal=journal, log_format=args.log_format,
+                                     metrics=metrics)
+    try:
+        asyncio.run(runner.run(process_results))
+    except KeyboardInterrupt:
+        print("Interrupted, running curves were killed")
+    finally:
+        process_results.close()
+        if reporter:
+            reporter.close()
+
 
 if __name__ == "__main__":
     parser = get_argparser()
@@ -498,4 +1781,7 @@ if __name__ == "__main__":
     validate_args(args)
     print("Args:", args)
 
-    main_loop(args)
+    if args.asyncio:
+        async_main_loop(args)
+    else:
+        main_loop(args)
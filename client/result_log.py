@@ -0,0 +1,271 @@
+"""Compact binary ecm_runner result log (.rlog).
+
+    file    := MAGIC block*
+    block   := BLOCK_HEADER(payload length, record count) zlib(payload)
+    payload := u32 length, NUL separated strings,
+               RECORD * count,
+               i32 factor string index * (sum of record factor counts)
+
+String fields of a RECORD index the block's string table (-1 is None), so
+repeated strings (N, version, using, params) are stored once per block and
+every block decodes on its own. Full ecm output is only kept for curves
+that found a factor.
+
+Only uses the standard library so ecm_runner.py stays a copy-and-run client.
+"""
+
+import collections
+import json
+import os
+import struct
+import zlib
+
+
+MAGIC = b"ECMRLOG\x01"
+BLOCK_HEADER = struct.Struct("<II")
+STRINGS_HEADER = struct.Struct("<I")
+# uid, 11 strings, curves, exit_status, step1_ms, step2_ms, runtime, factor count
+RECORD = struct.Struct("<q11iHhIIdH")
+FACTOR = struct.Struct("<i")
+
+RECORD_FIELDS = (
+    "uid", "n", "params", "B1", "B2", "wu_resume_line", "input_number",
+    "using", "version", "sigma", "resume_line", "output",
+    "curves", "exit_status", "step1_ms", "step2_ms", "runtime", "factors")
+
+Record = collections.namedtuple("Record", RECORD_FIELDS)
+
+
+class _Block:
+    """Records being collected for the next block."""
+
+    def __init__(self):
+        self.strings = {}
+        self.records = []
+        self.factors = []
+
+
+    def intern(self, s):
+        if s is None:
+            return -1
+        index = self.strings.get(s)
+        if index is None:
+            assert "\0" not in s, s
+            index = self.strings[s] = len(self.strings)
+        return index
+
+
+    def payload(self):
+        strings = "\0".join(self.strings).encode()
+        return b"".join([
+            STRINGS_HEADER.pack(len(strings)),
+            strings,
+            b"".join(RECORD.pack(*record) for record in self.records),
+            b"".join(FACTOR.pack(f) for f in self.factors),
+        ])
+
+
+def valid_length(fn):
+    """Bytes of fn made of complete blocks (0 if fn isn't a result log)"""
+    with open(fn, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return 0
+        end = len(MAGIC)
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return end
+            length, _ = BLOCK_HEADER.unpack(header)
+            if len(f.read(length)) < length:
+                return end
+            end += BLOCK_HEADER.size + length
+
+
+class ResultLogWriter:
+    """Appends (WorkUnit, EcmOutput) records to a .rlog file in compressed blocks."""
+
+    def __init__(self, fn, block_records=4096, level=6):
+        self.block_records = block_records
+        self.level = level
+        self.block = _Block()
+
+        if os.path.exists(fn) and os.path.getsize(fn):
+            # Continue an existing log, dropping a block cut short by a crash.
+            end = valid_length(fn)
+            assert end, f"{fn!r} isn't a result log"
+            self.f = open(fn, "r+b")
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.f = open(fn, "wb")
+            self.f.write(MAGIC)
+
+
+    def write(self, wu, result):
+        block = self.block
+        intern = block.intern
+        factors = [str(f) for f in result.factors]
+        match_start = result.output.find("Input number is ")
+        input_number = None
+        if match_start >= 0:
+            input_number = result.output[match_start:].split(" ", 4)[3]
+
+        block.records.append((
+            wu.uid,
+            intern(wu.n),
+            intern(json.dumps(list(wu.params))),
+            intern(wu.B1),
+            intern(wu.B2),
+            intern(wu.resume_line),
+            intern(input_number),
+            intern(result.using),
+            intern(result.version),
+            intern(result.sigma),
+            intern(result.resume_line),
+            # Only output of interesting curves is kept
+            intern(result.output if factors else None),
+            wu.curves,
+            result.exit_status,
+            result.timings[0],
+            result.timings[1],
+            result.runtime,
+            len(factors),
+        ))
+        block.factors.extend(intern(f) for f in factors)
+
+        if len(block.records) >= self.block_records:
+            self.write_block()
+
+
+    def write_block(self):
+        if not self.block.records:
+            return
+        data = zlib.compress(self.block.payload(), self.level)
+        self.f.write(BLOCK_HEADER.pack(len(data), len(self.block.records)))
+        self.f.write(data)
+        self.block = _Block()
+
+
+    def flush(self):
+        """Write buffered records (as a short block) and flush to the OS."""
+        self.write_block()
+        self.f.flush()
+
+
+    def fileno(self):
+        return self.f.fileno()
+
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def decode_block(data, count):
+    """(strings, raw record tuples, factor indexes) of one block"""
+    payload = zlib.decompress(data)
+    (length,) = STRINGS_HEADER.unpack_from(payload)
+    start = STRINGS_HEADER.size
+    strings = payload[start:start + length].decode().split("\0")
+    # -1 (None) indexes the last entry
+    strings.append(None)
+
+    start += length
+    end = start + RECORD.size * count
+    rows = list(RECORD.iter_unpack(payload[start:end]))
+    factors = [f for (f,) in FACTOR.iter_unpack(payload[end:])]
+    return strings, rows, factors
+
+
+def read_raw_blocks(fn, offset=0):
+    """Yields (end offset, strings, rows, factors) for each complete block after offset.
+
+    rows are RECORD tuples with string indexes, the fastest way to scan
+    numeric fields (timings, runtime) of many records.
+    """
+    with open(fn, "rb") as f:
+        if offset < len(MAGIC):
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{fn!r} isn't a result log")
+            offset = len(MAGIC)
+        f.seek(offset)
+
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            length, count = BLOCK_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Block still being written
+                return
+            offset += BLOCK_HEADER.size + length
+            yield (offset, *decode_block(data, count))
+
+
+def read_blocks(fn, offset=0):
+    """Yields (end offset, [Record, ...]) for each complete block after offset."""
+    make = tuple.__new__
+    for end, s, rows, factors in read_raw_blocks(fn, offset):
+        records = []
+        f = 0
+        for (uid, n, params, B1, B2, wu_resume, input_number, using, version, sigma,
+             resume, output, curves, exit_status, step1_ms, step2_ms, runtime, count) in rows:
+            found = ()
+            if count:
+                found = tuple(int(s[j]) for j in factors[f:f + count])
+                f += count
+            records.append(make(Record, (
+                uid, s[n], s[params], s[B1], s[B2], s[wu_resume], s[input_number],
+                s[using], s[version], s[sigma], s[resume], s[output],
+                curves, exit_status, step1_ms, step2_ms, runtime, found)))
+        yield end, records
+
+
+def iter_records(fn):
+    for _, records in read_blocks(fn):
+        yield from records
+
+
+def to_json(record):
+    """(wu, result) dicts as in ecm_runner's .json.log for a Record.
+
+    When output wasn't kept the header lines ecm printed are rebuilt so
+    parsers looking for "Input number is" still work.
+    """
+    output = record.output
+    if output is None:
+        lines = [record.version]
+        if record.input_number:
+            n = record.input_number
+            lines.append(f"Input number is {n} ({len(n)} digits)")
+        lines.append(record.using)
+        output = "\n".join(lines)
+
+    wu = {
+        "uid": record.uid,
+        "n": record.n,
+        "params": json.loads(record.params),
+        "B1": record.B1,
+        "B2": record.B2,
+        "resume_line": record.wu_resume_line,
+        "curves": record.curves,
+    }
+    result = {
+        "factors": list(record.factors),
+        "exit_status": record.exit_status,
+        "resume_line": record.resume_line,
+        "using": record.using,
+        "version": record.version,
+        "output": output,
+        "timings": [record.step1_ms, record.step2_ms],
+        "runtime": record.runtime,
+        "sigma": record.sigma,
+    }
+    return wu, result
+
+
+def read_json_blocks(fn, offset=0):
+    """read_blocks with records as (wu, result) dicts, for EcmServer.import_result_blocks"""
+    for end, records in read_blocks(fn, offset):
+        yield end, [to_json(record) for record in records]
@@ -1,9 +1,16 @@
+import collections
+import concurrent.futures
 import contextlib
 import datetime
+import hashlib
+import json
 import logging
 import numbers
 import os
+import pathlib
+import queue
 import re
+import threading
 import time
 
 from enum import Enum
@@ -11,6 +18,103 @@ from enum import Enum
 import gmpy2
 import sqlite3
 
+from client import ecm_output
+
+
+# ecm prints the input as given, an expression stays an expression
+RE_INPUT_NUMBER = re.compile(r"^Input number is (\S+) \(", re.MULTILINE)
+RE_USING_SIGMA = re.compile(r"\bsigma=(?:([0-9]+):)?([0-9]+)")
+# All "KEY=value;" fields of a resume line in one pass.
+RE_RESUME_FIELDS = re.compile(r"([A-Z][A-Z0-9]*)=([^;]*);")
+
+RESUME_METHODS = {"ECM": 1, "P-1": 2, "P+1": 3}
+RESUME_METHOD_NAMES = {value: name for name, value in RESUME_METHODS.items()}
+
+
+class _LRUCache:
+    """Bounded mapping that evicts the least recently used key, thread safe."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _GroupWriter(threading.Thread):
+    """Runs writes from many threads on the single writer connection.
+
+    Writes queued while a transaction is running are committed together in
+    the next one, so concurrent writers share the cost of a commit.
+    """
+
+    # Most writes committed by one transaction.
+    MAX_GROUP = 256
+
+    def __init__(self, server):
+        super().__init__(name="EcmServer writer", daemon=True)
+        self.server = server
+        self.queue = queue.Queue()
+        self.writes = 0
+        self.commits = 0
+
+
+    def submit(self, fn, *args):
+        """fn(cur, *args)'s result once committed, or its exception"""
+        if not self.is_alive():
+            raise RuntimeError("EcmServer is closed")
+        future = concurrent.futures.Future()
+        self.queue.put((fn, args, future))
+        return future.result()
+
+
+    def run(self):
+        while True:
+            group = [self.queue.get()]
+            while len(group) < _GroupWriter.MAX_GROUP:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [write for write in group if write is not None]
+            if writes:
+                self.server._commit_group(writes)
+                self.writes += len(writes)
+                self.commits += 1
+            if len(writes) < len(group):
+                return
+
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
 class EcmServer:
     """ECM Server
 
@@ -26,9 +130,62 @@ class EcmServer:
         CF = 4
         C = 5
 
-    def __init__(self, db_file="./ecm-server.db"):
+    class Method(Enum):
+        ECM = 1
+        PM1 = 2
+        PP1 = 3
+
+    class WorkState(Enum):
+        QUEUED = 1
+        LEASED = 2
+        DONE = 3
+
+    # Optional keys for record_curves and their defaults.
+    # stage1_chkpnt is the residue X (int, hex "0x..." or decimal str, or bytes).
+    # factors found by the curve are added to the factor tree.
+    CURVE_DEFAULTS = {
+        "curve_id": None,
+        "stage1_chkpnt": None,
+        "maxmem": 0,
+        "stage1_ms": 0,
+        "stage2_ms": 0,
+        "method": Method.ECM.value,
+        "param": None,
+        "sigma": None,
+        "timestamp": None,
+        "factors": (),
+    }
+
+    # Maximum number of n -> num_id entries kept in memory.
+    NUM_ID_CACHE_SIZE = 100000
+    # Maximum number of digest -> status entries kept in memory.
+    STATUS_CACHE_SIZE = 100000
+    # Numbers with more digits are classified in a process pool.
+    PARALLEL_CLASSIFY_DIGITS = 1000
+
+    def __init__(self, db_file="./ecm-server.db", check_same_thread=True, readers=0):
+        """readers > 0 makes the server safe to use from many threads.
+
+        Reads (cursor(), find_number, stats, ...) then use a pool of readers
+        read only WAL connections and writes are group committed on one
+        writer connection by a background thread.
+        """
         self._db_file = db_file
         self._db = None
+        # False allows use from other threads, caller must serialize access.
+        self._check_same_thread = check_same_thread and not readers
+        self._num_readers = readers
+        self._readers = None
+        self._writer = None
+        # Held while the writer connection is in a transaction.
+        self._write_lock = threading.RLock()
+
+        # Only holds num_ids visible to the writer connection, cleared on rollback.
+        self._num_ids = _LRUCache(EcmServer.NUM_ID_CACHE_SIZE)
+        # num_ids read by the read pool, always committed.
+        self._read_num_ids = _LRUCache(EcmServer.NUM_ID_CACHE_SIZE)
+        # PRP results by digest, survives rollbacks so a retry doesn't retest.
+        self._statuses = _LRUCache(EcmServer.STATUS_CACHE_SIZE)
 
         self.init_db()
 
@@ -36,68 +193,797 @@ class EcmServer:
     def init_db(self):
         exists = os.path.isfile(self._db_file) and os.path.getsize(self._db_file) > 0
 
-        self._db = sqlite3.connect(self._db_file)
+        self._db = sqlite3.connect(self._db_file, check_same_thread=self._check_same_thread)
         # Makes returns namedtuple like
         self._db.row_factory = sqlite3.Row
 
         # Turn on foreign_key constraints
         self._db.execute("PRAGMA foreign_keys = 1")
 
+        # WAL lets readers continue during ingest and with synchronous=NORMAL
+        # only checkpoints (not every commit) wait on fsync.
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+
         if not exists:
             schema_path = os.path.join(os.path.dirname(__file__), EcmServer.SCHEMA_FILE)
             logging.warning(f"Creating db({self._db_file}) from {schema_path}")
             with open(schema_path) as schema_f:
                 schema = schema_f.read()
-                with self.cursor() as cur:
+                with contextlib.closing(self._get_cursor()) as cur:
                     cur.executescript(schema)
 
+        if self._num_readers:
+            uri = pathlib.Path(self._db_file).absolute().as_uri() + "?mode=ro"
+            self._readers = queue.Queue()
+            for _ in range(self._num_readers):
+                reader = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                reader.row_factory = sqlite3.Row
+                self._readers.put(reader)
+
+            self._writer = _GroupWriter(self)
+            self._writer.start()
+
+
+    def close(self):
+        """Finish queued writes and close all connections"""
+        if self._writer:
+            self._writer.close()
+            while not self._readers.empty():
+                self._readers.get().close()
+        self._db.close()
+
 
     def _get_cursor(self):
         # TODO: closing cursor one day.
         return self._db.cursor()
 
 
+    @contextlib.contextmanager
     def cursor(self):
-        return contextlib.closing(self._get_cursor())
+        """Cursor for reads, from the read only pool if the server has readers."""
+        if self._readers is None:
+            with contextlib.closing(self._get_cursor()) as cur:
+                yield cur
+            return
+
+        reader = self._readers.get()
+        try:
+            with contextlib.closing(reader.cursor()) as cur:
+                yield cur
+        finally:
+            self._readers.put(reader)
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Cursor whose statements are committed together (or rolled back on error)."""
+        with self._write_lock:
+            try:
+                with self._db:
+                    with contextlib.closing(self._get_cursor()) as cur:
+                        yield cur
+            except:
+                # Cached num_ids may refer to rows that were just rolled back.
+                self._num_ids.clear()
+                raise
+
+
+    def _write(self, fn, *args):
+        """fn(cur, *args) in a transaction, group committed if the server has readers."""
+        if self._writer is None:
+            with self.transaction() as cur:
+                return fn(cur, *args)
+        return self._writer.submit(fn, *args)
+
+
+    def _commit_group(self, writes):
+        """Run [(fn, args, future), ...] in one transaction, each in a savepoint.
+
+        A write that raises is rolled back on its own, the rest still commit.
+        Futures are resolved only after the commit.
+        """
+        done = []
+        with self._write_lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                with contextlib.closing(self._get_cursor()) as cur:
+                    for fn, args, future in writes:
+                        cur.execute("SAVEPOINT write")
+                        try:
+                            done.append((future, fn(cur, *args), None))
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO write")
+                            self._num_ids.clear()
+                            done.append((future, None, e))
+                        cur.execute("RELEASE write")
+                self._db.commit()
+            except Exception as e:
+                self._db.rollback()
+                self._num_ids.clear()
+                for _, _, future in writes:
+                    future.set_exception(e)
+                return
+
+        for future, result, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
 
 
     def find_number(self, n):
         """Find record for number if it's part of the database"""
         # TODO allow lookup by numid?
+        n = EcmServer._parse_number(n)
         with self.cursor() as cur:
-            cur.execute('SELECT * from numbers where n = ?', (n,))
-            records = cur.fetchall()
+            num_id = self._find_num_id(cur, n)
+            if num_id is None:
+                return None
+            cur.execute('SELECT * from numbers where num_id = ?', (num_id,))
+            return cur.fetchone()
 
-        if len(records) == 0:
+
+    def _find_num_id(self, cur, n):
+        """num_id for int n or None, uses the LRU cache of cur's connection."""
+        cache = self._num_ids if cur.connection is self._db else self._read_num_ids
+        key = str(n)
+        num_id = cache.get(key)
+        if num_id is not None:
+            return num_id
+
+        cur.execute('SELECT num_id, n from numbers where n_digest = ?',
+                    (EcmServer._digest(key),))
+        record = cur.fetchone()
+        if record is None:
             return None
-        elif len(records) >= 2:
-            raise ValueError(f"Duplicate records for {n}")
-        return records[0]
+        if record['n'] != key:
+            raise ValueError(f"Digest collision for {n} and {record['n']}")
+
+        cache.put(key, record['num_id'])
+        return record['num_id']
 
 
     def add_number(self, expr):
         """Add a number to the database"""
+        return self.add_numbers([expr])[0]
 
-        if EcmServer._is_number(expr):
-            n = int(expr)
+
+    def add_numbers(self, exprs, processes=None):
+        """Add many numbers to the database in one transaction.
+
+        Large new numbers are classified (PRP or composite) in a pool of
+        processes workers (default: cpu count) before the transaction.
+
+        Returns the record for each expr (in order), existing or new.
+        """
+        ns = [EcmServer._parse_number(expr) for expr in exprs]
+
+        statuses = self._classify_new(ns, processes)
+        self._write(self._add_numbers, ns, statuses)
+
+        return [self.find_number(n) for n in ns]
+
+
+    def _add_numbers(self, cur, ns, statuses=None):
+        """Insert any of ns that aren't in the database, doesn't commit.
+
+        statuses is {digest: status} from _classify_new, anything missing
+        is classified inline.
+        """
+        statuses = statuses or {}
+        rows = []
+        for n in dict.fromkeys(ns):
+            if self._find_num_id(cur, n) is not None:
+                continue
+
+            digest = EcmServer._digest(n)
+            status = statuses.get(digest) or self._statuses.get(digest)
+            if status is None:
+                status = EcmServer._classify(n)
+                self._statuses.put(digest, status)
+            rows.append((str(n), digest, status))
+
+        cur.executemany('INSERT INTO numbers (n, n_digest, status) VALUES (?,?,?)', rows)
+        return len(rows)
+
+
+    def _classify_new(self, ns, processes=None):
+        """Status of each n not already in the database, {digest: status}.
+
+        Uses the status cache, large numbers are classified here (in a process
+        pool if there are several) so writes never wait on them.
+        """
+        with self.cursor() as cur:
+            new = [n for n in dict.fromkeys(ns) if self._find_num_id(cur, n) is None]
+
+        statuses = {}
+        large = []
+        for n in new:
+            digest = EcmServer._digest(n)
+            status = self._statuses.get(digest)
+            if status is not None:
+                statuses[digest] = status
+            elif gmpy2.num_digits(n) > EcmServer.PARALLEL_CLASSIFY_DIGITS:
+                large.append((digest, n))
+
+        if len(large) >= 2 and processes != 1:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                results = list(pool.map(EcmServer._classify, [n for _, n in large]))
         else:
-            raise ValueError(f"Bad expr: {expr}")
+            results = [EcmServer._classify(n) for _, n in large]
+        for (digest, _), status in zip(large, results):
+            statuses[digest] = status
+            self._statuses.put(digest, status)
+
+        return statuses
+
+
+    def _found_children(self, curves):
+        """Factor and cofactor of each factor curves found, to classify before a write."""
+        children = []
+        with self.cursor() as cur:
+            for curve in curves:
+                if not curve.get("factors"):
+                    continue
+                if curve.get("n") is not None:
+                    n = EcmServer._parse_number(curve["n"])
+                else:
+                    cur.execute('SELECT n from numbers where num_id = ?', (curve["num_id"],))
+                    record = cur.fetchone()
+                    if not record:
+                        continue
+                    n = int(record['n'])
+                for f in map(int, curve["factors"]):
+                    if 1 < f < n and n % f == 0:
+                        children.extend((f, n // f))
+        return children
+
+
+    def record_curves(self, curves):
+        """Record many curves in one transaction.
+
+        Each curve is a mapping with "num_id" (or "n" of a number already in
+        the database), "B1", "B2" and optionally any of CURVE_DEFAULTS.
+        curve_id is assigned per number if not given. "factors" found by
+        a curve split its number as in record_factors.
+
+        Returns the number of curves recorded.
+        """
+        statuses = self._classify_new(self._found_children(curves))
+        return self._write(self._record_curves, curves, statuses)
+
+
+    def _record_curves(self, cur, curves, statuses=None):
+        """Insert curves, doesn't commit.
+
+        A curve with the number, method, B1 and sigma of a stored curve is
+        the same curve seen again. Stage 2 results (a larger B2) complete
+        the stored curve in place, e.g. a stage 1 curve imported from a
+        resume file. Anything else is a duplicate that at most adds a
+        missing residue.
+
+        statuses is {digest: status} of new factors, see _add_numbers.
+
+        Returns the number of curves inserted or completed.
+        """
+        now = int(time.time())
+        next_curve_id = {}
+
+        rows = []
+        for curve in curves:
+            row = dict(EcmServer.CURVE_DEFAULTS)
+            row.update(curve)
+
+            num_id = row.get("num_id")
+            if num_id is None:
+                n = EcmServer._parse_number(row["n"])
+                num_id = row["num_id"] = self._find_num_id(cur, n)
+                if num_id is None:
+                    raise ValueError(f"Unknown number: {n}")
+
+            if row["timestamp"] is None:
+                row["timestamp"] = now
+
+            if isinstance(row["method"], EcmServer.Method):
+                row["method"] = row["method"].value
+
+            row["stored"] = False
+            rows.append(row)
+
+        with_residue = [row for row in rows if row["stage1_chkpnt"] is not None]
+        residue_ids = self._add_residues(cur, [row["stage1_chkpnt"] for row in with_residue])
+        for row in rows:
+            row["residue_id"] = None
+        for row, residue_id in zip(with_residue, residue_ids):
+            row["residue_id"] = residue_id
+
+        new_rows = []
+        # (num_id, method, B1, sigma) -> curve inserted or loaded by this call
+        matches = {}
+        # (num_id, curve_id) -> (stored curve, its (B2, stage1_ms, stage2_ms) before changes)
+        changed = {}
+        completed = 0
+        for row in rows:
+            key = (row["num_id"], row["method"], row["B1"], row["sigma"])
+            stored = None
+            if row["sigma"] is not None:
+                stored = matches.get(key) or self._stored_curve(cur, key)
+            if stored is not None and None not in (stored["param"], row["param"]) and (
+                    stored["param"] != row["param"]):
+                # Same sigma with another parametrization is another curve
+                stored = None
+
+            if stored is None:
+                new_rows.append(row)
+                if row["sigma"] is not None:
+                    matches[key] = row
+                continue
+
+            matches[key] = stored
+            stage2 = row["B2"] > stored["B2"]
+            residue = stored["residue_id"] is None and row["residue_id"] is not None
+            if not (stage2 or residue):
+                # Duplicate
+                continue
+            if stored["stored"]:
+                changed.setdefault((stored["num_id"], stored["curve_id"]), (
+                    stored, (stored["B2"], stored["stage1_ms"], stored["stage2_ms"])))
+            if stage2:
+                # Stage 2 of a stored stage 1 curve
+                stored["B2"] = row["B2"]
+                stored["stage1_ms"] += row["stage1_ms"]
+                stored["stage2_ms"] += row["stage2_ms"]
+                completed += stored["stored"]
+            if residue:
+                stored["residue_id"] = row["residue_id"]
+
+        for row in new_rows:
+            num_id = row["num_id"]
+            if row["curve_id"] is None:
+                if num_id not in next_curve_id:
+                    cur.execute('SELECT MAX(curve_id) from ecm_curves where num_id = ?',
+                                (num_id,))
+                    last = cur.fetchone()[0]
+                    next_curve_id[num_id] = 0 if last is None else last + 1
+                row["curve_id"] = next_curve_id[num_id]
+                next_curve_id[num_id] += 1
+
+        cur.executemany(
+            'INSERT INTO ecm_curves '
+            '(num_id, curve_id, B1, B2, residue_id, maxmem, stage1_ms, stage2_ms, '
+            ' method, param, sigma, timestamp) '
+            'VALUES (:num_id, :curve_id, :B1, :B2, :residue_id, :maxmem, '
+            ':stage1_ms, :stage2_ms, :method, :param, :sigma, :timestamp)',
+            new_rows)
+        cur.executemany(
+            'UPDATE ecm_curves SET B2 = :B2, residue_id = :residue_id, '
+            '  stage1_ms = :stage1_ms, stage2_ms = :stage2_ms '
+            'where num_id = :num_id and curve_id = :curve_id',
+            [stored for stored, _ in changed.values()])
+
+        effort = collections.defaultdict(lambda: [0, 0, 0])
+        for row in new_rows:
+            group = effort[(row["num_id"], row["method"], row["B1"], row["B2"])]
+            group[0] += 1
+            group[1] += row["stage1_ms"]
+            group[2] += row["stage2_ms"]
+        for stored, (B2, stage1_ms, stage2_ms) in changed.values():
+            # Move the curve to its new (num_id, method, B1, B2) group
+            group = effort[(stored["num_id"], stored["method"], stored["B1"], B2)]
+            group[0] -= 1
+            group[1] -= stage1_ms
+            group[2] -= stage2_ms
+            group = effort[(stored["num_id"], stored["method"], stored["B1"], stored["B2"])]
+            group[0] += 1
+            group[1] += stored["stage1_ms"]
+            group[2] += stored["stage2_ms"]
+
+        cur.executemany(
+            'INSERT INTO ecm_effort VALUES (?,?,?,?,?,?,?) '
+            'ON CONFLICT (num_id, method, B1, B2) DO UPDATE SET '
+            '  curves = curves + excluded.curves, '
+            '  stage1_ms = stage1_ms + excluded.stage1_ms, '
+            '  stage2_ms = stage2_ms + excluded.stage2_ms',
+            [key + tuple(totals) for key, totals in effort.items() if any(totals)])
+        cur.executemany(
+            'DELETE FROM ecm_effort where num_id = ? and method = ? and B1 = ? and B2 = ? '
+            'and curves <= 0',
+            [key for key, totals in effort.items() if totals[0] < 0])
+
+        found = [(row["num_id"], f) for row in rows for f in row["factors"]]
+        if found:
+            self._record_factors(cur, found, statuses)
+
+        return len(new_rows) + completed
+
+
+    def _stored_curve(self, cur, key):
+        """Stored ecm_curves row for (num_id, method, B1, sigma) as a dict, or None"""
+        num_id, method, B1, sigma = key
+        cur.execute(
+            'SELECT num_id, curve_id, method, B1, B2, residue_id, stage1_ms, stage2_ms, param '
+            'from ecm_curves where num_id = ? and sigma = ? and B1 = ? and method = ? LIMIT 1',
+            (num_id, sigma, B1, method))
+        record = cur.fetchone()
+        return dict(record, stored=True) if record else None
+
+
+    def record_factor(self, expr, factor):
+        """Record that factor divides number, see record_factors."""
+        return self.record_factors([(expr, factor)])
+
+
+    def record_factors(self, pairs):
+        """Record (number, factor) pairs in one transaction.
+
+        Each number is split into factor and cofactor (added and classified
+        like add_numbers), or if it was split before, the composite factor
+        of it that factor divides. Returns the number of new splits.
+        """
+        pairs = [(EcmServer._parse_number(expr), EcmServer._parse_number(factor))
+                 for expr, factor in pairs]
+        for n, f in pairs:
+            if f <= 1 or n % f:
+                raise ValueError(f"{f} isn't a factor of {n}")
+        ns = [n for n, _ in pairs]
+        # Usually the new numbers, classified before the transaction
+        children = [x for n, f in pairs if f < n for x in (f, n // f)]
+        statuses = self._classify_new(ns + children)
+
+        def write(cur):
+            self._add_numbers(cur, ns, statuses)
+            return self._record_factors(
+                cur, [(self._find_num_id(cur, n), f) for n, f in pairs], statuses)
+
+        return self._write(write)
+
+
+    def _record_factors(self, cur, found, statuses=None):
+        """Split numbers by (num_id, factor) pairs in the factor tree, doesn't commit.
+
+        Adds factor and cofactor, the factors rows, the number_lineage
+        closure (every ancestor above every descendant), marks the split
+        number CF and any ancestor without a composite leaf left FF.
+        """
+        C = EcmServer.Status.C.value
+        splits = 0
+        for num_id, factor in found:
+            cur.execute('SELECT n from numbers where num_id = ?', (num_id,))
+            n = int(cur.fetchone()['n'])
+            factor = int(factor)
+            if factor in (1, n):
+                # ecm found the whole input number
+                continue
+            if factor < 1 or n % factor:
+                logging.warning(f"Skipping {factor}, not a factor of {n}")
+                continue
+
+            target_id, target = num_id, n
+            if not self._is_leaf(cur, num_id):
+                # Split the composite leaf of n's tree that factor divides
+                cur.execute(
+                    'SELECT num_id, n from number_lineage JOIN numbers ON num_id = descendant '
+                    'where ancestor = ? and status = ?', (num_id, C))
+                leaves = [(record['num_id'], int(record['n'])) for record in cur.fetchall()]
+                leaves = [(i, d) for i, d in leaves if d % factor == 0 and d != factor]
+                if not leaves:
+                    # Nothing new
+                    continue
+                target_id, target = leaves[0]
+
+            children = [factor, target // factor]
+            self._add_numbers(cur, children, statuses)
+            child_ids = sorted({self._find_num_id(cur, child) for child in children})
+
+            cur.executemany('INSERT OR IGNORE INTO factors VALUES (?, ?)',
+                            [(target_id, child_id) for child_id in child_ids])
+            cur.executemany(
+                'INSERT OR IGNORE INTO number_lineage '
+                'SELECT a.ancestor, d.descendant from '
+                '  (SELECT ancestor from number_lineage where descendant = :parent '
+                '   UNION SELECT :parent) as a, '
+                '  (SELECT descendant from number_lineage where ancestor = :child '
+                '   UNION SELECT :child) as d',
+                [{"parent": target_id, "child": child_id} for child_id in child_ids])
+
+            cur.execute('UPDATE numbers SET status = ? where num_id = ? and status = ?',
+                        (EcmServer.Status.CF.value, target_id, C))
+            cur.execute(
+                'UPDATE numbers SET status = :FF where status = :CF and num_id in '
+                '  (SELECT ancestor from number_lineage where descendant = :id UNION SELECT :id) '
+                'and not exists (SELECT 1 from number_lineage JOIN numbers as d '
+                '  ON d.num_id = descendant where ancestor = numbers.num_id and d.status = :C)',
+                {"FF": EcmServer.Status.FF.value, "CF": EcmServer.Status.CF.value,
+                 "id": target_id, "C": C})
+            splits += 1
 
-        record = self.find_number(n)
-        if record:
-            return record
+        return splits
 
-        status = 2 if gmpy2.is_prime(n) else 5
 
+    def _is_leaf(self, cur, num_id):
+        cur.execute('SELECT 1 from factors where num_id_c = ? LIMIT 1', (num_id,))
+        return cur.fetchone() is None
+
+
+    def fully_factored(self, expr):
+        """True if number is (probably) prime or every leaf of its factor tree is."""
+        number = self.find_number(expr)
+        if not number:
+            return False
+        if number['status'] == EcmServer.Status.C.value:
+            return False
+
+        with self.cursor() as cur:
+            cur.execute(
+                'SELECT NOT EXISTS (SELECT 1 from number_lineage JOIN numbers '
+                '  ON num_id = descendant where ancestor = ? and status = ?)',
+                (number['num_id'], EcmServer.Status.C.value))
+            return bool(cur.fetchone()[0])
+
+
+    def lineage_effort(self, expr):
+        """stats() including effort on every number this one is a factor of.
+
+        Curves run on a number also searched all of its factors, so a
+        cofactor inherits its ancestors' effort.
+        """
+        number = self.find_number(expr)
+        if not number:
+            return []
+
+        with self.cursor() as cur:
+            cur.execute(
+                'SELECT method, B1, B2, sum(curves) as curves, sum(stage1_ms) as stage1_ms, '
+                'sum(stage2_ms) as stage2_ms from ecm_effort where num_id in '
+                '  (SELECT ancestor from number_lineage where descendant = :id UNION SELECT :id) '
+                'GROUP BY method, B1, B2 ORDER BY method, B1, B2',
+                {"id": number['num_id']})
+            return cur.fetchall()
+
+
+    def _add_residues(self, cur, residues):
+        """residue_id for each residue, storing the ones not seen before. Doesn't commit."""
+        data = [EcmServer._residue_bytes(x) for x in residues]
+        digests = [hashlib.blake2b(x, digest_size=16).digest() for x in data]
+        cur.executemany('INSERT OR IGNORE INTO residues (digest, x) VALUES (?, ?)',
+                        zip(digests, data))
+
+        residue_ids = []
+        for digest in digests:
+            cur.execute('SELECT residue_id from residues where digest = ?', (digest,))
+            residue_ids.append(cur.fetchone()[0])
+        return residue_ids
+
+
+    def add_work(self, expr, B1, B2=None, count=1, params=()):
+        """Queue count work units of B1, B2 for number.
+
+        Returns the new wu_ids.
+        """
+        n = EcmServer._parse_number(expr)
+        statuses = self._classify_new([n])
+
+        def write(cur):
+            self._add_numbers(cur, [n], statuses)
+            num_id = self._find_num_id(cur, n)
+            cur.execute('SELECT IFNULL(MAX(wu_id), 0) from work_units')
+            last = cur.fetchone()[0]
+            cur.executemany(
+                'INSERT INTO work_units (num_id, B1, B2, params, state) VALUES (?,?,?,?,?)',
+                [(num_id, int(B1), None if B2 is None else int(B2), json.dumps(list(params)),
+                  EcmServer.WorkState.QUEUED.value)] * count)
+            cur.execute('SELECT wu_id from work_units where wu_id > ? ORDER BY wu_id', (last,))
+            return [row[0] for row in cur.fetchall()]
+
+        return self._write(write)
+
+
+    def lease_work(self, count, owner, lease_seconds):
+        """Lease up to count queued work units to owner.
+
+        Units whose lease has expired are requeued first.
+        Returns rows of (wu_id, n, B1, B2, params, resume_line).
+        """
+        now = int(time.time())
+
+        def write(cur):
+            cur.execute(
+                'UPDATE work_units SET state = ?, lease_owner = NULL, lease_expires = NULL '
+                'where state = ? and lease_expires < ?',
+                (EcmServer.WorkState.QUEUED.value, EcmServer.WorkState.LEASED.value, now))
+            if cur.rowcount > 0:
+                logging.info(f"Requeued {cur.rowcount} expired work units")
+
+            cur.execute(
+                'SELECT wu_id, n, B1, B2, params, resume_line from work_units '
+                'JOIN numbers USING (num_id) where state = ? ORDER BY wu_id LIMIT ?',
+                (EcmServer.WorkState.QUEUED.value, count))
+            records = cur.fetchall()
+
+            cur.executemany(
+                'UPDATE work_units SET state = ?, lease_owner = ?, lease_expires = ? '
+                'where wu_id = ?',
+                [(EcmServer.WorkState.LEASED.value, owner, now + lease_seconds, r['wu_id'])
+                 for r in records])
+            return records
+
+        return self._write(write)
+
+
+    def complete_work(self, results):
+        """Record results of leased work units.
+
+        results are [wu, result] pairs as written by ecm_runner's
+        json_result_format, wu["uid"] is the wu_id. All results are recorded
+        in one transaction. Results of work units already DONE are skipped,
+        so a runner can retry an upload it didn't get an answer for.
+
+        Returns the number of curves recorded.
+        """
+        curves = []
+        for wu, result in results:
+            curves.append((int(wu["uid"]), EcmServer._parse_json_result(wu, result)))
+        wu_ids = sorted({wu_id for wu_id, _ in curves})
+
+        ns = [curve["n"] for _, curve in curves]
+        statuses = self._classify_new(
+            ns + self._found_children([curve for _, curve in curves]))
+
+        def write(cur):
+            done = set()
+            for i in range(0, len(wu_ids), 1000):
+                chunk = wu_ids[i:i+1000]
+                cur.execute(
+                    'SELECT wu_id from work_units '
+                    f'where state = ? and wu_id in ({",".join("?" * len(chunk))})',
+                    [EcmServer.WorkState.DONE.value] + chunk)
+                done.update(row[0] for row in cur.fetchall())
+            if done:
+                logging.info(f"Skipping results of {len(done)} work units already done")
+
+            self._add_numbers(cur, ns, statuses)
+            recorded = self._record_curves(
+                cur, [curve for wu_id, curve in curves if wu_id not in done], statuses)
+            cur.executemany(
+                'UPDATE work_units SET state = ?, lease_owner = NULL, lease_expires = NULL '
+                'where wu_id = ?',
+                [(EcmServer.WorkState.DONE.value, wu_id) for wu_id in wu_ids
+                 if wu_id not in done])
+            return recorded
+
+        return self._write(write)
+
+
+    def work_status(self):
+        """{WorkState name: count} of work units"""
+        with self.cursor() as cur:
+            cur.execute('SELECT state, COUNT(*) from work_units GROUP BY state')
+            counts = dict(cur.fetchall())
+        return {state.name: counts.get(state.value, 0) for state in EcmServer.WorkState}
+
+
+    def import_json_log(self, fn, chunk_size=10000):
+        """Import curves from an ecm_runner .json.log file.
+
+        Only lines after the previous import of fn are read; the byte offset
+        is saved in the same transaction as each chunk of curves so an
+        interrupted or repeated import never double counts. A trailing
+        partial line (log still being written) is left for the next import.
+
+        Returns the number of curves imported (not counting curves already
+        recorded, see record_curves).
+        """
+        def parse(line):
+            wu, result = json.loads(line)
+            return EcmServer._parse_json_result(wu, result)
+
+        return self._import_lines(fn, parse, chunk_size)
+
+
+    def import_resume_file(self, fn, chunk_size=10000):
+        """Import stage 1 curves (and residues) from a GMP-ECM -save file.
+
+        Missing numbers are added, each line becomes an ecm_curves row with
+        B2 = B1 (no stage 2) and a reference to its residue. Streams with
+        the same checkpointing as import_json_log.
+
+        Returns the number of curves imported.
+        """
+        return self._import_lines(fn, EcmServer._parse_resume_line, chunk_size)
+
+
+    def import_result_blocks(self, fn, read_blocks):
+        """Import curves from a block structured log (ecm_runner's .rlog).
+
+        read_blocks(path, offset) yields (end offset, [(wu, result), ...])
+        for each complete block after offset, with wu and result as in a
+        .json.log line. Checkpointed per block like import_json_log.
+
+        Returns the number of curves imported.
+        """
+        path = os.path.abspath(fn)
+        offset = self._import_offset(path)
+
+        imported = 0
+        for end, results in read_blocks(path, offset):
+            try:
+                curves = [EcmServer._parse_json_result(wu, result) for wu, result in results]
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{fn}@{offset}: bad block: {e}") from e
+            imported += self._import_chunk(path, end, curves)
+            offset = end
+
+        return imported
+
+
+    def _import_lines(self, fn, parse, chunk_size):
+        """Record parse(line) for each new complete line of fn in chunks.
+
+        Lines parse can't handle are logged and skipped so one bad line
+        doesn't stop every later import of fn.
+        """
+        path = os.path.abspath(fn)
+        offset = self._import_offset(path)
+
+        imported = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            chunk = []
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+
+                if line.strip():
+                    try:
+                        chunk.append(parse(line))
+                    except (ValueError, KeyError, TypeError) as e:
+                        # Skipped for good, the offset moves past it with the next chunk
+                        logging.warning(f"{fn}@{offset}: skipping bad line: {e!r}")
+                offset += len(line)
+
+                if len(chunk) >= chunk_size:
+                    imported += self._import_chunk(path, offset, chunk)
+                    chunk = []
+
+            imported += self._import_chunk(path, offset, chunk)
+
+        return imported
+
+
+    def _import_offset(self, path):
+        """Byte offset already imported from path"""
         with self.cursor() as cur:
-            cur.execute('INSERT INTO numbers VALUES (null,?,?)', (n, status))
-        self._db.commit()
+            cur.execute('SELECT byte_offset from import_checkpoints where path = ?', (path,))
+            record = cur.fetchone()
+
+        offset = record['byte_offset'] if record else 0
+        if os.path.getsize(path) < offset:
+            logging.warning(f"{path!r} is shorter than last import, importing from start")
+            offset = 0
+        return offset
+
+
+    def _import_chunk(self, path, offset, curves):
+        """Add numbers and record curves, advance path's checkpoint to offset."""
+        ns = [curve["n"] for curve in curves]
+        statuses = self._classify_new(ns + self._found_children(curves))
 
-        return self.find_number(n)
+        def write(cur):
+            self._add_numbers(cur, ns, statuses)
+            recorded = self._record_curves(cur, curves, statuses)
+            cur.execute('INSERT OR REPLACE INTO import_checkpoints VALUES (?, ?)',
+                        (path, offset))
+            return recorded
+
+        return self._write(write)
 
 
     def stats(self, expr):
-        """Statistics about number, ecm progress, factors"""
+        """Statistics about number, ecm progress, factors
+
+        One row per (method, B1, B2) with curve count and total stage times.
+        """
         # TODO look up parents and all that jazz.
 
         # TODO wrapper class
@@ -107,17 +993,224 @@ class EcmServer:
         num_id = number['num_id']
 
         with self.cursor() as cur:
-            cur.execute('SELECT * from ecm_curves where num_id = ?', (num_id,))
+            cur.execute('SELECT * from ecm_effort where num_id = ? ORDER BY method, B1, B2',
+                        (num_id,))
             records = cur.fetchall()
         return records
 
 
+    def effort_groups(self, num_ids, inherited=False):
+        """ECM ecm_effort rows (num_id, B1, B2, curves) for many numbers.
+
+        With inherited, also rows of each number's ancestors (as in
+        lineage_effort) under the number's num_id.
+        """
+        records = []
+        num_ids = list(num_ids)
+        with self.cursor() as cur:
+            for i in range(0, len(num_ids), 1000):
+                chunk = num_ids[i:i+1000]
+                marks = ",".join("?" * len(chunk))
+                cur.execute(
+                    'SELECT num_id, B1, B2, curves from ecm_effort '
+                    f'where method = ? and num_id in ({marks})',
+                    [EcmServer.Method.ECM.value] + chunk)
+                records.extend(cur.fetchall())
+                if inherited:
+                    cur.execute(
+                        'SELECT descendant as num_id, B1, B2, curves from number_lineage '
+                        'JOIN ecm_effort ON num_id = ancestor '
+                        f'where method = ? and descendant in ({marks})',
+                        [EcmServer.Method.ECM.value] + chunk)
+                    records.extend(cur.fetchall())
+        return records
+
+
+    def stage2_timings(self):
+        """ECM stage 2 time per (digits, B1, B2) over all numbers.
+
+        Rows of (digits, B1, B2, curves, stage2_ms), read from the ecm_effort
+        summary so it's one pass over groups not curves.
+        """
+        with self.cursor() as cur:
+            cur.execute(
+                'SELECT length(n) as digits, B1, B2, sum(curves) as curves, '
+                'sum(stage2_ms) as stage2_ms '
+                'from ecm_effort join numbers using (num_id) '
+                'where method = ? and stage2_ms > 0 '
+                'GROUP BY digits, B1, B2 ORDER BY digits, B1, B2',
+                (EcmServer.Method.ECM.value,))
+            return cur.fetchall()
+
+
+    def iter_curves(self, expr, batch_size=1000):
+        """Yields every ecm_curves row for number without loading them all."""
+        number = self.find_number(expr)
+        if not number:
+            return
+
+        with self.cursor() as cur:
+            cur.execute('SELECT * from ecm_curves where num_id = ?', (number['num_id'],))
+            while True:
+                records = cur.fetchmany(batch_size)
+                if not records:
+                    break
+                yield from records
+
+
+    def iter_resume_lines(self, expr=None, B1=None, stage2_done=False, batch_size=1000):
+        """Yields GMP-ECM resume lines for stored stage 1 residues.
+
+        Selects curves of number expr (default all) with stage 1 bound B1
+        (default any), and only curves without stage 2 unless stage2_done.
+        Lines carry METHOD, PARAM, SIGMA, B1, N and X, enough for
+        `ecm -resume` to run stage 2.
+        """
+        where = []
+        params = []
+        if expr is not None:
+            number = self.find_number(expr)
+            if not number:
+                return
+            where.append('num_id = ?')
+            params.append(number['num_id'])
+        if B1 is not None:
+            where.append('B1 = ?')
+            params.append(int(B1))
+        if not stage2_done:
+            where.append('B2 <= B1')
+
+        with self.cursor() as cur:
+            cur.execute(
+                'SELECT n, method, param, sigma, B1, x from ecm_curves '
+                'JOIN residues USING (residue_id) JOIN numbers USING (num_id) '
+                + ('where ' + ' and '.join(where) if where else '') +
+                ' ORDER BY num_id, curve_id',
+                params)
+            while True:
+                records = cur.fetchmany(batch_size)
+                if not records:
+                    break
+                for record in records:
+                    yield EcmServer._resume_line(record)
+
+
+    def export_resume_file(self, fn, **filters):
+        """Write iter_resume_lines(**filters) to fn, returns the number of lines."""
+        count = 0
+        with open(fn, "w") as f:
+            for line in self.iter_resume_lines(**filters):
+                f.write(line)
+                count += 1
+        return count
+
+
     def _is_number(n):
-        return isinstance(n, numbers.Integral) or re.match("[1-9][0-9]*", n)
+        return isinstance(n, numbers.Integral) or re.fullmatch("[1-9][0-9]*", n)
+
+
+    def _parse_number(expr):
+        if EcmServer._is_number(expr):
+            return int(expr)
+        if EcmServer._is_number_expr(expr):
+            return ecm_output.parse_number(expr)
+        raise ValueError(f"Bad expr: {expr}")
+
+
+    def _parse_json_result(wu, result):
+        """Curve for record_curves from a json_result_format line"""
+        # Prefer the number ecm read, wu['n'] may be missing or out of date.
+        match = RE_INPUT_NUMBER.search(result["output"])
+        n = EcmServer._parse_number(match.group(1) if match else wu["n"])
+
+        match = ecm_output.RE_USING_BOUNDS.search(result["using"])
+        if not match:
+            raise ValueError(f"B1, B2 not found in {result['using']!r}")
+        B1, B2 = map(int, match.groups())
+
+        param = sigma = None
+        match = RE_USING_SIGMA.search(result["using"])
+        if match:
+            param = int(match.group(1)) if match.group(1) else None
+            sigma = match.group(2)
+
+        stage1_ms, stage2_ms = result["timings"]
+        return {
+            "n": n,
+            "B1": B1,
+            "B2": B2,
+            "stage1_ms": stage1_ms,
+            "stage2_ms": stage2_ms,
+            "param": param,
+            "sigma": sigma,
+            "factors": [int(f) for f in result.get("factors", ())],
+        }
+
+
+    def _parse_resume_line(line):
+        """Curve for record_curves from a GMP-ECM resume line"""
+        fields = dict(RE_RESUME_FIELDS.findall(line.decode()))
+
+        # Decimal, hex or the input expression
+        n = ecm_output.parse_number(fields["N"])
+
+        B1 = int(float(fields["B1"]))
+        timestamp = None
+        if "TIME" in fields:
+            try:
+                # e.g. "Sat Jan  2 11:00:00 2021"
+                timestamp = int(datetime.datetime.strptime(
+                    " ".join(fields["TIME"].split()), "%a %b %d %H:%M:%S %Y").timestamp())
+            except ValueError:
+                pass
+
+        return {
+            "n": n,
+            "B1": B1,
+            "B2": B1,
+            "stage1_chkpnt": fields["X"].strip(),
+            "method": RESUME_METHODS[fields.get("METHOD", "ECM").strip()],
+            "param": int(fields["PARAM"]) if "PARAM" in fields else None,
+            "sigma": fields["SIGMA"].strip() if "SIGMA" in fields else None,
+            "timestamp": timestamp,
+        }
+
+
+    def _resume_line(record):
+        """GMP-ECM resume line for a (n, method, param, sigma, B1, x) row"""
+        fields = [f"METHOD={RESUME_METHOD_NAMES[record['method']]}"]
+        if record['param'] is not None:
+            fields.append(f"PARAM={record['param']}")
+        if record['sigma'] is not None:
+            fields.append(f"SIGMA={record['sigma']}")
+        x = int.from_bytes(record['x'], "big")
+        fields += [f"B1={record['B1']}", f"N={record['n']}", f"X={x:#x}", "PROGRAM=ecm-db"]
+        return "; ".join(fields) + ";\n"
+
+
+    def _residue_bytes(x):
+        """Big endian bytes of a residue given as bytes, int, hex or decimal string"""
+        if isinstance(x, bytes):
+            return x
+        if isinstance(x, str):
+            x = x.strip()
+            x = int(x, 16) if x.lower().startswith("0x") else int(x)
+        return x.to_bytes(max(1, (x.bit_length() + 7) // 8), "big")
+
+
+    def _digest(n):
+        """Fixed width key for the numbers index"""
+        return hashlib.blake2b(str(n).encode(), digest_size=16).digest()
+
+
+    def _classify(n):
+        """Status for a number that hasn't been factored"""
+        if gmpy2.is_prime(n):
+            return EcmServer.Status.PRP.value
+        return EcmServer.Status.C.value
 
 
     def _is_number_expr(expr):
-        # TODO
-        # https://stackoverflow.com/questions/2371436/evaluating-a-mathematical-expression-in-a-string
-        return False
+        """expr looks like a GMP-ECM expression (see ecm_output.parse_number)"""
+        return isinstance(expr, str) and re.fullmatch(r"[0-9()+*/%^!\s-]+", expr) is not None
 
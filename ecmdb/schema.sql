@@ -1,9 +1,14 @@
 /** DB for tracking distribution ecm effort */
 
 /* TODO: delete before 1.0.0 */
+DROP TABLE IF EXISTS work_units;
+DROP TABLE IF EXISTS ecm_effort;
 DROP TABLE IF EXISTS ecm_curves;
+DROP TABLE IF EXISTS residues;
 DROP TABLE IF EXISTS numbers;
 DROP TABLE IF EXISTS factors;
+DROP TABLE IF EXISTS number_lineage;
+DROP TABLE IF EXISTS import_checkpoints;
 
 CREATE TABLE IF NOT EXISTS ecm_curves (
   num_id INTEGER NOT NULL,
@@ -12,7 +17,8 @@ CREATE TABLE IF NOT EXISTS ecm_curves (
   B1 INTEGER NOT NULL,
   B2 INTEGER NOT NULL,
 
-  stage1_chkpnt TEXT,
+  /* Stage 1 residue, NULL if not kept */
+  residue_id INTEGER,
 
   maxmem INTEGER NOT NULL,
   stage1_ms INTEGER NOT NULL,
@@ -21,19 +27,51 @@ CREATE TABLE IF NOT EXISTS ecm_curves (
   /* ecm = 1, pm1 = 2, pp1 = 3 */
   method INTEGER NOT NULL CHECK(method >= 1 AND method <= 3),
 
+  /* Curve selection, NULL if unknown */
+  param INTEGER,
+  sigma TEXT,
+
   timestamp INTEGER NOT NULL,
 
-  /* TODO: x, y, param, sigma */
+  /* TODO: x, y */
   /* TODO: A, torsion, k, power, dickson */
   /* TODO: ecm-version */
 
   FOREIGN KEY (num_id) REFERENCES numbers(num_id),
+  FOREIGN KEY (residue_id) REFERENCES residues(residue_id),
   PRIMARY KEY (num_id, curve_id)
 );
 
+/* Stage 1 residues out of line so large ones don't bloat ecm_curves rows */
+CREATE TABLE IF NOT EXISTS residues (
+  residue_id INTEGER PRIMARY KEY,
+  /* blake2b(x, 16 bytes), identical residues are stored once */
+  digest BLOB NOT NULL,
+  /* X as big endian bytes */
+  x BLOB NOT NULL
+);
+
+/* Sum of ecm_curves per (num_id, method, B1, B2), updated with each insert */
+CREATE TABLE IF NOT EXISTS ecm_effort (
+  num_id INTEGER NOT NULL,
+  method INTEGER NOT NULL,
+
+  B1 INTEGER NOT NULL,
+  B2 INTEGER NOT NULL,
+
+  curves INTEGER NOT NULL,
+  stage1_ms INTEGER NOT NULL,
+  stage2_ms INTEGER NOT NULL,
+
+  FOREIGN KEY (num_id) REFERENCES numbers(num_id),
+  PRIMARY KEY (num_id, method, B1, B2)
+);
+
 CREATE TABLE IF NOT EXISTS numbers (
   num_id INTEGER PRIMARY KEY AUTOINCREMENT,
   n      TEXT NOT NULL,
+  /* blake2b(n, 16 bytes), keeps the lookup index small for large n */
+  n_digest BLOB NOT NULL,
 
   /* TODO: n_expr */
   /* TODO: parent */
@@ -54,3 +92,47 @@ CREATE TABLE IF NOT EXISTS factors (
   PRIMARY KEY(num_id_c, num_id_f)
 );
 
+/* Closure of factors: every (ancestor, descendant) pair in the factor tree */
+CREATE TABLE IF NOT EXISTS number_lineage (
+  ancestor INTEGER NOT NULL,
+  descendant INTEGER NOT NULL,
+
+  FOREIGN KEY(ancestor) REFERENCES numbers(num_id),
+  FOREIGN KEY(descendant) REFERENCES numbers(num_id),
+  PRIMARY KEY(ancestor, descendant)
+) WITHOUT ROWID;
+
+/* Curves to hand out to ecm_runner hosts */
+CREATE TABLE IF NOT EXISTS work_units (
+  wu_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  num_id INTEGER NOT NULL,
+
+  B1 INTEGER NOT NULL,
+  /* NULL = ecm's default B2 */
+  B2 INTEGER,
+
+  /* JSON list of extra ecm arguments */
+  params TEXT NOT NULL DEFAULT '[]',
+  resume_line TEXT NOT NULL DEFAULT '',
+
+  /* queued = 1, leased = 2, done = 3 */
+  state INTEGER NOT NULL CHECK(state >= 1 AND state <= 3),
+  lease_owner TEXT,
+  lease_expires INTEGER,
+
+  FOREIGN KEY (num_id) REFERENCES numbers(num_id)
+);
+
+CREATE INDEX IF NOT EXISTS work_units_state ON work_units(state, wu_id);
+
+/* How far (in bytes) each log file has been imported */
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+  path   TEXT PRIMARY KEY,
+  byte_offset INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS numbers_n_digest ON numbers(n_digest);
+CREATE UNIQUE INDEX IF NOT EXISTS residues_digest ON residues(digest);
+/* Finds a stored curve when the same curve is recorded again (e.g. stage 2 of a residue) */
+CREATE INDEX IF NOT EXISTS ecm_curves_sigma ON ecm_curves(num_id, sigma, B1);
+CREATE INDEX IF NOT EXISTS number_lineage_descendant ON number_lineage(descendant, ancestor);
@@ -0,0 +1,171 @@
+"""ECM success probabilities and t-levels.
+
+A curve with bounds B1, B2 finds a prime factor p when the curve's group
+order is B1-smooth except for at most one prime below B2. Group orders are
+modeled (as in GMP-ECM's rho.c) as random integers exp(EXTRA_SMOOTHNESS)
+smaller than p, which gives
+
+    P(B1, B2, p) = rho(a) + integral_1^min(a, b) rho(a - x) / x dx
+
+with rho the Dickman function, a = log(p') / log(B1), b = log(B2) / log(B1).
+Brent-Suyama extension is ignored which slightly underestimates stage 2.
+
+Everything is evaluated with NumPy over arrays of (B1, B2) groups and
+digit sizes; probabilities are only computed once per distinct group.
+"""
+
+import functools
+
+import numpy as np
+
+
+# Suyama / Montgomery parametrized curves have (on average) group orders
+# this much (log e) smoother than a random integer of the same size.
+ECM_EXTRA_SMOOTHNESS = 3.134
+
+# Dickman rho is tabulated for u in [0, RHO_MAX_U] with RHO_STEPS per unit.
+RHO_MAX_U = 60
+RHO_STEPS = 256
+
+# Simpson points used for the stage 2 integral (must be odd).
+STAGE2_POINTS = 33
+
+# Digit sizes t-levels are searched over.
+DIGITS = np.arange(5, 121, dtype=np.float64)
+
+
+@functools.lru_cache(maxsize=None)
+def _rho_table():
+    """(u, rho(u)) on a uniform grid.
+
+    Uses u * rho(u) = integral_{u-1}^u rho(t) dt with the trapezoid rule,
+    which (unlike integrating rho') has no cancellation for large u.
+    """
+    m = RHO_STEPS
+    h = 1 / m
+    u = np.arange(RHO_MAX_U * m + 1) * h
+    rho = np.ones(len(u))
+
+    # rho[i-m+1] + ... + rho[i-1]
+    window = float(m - 1)
+    for i in range(m + 1, len(u)):
+        r = h * (rho[i - m] / 2 + window) / (u[i] - h / 2)
+        rho[i] = r
+        window += r - rho[i - m + 1]
+
+    return u, rho
+
+
+def dickman_rho(u):
+    """Dickman rho, vectorized over u."""
+    table_u, table_rho = _rho_table()
+    return np.interp(u, table_u, table_rho, left=1.0, right=0.0)
+
+
+def _simpson_weights(k):
+    w = np.ones(k)
+    w[1:-1:2] = 4
+    w[2:-1:2] = 2
+    return w / (3 * (k - 1))
+
+
+def curve_probability(B1, B2, digits, extra=ECM_EXTRA_SMOOTHNESS):
+    """Probability one curve finds a factor of digits size.
+
+    All arguments broadcast against each other. Factors of d digits are
+    taken to be 10^(d - 0.5) as GMP-ECM does.
+    """
+    B1 = np.asarray(B1, dtype=np.float64)
+    B2 = np.maximum(np.asarray(B2, dtype=np.float64), B1)
+    digits = np.asarray(digits, dtype=np.float64)
+
+    log_B1 = np.log(B1)
+    a = ((digits - 0.5) * np.log(10) - extra) / log_B1
+    b = np.minimum(np.log(B2) / log_B1, np.maximum(a, 1))
+    a, b = np.broadcast_arrays(a, b)
+
+    # Stage 2: integrate rho(a - x) / x over x in [1, b].
+    t = np.linspace(0, 1, STAGE2_POINTS)
+    x = 1 + (b[..., None] - 1) * t
+    integrand = dickman_rho(a[..., None] - x) / x
+    stage2 = (b - 1) * (integrand @ _simpson_weights(STAGE2_POINTS))
+
+    return np.minimum(dickman_rho(a) + stage2, 1.0)
+
+
+def expected_curves(B1, B2, digits, extra=ECM_EXTRA_SMOOTHNESS):
+    """Expected number of curves to find a factor of digits size."""
+    return 1 / curve_probability(B1, B2, digits, extra)
+
+
+def effort(num_index, B1, B2, curves, digits=DIGITS, extra=ECM_EXTRA_SMOOTHNESS,
+           count=None):
+    """Sum of curves / expected_curves for each number and digit size.
+
+    num_index (0..count-1), B1, B2, curves (and optionally extra) describe
+    one group of curves each. Returns an array [count, len(digits)], a
+    value of 1 at d digits is one t<d> worth of work.
+    """
+    num_index = np.asarray(num_index, dtype=np.int64)
+    curves = np.asarray(curves, dtype=np.float64)
+    groups = np.column_stack([
+        np.broadcast_to(np.asarray(column, dtype=np.float64), num_index.shape)
+        for column in (B1, B2, extra)])
+
+    unique, inverse = np.unique(groups, axis=0, return_inverse=True)
+    probs = curve_probability(
+        unique[:, 0, None], unique[:, 1, None], np.asarray(digits)[None, :],
+        unique[:, 2, None])
+
+    if count is None:
+        count = int(num_index.max()) + 1 if len(num_index) else 0
+    work = np.zeros((count, len(digits)))
+    np.add.at(work, num_index, curves[:, None] * probs[inverse.reshape(-1)])
+    return work
+
+
+def t_levels(num_index, B1, B2, curves, extra=ECM_EXTRA_SMOOTHNESS, count=None):
+    """t-level (digits where effort is 1) of each number, 0 if below DIGITS."""
+    work = effort(num_index, B1, B2, curves, DIGITS, extra, count)
+
+    # work decreases with digits, find the last grid point with work >= 1
+    # then interpolate log(work) to the crossing.
+    done = work >= 1
+    last = done.sum(axis=1) - 1
+    levels = np.zeros(len(work))
+
+    inside = (last >= 0) & (last < len(DIGITS) - 1)
+    rows = np.nonzero(inside)[0]
+    lo = np.log(work[rows, last[rows]])
+    hi = np.log(np.maximum(work[rows, last[rows] + 1], 1e-300))
+    levels[rows] = DIGITS[last[rows]] + lo / (lo - hi) * (DIGITS[1] - DIGITS[0])
+
+    levels[last == len(DIGITS) - 1] = DIGITS[-1]
+    return levels
+
+
+def factor_found_probability(num_index, B1, B2, curves, digits,
+                             extra=ECM_EXTRA_SMOOTHNESS, count=None):
+    """Probability that a factor of each digits size would have been found."""
+    work = effort(num_index, B1, B2, curves, np.atleast_1d(digits), extra, count)
+    return 1 - np.exp(-work)
+
+
+def server_t_levels(server, exprs):
+    """{n: t-level} for numbers in an EcmServer from its ecm_effort summary.
+
+    Includes effort on numbers they are factors of (see EcmServer.lineage_effort).
+    """
+    numbers = [server.find_number(expr) for expr in exprs]
+    numbers = [number for number in numbers if number]
+    index = {number['num_id']: i for i, number in enumerate(numbers)}
+
+    groups = server.effort_groups(list(index), inherited=True)
+    levels = t_levels(
+        [index[group['num_id']] for group in groups],
+        [group['B1'] for group in groups],
+        [group['B2'] for group in groups],
+        [group['curves'] for group in groups],
+        count=len(numbers))
+
+    return {number['n']: float(level) for number, level in zip(numbers, levels)}
@@ -0,0 +1,145 @@
+"""HTTP server that leases work units to ecm_runner hosts and records results.
+
+Endpoints (JSON bodies):
+    POST /lease     {"owner": str, "count": int} -> {"work": [WorkUnit fields]}
+    POST /results   {"results": [[wu, result], ...]} -> {"recorded": int}
+    GET  /status    -> {"QUEUED": int, "LEASED": int, "DONE": int}
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ecmdb.ecmserver import EcmServer
+
+
+class WorkServer(http.server.ThreadingHTTPServer):
+    """Serves one EcmServer to many runners.
+
+    server should have readers (be thread safe): /status reads run in
+    parallel and /lease, /results writes are group committed.
+    """
+
+    # Largest count a single /lease can request.
+    MAX_LEASE = 1000
+
+    def __init__(self, address, server, lease_seconds=3600):
+        super().__init__(address, WorkRequestHandler)
+        self.ecm_server = server
+        self.lease_seconds = lease_seconds
+
+
+    def lease(self, owner, count):
+        count = max(0, min(int(count), WorkServer.MAX_LEASE))
+        records = self.ecm_server.lease_work(count, owner, self.lease_seconds)
+
+        return [{
+            "uid": record['wu_id'],
+            "n": record['n'],
+            "params": json.loads(record['params']),
+            "B1": str(record['B1']),
+            "B2": None if record['B2'] is None else str(record['B2']),
+            "resume_line": record['resume_line'],
+        } for record in records]
+
+
+    def record(self, results):
+        return self.ecm_server.complete_work(results)
+
+
+    def status(self):
+        return self.ecm_server.work_status()
+
+
+class WorkRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._send_json(200, self.server.status())
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+            if self.path == "/lease":
+                work = self.server.lease(request.get("owner", "?"), request.get("count", 1))
+                self._send_json(200, {"work": work})
+            elif self.path == "/results":
+                recorded = self.server.record(request["results"])
+                self._send_json(200, {"recorded": recorded})
+            else:
+                self._send_json(404, {"error": f"Unknown path: {self.path}"})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='ecm-db work server.')
+    parser.add_argument('--db', default='./ecm-server.db',
+                        help='database file')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8419,
+                        help='port to listen on')
+    parser.add_argument('--lease_seconds', type=int, default=3600,
+                        help='seconds before a leased work unit is requeued')
+    parser.add_argument('--readers', type=int, default=8,
+                        help='read only database connections for concurrent requests')
+    parser.add_argument('-N', '-n', help='Number to queue work for')
+    parser.add_argument('--B1', '--b1', help='B1 of queued work')
+    parser.add_argument('--B2', '--b2', help='B2 of queued work')
+    parser.add_argument('-c', '--curves', type=int, default=0,
+                        help='number of work units to queue before serving')
+    return parser
+
+
+def main(args):
+    server = EcmServer(args.db, readers=max(1, args.readers))
+
+    if args.curves:
+        assert args.N and args.B1, "-N and --B1 are needed to queue work"
+        wu_ids = server.add_work(args.N, int(float(args.B1)),
+                                 int(float(args.B2)) if args.B2 else None, args.curves)
+        print(f"Queued {len(wu_ids)} work units")
+
+    httpd = WorkServer((args.host, args.port), server, args.lease_seconds)
+    print(f"Serving work on http://{args.host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Stand-in for GMP-ECM that prints realistic -v output.
+
+Reads N (or a resume line with -resume -) from stdin like ecm and accepts
+the arguments ecm_runner passes. Behaviour is tuned with environment
+variables:
+
+    FAKE_ECM_STAGE1_MS      stage 1 time per curve (default 0)
+    FAKE_ECM_STAGE2_MS      stage 2 time per curve (default 0)
+    FAKE_ECM_FACTOR_RATE    probability a curve finds a factor (default 0)
+    FAKE_ECM_OUTPUT_LINES   extra verbose lines per curve (default 10)
+    FAKE_ECM_MEMORY_KB      reported stage 2 memory use (default 2048)
+
+Tests synchronize with it through files instead of timing:
+
+    FAKE_ECM_STARTED        directory, each run creates a file named by its pid on start
+    FAKE_ECM_WAIT           stage 1 doesn't end until this file exists
+"""
+
+import os
+import random
+import sys
+import time
+
+VERSION = "GMP-ECM 7.0.5 [configured with GMP 6.2.1, --enable-asm-redc] [ECM]"
+
+
+def env(name, default, kind=float):
+    return kind(os.environ.get(name, default))
+
+
+def parse_args(argv):
+    opts = {"c": 1, "save": None, "chkpnt": None, "resume": None, "param": 1}
+    bounds = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("-c", "-save", "-chkpnt", "-resume", "-maxmem", "-param", "-power",
+                   "-dickson", "-sigma", "-x0", "-y0", "-A", "-k", "-torsion",
+                   "-savea", "-treefile", "-go", "-stage1time"):
+            opts[arg[1:]] = argv[i + 1]
+            i += 2
+            continue
+        if not arg.startswith("-"):
+            bounds.append(arg)
+        i += 1
+    opts["c"] = int(opts["c"])
+    opts["param"] = int(opts["param"])
+    B1 = int(float(bounds[0]))
+    B2 = int(float(bounds[1])) if len(bounds) > 1 else 50 * B1 + 1
+    return opts, B1, B2
+
+
+def wait_for(fn, timeout=60):
+    """Block until fn exists, gives up after timeout so a broken test can't hang"""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(fn) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def resume_fields(line):
+    fields = {}
+    for part in line.strip().split(";"):
+        if "=" in part:
+            key, value = part.strip().split("=", 1)
+            fields[key] = value
+    return fields
+
+
+def resume_line(n, B1, sigma, param):
+    x = random.getrandbits(min(n.bit_length(), 256))
+    return (f"METHOD=ECM; PARAM={param}; SIGMA={sigma}; B1={B1}; N={n}; X={x:#x}; "
+            f"CHECKSUM={random.getrandbits(32)}; PROGRAM=GMP-ECM 7.0.5; Y=0x0; X0=0x0; "
+            f"Y0=0x0; WHO=fake@host; TIME={time.ctime()};\n")
+
+
+def small_factor(n):
+    for p in (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47):
+        if n % p == 0:
+            return p
+    return None
+
+
+def found_factor(out, n, factor, step):
+    out.write(f"********** Factor found in step {step}: {factor}\n")
+    out.write(f"Found prime factor of {len(str(factor))} digits: {factor}\n")
+    cofactor = n // factor if n % factor == 0 else n
+    out.write(f"Composite cofactor {cofactor} has {len(str(cofactor))} digits\n")
+    out.flush()
+    # Factor found (2) | factor is prime (4), see ecm's man page
+    return 6
+
+
+def main():
+    opts, B1, B2 = parse_args(sys.argv[1:])
+    stage1_ms = env("FAKE_ECM_STAGE1_MS", 0)
+    stage2_ms = env("FAKE_ECM_STAGE2_MS", 0)
+    factor_rate = env("FAKE_ECM_FACTOR_RATE", 0)
+    extra_lines = env("FAKE_ECM_OUTPUT_LINES", 10, int)
+    memory_kb = env("FAKE_ECM_MEMORY_KB", 2048, int)
+    wait_fn = os.environ.get("FAKE_ECM_WAIT")
+
+    started_dir = os.environ.get("FAKE_ECM_STARTED")
+    if started_dir:
+        open(os.path.join(started_dir, str(os.getpid())), "w").close()
+
+    data = sys.stdin.read()
+    resumed = None
+    if opts["resume"]:
+        resumed = resume_fields(data)
+        N = resumed["N"]
+        n = int(N, 16) if N.startswith("0x") else int(N)
+    else:
+        n = int(data.strip())
+
+    out = sys.stdout
+    out.write(VERSION + "\n")
+    out.write("Running on fakehost\n")
+    if resumed:
+        out.write(f"Resuming ECM residue saved by fake@host with GMP-ECM 7.0.5 on {time.ctime()}\n")
+    out.write(f"Input number is {n} ({len(str(n))} digits)\n")
+    out.flush()
+
+    for curve in range(opts["c"]):
+        if curve:
+            out.write(f"Run {curve + 1} out of {opts['c']}:\n")
+
+        if resumed:
+            sigma = resumed.get("SIGMA", "0")
+            param = int(resumed.get("PARAM", 0))
+            done_B1 = int(float(resumed["B1"]))
+            using_B1 = f"{done_B1}-{B1}"
+        else:
+            sigma = str(random.randint(10 ** 9, 2 ** 32 - 1))
+            param = opts["param"]
+            done_B1 = 0
+            using_B1 = str(B1)
+        out.write("Using MODMULN [mulredc:1, sqr_redc:1]\n")
+        out.write(f"Using B1={using_B1}, B2={B2}, polynomial x^1, sigma={param}:{sigma}\n")
+        out.write("dF=256, k=2, d=2310, d2=13, i0=-8\n")
+        for i in range(extra_lines):
+            out.write(f"{35 + 5 * i}\t{random.randint(100, 10 ** 6)}\n")
+        out.flush()
+
+        # Small factors are always found, others at factor_rate (not a real divisor)
+        factor = small_factor(n)
+        if factor is None and random.random() < factor_rate:
+            factor = random.choice([2, 3, 5, 7])
+
+        s1 = 0 if done_B1 >= B1 else stage1_ms
+        if opts["chkpnt"] and s1:
+            time.sleep(s1 / 2000)
+            with open(opts["chkpnt"], "w") as f:
+                f.write(resume_line(n, max(done_B1, B1 // 2), sigma, param))
+            time.sleep(s1 / 2000)
+        else:
+            time.sleep(s1 / 1000)
+        if wait_fn:
+            wait_for(wait_fn)
+        out.write(f"Step 1 took {int(s1)}ms\n")
+        out.flush()
+
+        if opts["save"]:
+            with open(opts["save"], "a") as f:
+                f.write(resume_line(n, B1, sigma, param))
+
+        if B2 > B1:
+            out.write(f"Estimated memory usage: {memory_kb / 1024:.2f}MB\n")
+            out.write("Initializing tables of differences for F took 0ms\n")
+            out.flush()
+            time.sleep(stage2_ms / 1000)
+            out.write(f"Step 2 took {int(stage2_ms)}ms\n")
+            if factor:
+                return found_factor(out, n, factor, 2)
+        elif factor:
+            return found_factor(out, n, factor, 1)
+        out.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
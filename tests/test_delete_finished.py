@@ -0,0 +1,123 @@
+from tools import delete_finished
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+
+TEXT_LOG = """GMP-ECM 7.0.5 [configured with GMP 6.2.1, --enable-asm-redc] [ECM]
+Input number is 1000000000000000000000000000000000000000000000000007 (52 digits)
+Using B1=10000, B2=500001, polynomial x^1, sigma=1:1111111111
+Step 1 took 30ms
+GMP-ECM 7.0.5 [configured with GMP 6.2.1, --enable-asm-redc] [ECM]
+Input number is 2^1277-1 (385 digits)
+Using B1=10000, B2=500001, polynomial x^1, sigma=1:2222222222
+Step 1 took 20ms
+Input number is garbled
+"""
+
+RESUME_LINE = "METHOD=ECM; PARAM=1; SIGMA={sigma}; B1=10000; N={N}; X=0x1; CHECKSUM=1; PROGRAM=GMP-ECM 7.0.5;\n"
+
+
+class TestDeleteFinished(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.log_fn = self.path("ecm_runner_1.log")
+        with open(self.log_fn, "w") as f:
+            f.write(TEXT_LOG)
+
+        self.json_log_fn = self.path("ecm_runner_2.json.log")
+        with open(self.json_log_fn, "w") as f:
+            output = "Input number is 3*10^40+1 (41 digits)\nStep 1 took 10ms\n"
+            f.write(json.dumps([{"uid": 0}, {"stdout": output}]) + "\n")
+
+        self.finished = [
+            RESUME_LINE.format(sigma=1, N=10 ** 51 + 7),
+            RESUME_LINE.format(sigma=2, N=hex(10 ** 51 + 7)),
+            RESUME_LINE.format(sigma=3, N="2^1277-1"),
+            RESUME_LINE.format(sigma=4, N="3*10^40+1"),
+        ]
+        self.remaining = [
+            RESUME_LINE.format(sigma=5, N=10 ** 51 + 9),
+            RESUME_LINE.format(sigma=6, N="2^1279-1"),
+            "not a resume line\n",
+        ]
+        self.resume_fn = self.path("resume.txt")
+        with open(self.resume_fn, "w") as f:
+            for i in range(len(self.remaining)):
+                f.write(self.finished[i] + self.remaining[i])
+            f.writelines(self.finished[len(self.remaining):])
+
+
+    def path(self, fn):
+        return os.path.join(self.tmp.name, fn)
+
+
+    def run_main(self, *argv):
+        args = delete_finished.get_argparser().parse_args(
+            list(argv) + [self.resume_fn, self.log_fn, self.json_log_fn])
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            delete_finished.main(args)
+        return out.getvalue()
+
+
+    def read(self, fn):
+        with open(fn) as f:
+            return f.readlines()
+
+
+    def test_read_logs(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            finished = delete_finished.read_logs([self.log_fn, self.json_log_fn])
+        self.assertEqual(finished, {str(10 ** 51 + 7).encode(), b"2^1277-1", b"3*10^40+1"})
+        self.assertIn("Skipping unparsed line 9", out.getvalue())
+
+
+    def test_filter(self):
+        self.run_main()
+        self.assertEqual(self.read(self.resume_fn + ".filtered"), self.remaining)
+        # Original is untouched
+        self.assertEqual(len(self.read(self.resume_fn)), len(self.finished) + len(self.remaining))
+
+
+    def test_dry_run(self):
+        out = self.run_main("-n")
+        self.assertIn("Removed 4/7 finished results", out)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ["ecm_runner_1.log", "ecm_runner_2.json.log", "resume.txt"])
+
+
+    def test_in_place(self):
+        self.run_main("-i")
+        self.assertEqual(self.read(self.resume_fn), self.remaining)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ["ecm_runner_1.log", "ecm_runner_2.json.log", "resume.txt"])
+
+
+    def test_atomic_replace(self):
+        before = self.read(self.resume_fn)
+        args = delete_finished.get_argparser().parse_args(["-i", "x"])
+        finished = delete_finished.FinishedFilter({b"2^1277-1"})
+
+        def failing(line):
+            if b"SIGMA=5;" in line:
+                raise OSError("disk full")
+            return finished(line)
+
+        with contextlib.redirect_stdout(io.StringIO()), self.assertRaises(OSError):
+            delete_finished.remove_matched(args, self.resume_fn, self.resume_fn, failing)
+
+        # Neither a partial file nor the temporary file are left behind
+        self.assertEqual(self.read(self.resume_fn), before)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ["ecm_runner_1.log", "ecm_runner_2.json.log", "resume.txt"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+from client import ecm_output
+from client import ecm_runner
+
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+
+
+VERSION = "GMP-ECM 7.0.5 [configured with GMP 6.2.1, --enable-asm-redc] [ECM]"
+
+STAGE1_FACTOR = f"""{VERSION}
+Input number is 1000000000000000000000000000000000000000000000000007 (52 digits)
+Using B1=10000, B2=500001, polynomial x^1, sigma=3:1111111111
+x=123456789
+Step 1 took 30ms
+x=987654321
+********** Factor found in step 1: 1000003
+Found prime factor of 7 digits: 1000003
+"""
+
+BATCH = f"""{VERSION}
+Resuming ECM residue saved by me@host with GMP-ECM 7.0.5 on Thu Jan  1 00:00:00 2026
+Input number is 1000000000000000000000000000000000000000000000000007 (52 digits)
+Using B1=5000-10000, B2=500001, polynomial x^1, sigma=1:2222222222
+Step 1 took 20ms
+Estimated memory usage: 512KB
+Step 2 took 20ms
+Run 2 out of 2:
+Using B1=5000-10000, B2=500001, polynomial Dickson(3), sigma=3333333333
+Step 1 took 20ms
+Estimated memory usage: 1.50GB
+Step 2 took 10ms
+"""
+
+
+class TestEcmOutput(unittest.TestCase):
+
+    def test_single_curve(self):
+        curves = ecm_output.parse_output(STAGE1_FACTOR)
+        self.assertEqual(len(curves), 1)
+        curve = curves[0]
+        self.assertEqual(curve.version, VERSION)
+        self.assertEqual(curve.digits, 52)
+        self.assertEqual((curve.B1, curve.B2, curve.polynomial), ("10000", "500001", "x^1"))
+        self.assertEqual((curve.param, curve.sigma), (3, "3:1111111111"))
+        self.assertEqual(curve.residue, "987654321")
+        self.assertEqual((curve.factors, curve.factor_step), ((1000003,), 1))
+        # No stage 2 after a stage 1 factor
+        self.assertEqual(curve.step2_ms, None)
+        self.assertEqual(curve.errors, ())
+        self.assertEqual(curve.output, STAGE1_FACTOR)
+
+
+    def test_batch(self):
+        curves = ecm_output.parse_output(BATCH)
+        self.assertEqual([c.sigma for c in curves], ["1:2222222222", "3333333333"])
+        self.assertEqual([c.param for c in curves], [1, 0])
+        self.assertEqual([c.memory_mb for c in curves], [0.5, 1536])
+        self.assertEqual([(c.step1_ms, c.step2_ms) for c in curves], [(20, 20), (20, 10)])
+        self.assertTrue(all(c.resumed and c.input_number and not c.errors for c in curves))
+        self.assertEqual([c.line for c in curves], [4, 9])
+
+        # Header is repeated, "Run 2 out of 2" dropped
+        self.assertTrue(curves[1].output.startswith(VERSION))
+        self.assertNotIn("Run 2", curves[1].output)
+        self.assertEqual(sum(c.output.count("Using B1") for c in curves), 2)
+
+        # Line at a time gives the same curves
+        parser = ecm_output.OutputParser()
+        streamed = []
+        for line in BATCH.splitlines(keepends=True):
+            streamed.extend(parser.feed(line))
+        self.assertEqual(streamed + parser.close(), curves)
+
+
+    def test_errors(self):
+        truncated = BATCH[:BATCH.index("Step 2 took 10ms")]
+        curves = ecm_output.parse_output(truncated)
+        self.assertEqual(curves[1].errors, (
+            ecm_output.ParseError("step2_ms", "missing 'Step 2 took' line", 9),))
+
+        # Header but no curve
+        curves = ecm_output.parse_output(VERSION + "\n")
+        self.assertEqual([e.field for e in curves[0].errors],
+                         ["input_number", "using", "step1_ms", "step2_ms"])
+
+        # ecm_runner imports its own copy of ecm_output, EcmOutputError is a ValueError
+        output = subprocess.CompletedProcess(["ecm"], 0, truncated, "")
+        with self.assertRaises(ValueError) as cm:
+            ecm_runner.process_batch_output(output, 1.0)
+        self.assertEqual([e.field for e in cm.exception.errors], ["step2_ms"])
+
+        # Stage 1 only runs don't need a stage 2 timing
+        results = ecm_runner.process_batch_output(output, 1.0, stage2=False)
+        self.assertEqual([r.timings for r in results], [(20, 0), (20, 0)])
+
+        output = subprocess.CompletedProcess(["ecm"], 1, STAGE1_FACTOR, "")
+        with self.assertRaisesRegex(ValueError, "exit_status"):
+            ecm_runner.process_output(output, 1.0)
+
+
+    def test_parse_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, "ecm.txt")
+            with open(fn, "w") as f:
+                f.write(BATCH + "some other program\n" + STAGE1_FACTOR + BATCH)
+            curves = list(ecm_output.parse_log(fn))
+            self.assertEqual([c.factor_step for c in curves], [None, None, 1, None, None])
+            self.assertEqual([c.line for c in curves], [4, 9, 16, 25, 30])
+            self.assertEqual({c.output for c in curves}, {""})
+
+            fn = os.path.join(tmp, "ecm.json.log")
+            with open(fn, "w") as f:
+                for output in (STAGE1_FACTOR, BATCH):
+                    f.write(json.dumps([{}, {"output": output.rstrip()}]) + "\n")
+            curves = list(ecm_output.parse_log(fn))
+            self.assertEqual([c.sigma for c in curves],
+                             ["3:1111111111", "1:2222222222", "3333333333"])
+
+
+    def test_resume_numbers(self):
+        line = "METHOD=ECM; SIGMA=5; B1=11000; N=0x3f1; X=0x12; CHECKSUM=1; PROGRAM=GMP-ECM 7.0.5;\n"
+        self.assertEqual(ecm_output.RE_RESUME_N.search(line).group(1), "0x3f1")
+        self.assertEqual(ecm_output.RE_RESUME_N_BYTES.search(line.encode()).group(1), b"0x3f1")
+        self.assertEqual(ecm_output.RE_RESUME_N.search("N=2^1277-1; X=0x1;").group(1), "2^1277-1")
+
+        # Hex, decimal with leading zeros and the decimal all name the same number
+        self.assertEqual({ecm_output.normalize_number(n) for n in ("0x3f1", "001009", " 1009\n")},
+                         {"1009"})
+        self.assertEqual(ecm_output.normalize_number("(2^349 - 1) / 1779973928671"),
+                         "(2^349-1)/1779973928671")
+
+
+    def test_parse_number(self):
+        self.assertEqual(ecm_output.parse_number("(2^349-1)/1779973928671"),
+                         (2 ** 349 - 1) // 1779973928671)
+        self.assertEqual(ecm_output.parse_number("3*10^40+1"), 3 * 10 ** 40 + 1)
+        self.assertEqual(ecm_output.parse_number("2^3^2 - -1"), 513)
+        self.assertEqual(ecm_output.parse_number("10!/7%100"), 3628800 // 7 % 100)
+        self.assertEqual(ecm_output.parse_number("0x3f1"), 1009)
+        for bad in ("2^349-x", "(2^7-1", "1/0", "2^-1", "2^99999999", "3)"):
+            with self.assertRaises(ValueError):
+                ecm_output.parse_number(bad)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,640 @@
+from client import ecm_runner
+from client import result_log
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+
+FAKE_ECM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ecm.py")
+# No factors the fake ecm reports
+N = str(10 ** 51 + 7)
+
+
+BATCH_OUTPUT = """GMP-ECM 7.0.5 [configured with GMP 6.2.1, --enable-asm-redc] [ECM]
+Input number is 1000000000000000000000000000000000000000000000000007 (52 digits)
+Using B1=10000, B2=500001, polynomial x^1, sigma=1:1111111111
+Step 1 took 30ms
+Step 2 took 10ms
+Run 2 out of 3:
+Using B1=10000, B2=500001, polynomial x^1, sigma=1:2222222222
+Step 1 took 20ms
+Step 2 took 20ms
+Run 3 out of 3:
+Using B1=10000, B2=500001, polynomial x^1, sigma=1:3333333333
+Step 1 took 20ms
+Step 2 took 0ms
+"""
+
+
+def runner_args(*argv):
+    return ecm_runner.get_argparser().parse_args(["-b", FAKE_ECM, "--asyncio"] + list(argv))
+
+
+def write_wrapper(fn, body):
+    """Executable Python script standing in for ecm"""
+    with open(fn, "w") as f:
+        f.write(f"#!{sys.executable}\nimport os, sys\n{body}")
+    os.chmod(fn, 0o755)
+    return fn
+
+
+def started_pids(started_dir):
+    """pids of the fake ecm runs started with FAKE_ECM_STARTED=started_dir"""
+    return sorted(int(fn) for fn in os.listdir(started_dir))
+
+
+def read_json_log(fn):
+    with open(fn) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestEcmRunner(unittest.TestCase):
+
+    def assertKilled(self, pids):
+        self.assertTrue(pids)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+    def test_split_output(self):
+        runs = ecm_runner.split_output(BATCH_OUTPUT)
+        self.assertEqual(len(runs), 3)
+        for run in runs:
+            self.assertIn("Input number is", run)
+            self.assertEqual(run.count("Using B1="), 1)
+
+        self.assertEqual(ecm_runner.split_output("Step 1 took 1ms\n"), ["Step 1 took 1ms\n"])
+
+
+    def test_process_batch_output(self):
+        output = subprocess.CompletedProcess(["ecm"], 0, BATCH_OUTPUT, "")
+        results = ecm_runner.process_batch_output(output, 1.0)
+
+        self.assertEqual([r.sigma for r in results],
+                         ["1:1111111111", "1:2222222222", "1:3333333333"])
+        self.assertEqual([r.timings for r in results], [(30, 10), (20, 20), (20, 0)])
+        self.assertAlmostEqual(sum(r.runtime for r in results), 1.0)
+        self.assertAlmostEqual(results[2].runtime, 0.2)
+
+
+    def test_curve_batcher(self):
+        batcher = ecm_runner.CurveBatcher(10, 50)
+        self.assertEqual(batcher.curves(), 1)
+
+        output = subprocess.CompletedProcess(["ecm"], 0, BATCH_OUTPUT, "")
+        batcher.observe(ecm_runner.process_batch_output(output, 1.5))
+        self.assertEqual(batcher.curves(), 20)
+
+        self.assertEqual(ecm_runner.CurveBatcher(0, 50).curves(), 1)
+
+
+    def test_journal_restart(self):
+        units = [ecm_runner.WorkUnit(i, "1007", (), "10000", None,
+                                     resume_line=f"METHOD=ECM; SIGMA={i}; B1=10000; N=1007;")
+                 for i in range(5)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, "r.journal")
+            journal = ecm_runner.Journal(fn, sync_every=2)
+            self.assertFalse(journal.restarted)
+            for wu in units:
+                journal.dispatch(wu)
+            journal.complete(units[0])
+            self.assertFalse(journal.sync_due())
+            journal.complete(units[3])
+            self.assertTrue(journal.sync_due())
+            journal.sync()
+            # Crash while writing the next record
+            journal.f.write("C 12")
+            journal.f.close()
+
+            journal = ecm_runner.Journal(fn)
+            self.assertTrue(journal.restarted)
+            self.assertEqual(journal.unfinished(units), [units[1], units[2], units[4]])
+            journal.close()
+
+            # Same lines in a different order (e.g. an edited resume file) still match
+            moved = [dataclasses.replace(wu, uid=10 - wu.uid) for wu in units]
+            journal = ecm_runner.Journal(fn)
+            self.assertEqual(len(journal.unfinished(moved)), 3)
+            journal.close()
+
+
+    def test_journal_lost_completions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fn = os.path.join(tmp, "resume.txt")
+            with open(resume_fn, "w") as f:
+                for i in range(5):
+                    f.write(f"METHOD=ECM; PARAM=1; SIGMA={1000 + i}; B1=1000; N={N}; X=0x1f;\n")
+
+            for log_format in ("text", "binary"):
+                args = runner_args("-r", resume_fn, "--B2", "50000", "-t", "2",
+                                   "--log_format", log_format)
+                ecm_runner.async_main_loop(args)
+
+                # D records are written when ecm starts, not when units are queued
+                journal_fn = resume_fn + ".journal"
+                with open(journal_fn) as f:
+                    lines = f.readlines()
+                self.assertEqual(sorted(line[0] for line in lines), ["C"] * 5 + ["D"] * 5)
+
+                # Crash after logging results but before the journal was synced
+                with open(journal_fn, "w") as f:
+                    f.writelines(line for line in lines if line.startswith("D"))
+                ecm_runner.async_main_loop(args)
+
+                if log_format == "text":
+                    results = read_json_log(resume_fn + ".json.log")
+                else:
+                    results = list(result_log.iter_records(resume_fn + ".rlog"))
+                self.assertEqual(len(results), 5)
+                with open(journal_fn) as f:
+                    self.assertEqual(sum(line.startswith("C ") for line in f), 5)
+
+                for fn in (resume_fn + ".log", resume_fn + ".json.log", resume_fn + ".rlog",
+                           journal_fn):
+                    if os.path.exists(fn):
+                        os.remove(fn)
+
+
+    def test_journal_main_loop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fn = os.path.join(tmp, "resume.txt")
+            with open(resume_fn, "w") as f:
+                for i in range(4):
+                    f.write(f"METHOD=ECM; PARAM=1; SIGMA={1000 + i}; B1=1000; N={N}; X=0x1f;\n")
+
+            # Multiprocessing workers report starts too
+            args = ecm_runner.get_argparser().parse_args(
+                ["-b", FAKE_ECM, "-r", resume_fn, "--B2", "50000", "-t", "2"])
+            ecm_runner.main_loop(args)
+
+            with open(resume_fn + ".journal") as f:
+                records = [line.split() for line in f]
+        self.assertEqual(sorted(kind for kind, _ in records), ["C"] * 4 + ["D"] * 4)
+        for kind, key in records:
+            if kind == "C":
+                self.assertLess(records.index(["D", key]), records.index(["C", key]))
+
+
+    def test_checkpoint_resume(self):
+        wu = ecm_runner.WorkUnit(1234, "1007", ("-v",), "10000", None)
+        with tempfile.TemporaryDirectory() as tmp:
+            env = ecm_runner.Env("ecm", (), tmp)
+            fn = ecm_runner.checkpoint_fn(wu, env)
+            self.assertEqual(fn, os.path.join(tmp, "1234.chkpnt"))
+
+            stdin, cmd = ecm_runner.get_command(wu, env)
+            self.assertEqual(stdin, "1007")
+            self.assertEqual(cmd, ["ecm", "-v", "-chkpnt", fn, "10000"])
+
+            # ecm was killed after checkpointing part of stage 1
+            line = "METHOD=ECM; PARAM=1; SIGMA=42; B1=5000; N=1007; X=0x1; CHECKSUM=1;\n"
+            with open(fn, "w") as f:
+                f.write(line)
+            stdin, cmd = ecm_runner.get_command(wu, env)
+            self.assertEqual(stdin, line)
+            self.assertEqual(cmd, ["ecm", "-v", "-chkpnt", fn, "-resume", "-", "10000"])
+
+            args = argparse.Namespace(N="1007", B1="10000", B2=None)
+            self.assertEqual([u.uid for u in ecm_runner.checkpointed_work_units(args, env)], [1234])
+
+            # ecm writes N in hex, or the expression it was given
+            expr = "(2^349-1)/1779973928671"
+            for uid, n in ((1235, "0x3ef"), (1236, expr), (1237, "1009")):
+                with open(os.path.join(tmp, f"{uid}.chkpnt"), "w") as f:
+                    f.write(line.replace("N=1007", f"N={n}"))
+            self.assertEqual([u.uid for u in ecm_runner.checkpointed_work_units(args, env)],
+                             [1234, 1235])
+            args.N = " (2^349 - 1) / 1779973928671"
+            units = ecm_runner.checkpointed_work_units(args, env)
+            self.assertEqual([(u.uid, u.n) for u in units], [(1236, args.N)])
+            self.assertEqual(ecm_runner.read_checkpoint(ecm_runner.checkpoint_fn(units[0], env)),
+                             line.replace("N=1007", f"N={expr}"))
+
+            ecm_runner.remove_checkpoint(wu, env)
+            self.assertFalse(os.path.exists(fn))
+
+        # Batched curves don't checkpoint
+        batch = dataclasses.replace(wu, curves=5)
+        self.assertEqual(ecm_runner.checkpoint_fn(batch, ecm_runner.Env("ecm", (), "ck")), "")
+
+
+    def test_main_loop_factor_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            started = os.path.join(tmp, "started")
+            checkpoint_dir = os.path.join(tmp, "checkpoints")
+            os.mkdir(started)
+            os.mkdir(checkpoint_dir)
+            # The first ecm finds a factor once the other has checkpointed, that one never finishes
+            ecm = write_wrapper(os.path.join(tmp, "ecm"), f"""
+import time
+try:
+    os.mkdir({os.path.join(tmp, "first")!r})
+except FileExistsError:
+    os.environ.update(FAKE_ECM_STARTED={started!r}, FAKE_ECM_WAIT={os.path.join(tmp, "never")!r},
+                      FAKE_ECM_STAGE1_MS="10")
+    os.execv(sys.executable, [sys.executable, {FAKE_ECM!r}] + sys.argv[1:])
+
+deadline = time.monotonic() + 10
+while not os.listdir({checkpoint_dir!r}) and time.monotonic() < deadline:
+    time.sleep(0.01)
+os.environ["FAKE_ECM_FACTOR_RATE"] = "1"
+os.execv(sys.executable, [sys.executable, {FAKE_ECM!r}] + sys.argv[1:])
+""")
+            log_fn = os.path.join(tmp, "factor")
+            args = ecm_runner.get_argparser().parse_args(
+                ["-b", ecm, "-N", N, "--B1", "1000", "-t", "2", "--log_name", log_fn,
+                 "--checkpoint_dir", checkpoint_dir])
+            ecm_runner.main_loop(args)
+
+            # The sibling's ecm was killed and its checkpoint removed
+            self.assertKilled(started_pids(started))
+            self.assertEqual(os.listdir(checkpoint_dir), [])
+            results = read_json_log(log_fn + ".json.log")
+            self.assertEqual(len(results), 1)
+            self.assertTrue(results[0][1]["factors"])
+
+
+    def test_log_writer(self):
+        wu = ecm_runner.WorkUnit(1, "1007", ("-v",), "10000", None)
+        output = subprocess.CompletedProcess(["ecm"], 0, BATCH_OUTPUT, "")
+        results = ecm_runner.process_batch_output(output, 1.0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fns = [os.path.join(tmp, "w.log"), os.path.join(tmp, "w.json.log")]
+            writer = ecm_runner.LogWriter(fns, "text", "w", flush_records=100, flush_seconds=60)
+            for result in results:
+                writer.put(wu, result)
+            writer.flush()
+            with open(fns[1]) as f:
+                self.assertEqual(len(f.readlines()), 3)
+
+            for _ in range(10):
+                writer.put(wu, results[0])
+            # close drains the queue
+            writer.close()
+            with open(fns[1]) as f:
+                self.assertEqual(len(f.readlines()), 13)
+            with open(fns[0]) as f:
+                self.assertEqual(f.read().count("sigma=1:1111111111"), 11 * 2)
+
+            # Binary blocks end at the same record count as the other flushes
+            fn = os.path.join(tmp, "w.rlog")
+            writer = ecm_runner.LogWriter([fn], "binary", "w", flush_records=100, flush_seconds=60)
+            for _ in range(250):
+                writer.put(wu, results[0])
+            writer.close()
+            counts = [len(rows) for _, _, rows, _ in result_log.read_raw_blocks(fn)]
+            self.assertEqual(counts, [100, 100, 50])
+
+
+    def test_close_upload_error(self):
+        wu = ecm_runner.WorkUnit(1, "1007", ("-v",), "10000", None)
+        output = subprocess.CompletedProcess(["ecm"], 0, BATCH_OUTPUT, "")
+        results = ecm_runner.process_batch_output(output, 1.0)
+
+        for error in (OSError("unreachable"), RuntimeError("bug")):
+            with tempfile.TemporaryDirectory() as tmp:
+                log_fn = os.path.join(tmp, "r.log")
+                client = mock.Mock()
+                client.upload.side_effect = error
+                process_results = ecm_runner.ProcessResults(
+                    log_fn, client, upload_batch=100,
+                    journal=ecm_runner.Journal(log_fn + ".journal"))
+                for result in results:
+                    process_results.process(wu, result)
+                process_results.finished(wu)
+
+                if isinstance(error, OSError):
+                    process_results.close()
+                else:
+                    with self.assertRaises(RuntimeError):
+                        process_results.close()
+
+                # The local logs don't depend on the server
+                self.assertFalse(process_results.writer.is_alive())
+                self.assertEqual(len(read_json_log(os.path.join(tmp, "r.json.log"))), 3)
+                with open(log_fn + ".journal") as f:
+                    self.assertEqual(f.read().count("C "), 1)
+                self.assertEqual(len(read_json_log(process_results.unsent_fn)), 3)
+
+
+    def test_metrics(self):
+        wu = ecm_runner.WorkUnit(1, "1007", ("-v",), "11000", None)
+        output = subprocess.CompletedProcess(["ecm"], 0, BATCH_OUTPUT, "")
+        metrics = ecm_runner.Metrics(threads=2)
+        for result in ecm_runner.process_batch_output(output, 0.1):
+            metrics.observe(wu, result)
+        metrics.set_queue(5, 2)
+
+        lines = dict(line.rsplit(" ", 1) for line in metrics.render().splitlines())
+        self.assertEqual(lines['ecm_runner_curves_total{n="1007"}'], "3")
+        self.assertEqual(lines['ecm_runner_curves_total{B1="11000"}'], "3")
+        self.assertEqual(lines["ecm_runner_queue_depth"], "5")
+        self.assertEqual(lines["ecm_runner_stage1_ms_sum"], "70")
+        self.assertEqual(lines['ecm_runner_stage1_ms_bucket{le="16"}'], "0")
+        self.assertEqual(lines['ecm_runner_stage1_ms_bucket{le="32"}'], "3")
+        self.assertEqual(lines['ecm_runner_stage2_ms_bucket{le="+Inf"}'], "3")
+        # 100ms of wall time vs 100ms reported by ecm
+        self.assertEqual(lines["ecm_runner_overhead_ms_sum"], "0")
+
+
+    def test_memory_model(self):
+        model = ecm_runner.MemoryModel()
+        wu = ecm_runner.WorkUnit(1, N, (), "11000000", "35133391030")
+        base = model.estimate(wu)
+        self.assertGreater(model.estimate(dataclasses.replace(wu, B2="1e12")), base)
+        self.assertGreater(model.estimate(dataclasses.replace(wu, n=N * 4)), base)
+
+        # Expression sizes are learned from ecm's output
+        expr = dataclasses.replace(wu, n="2^1277-1")
+        model.observe_line(expr, "Input number is 2^1277-1 (385 digits)\n")
+        self.assertEqual(model.digits["2^1277-1"], 385)
+        model.observe_line(expr, "Estimated memory usage: 2.50GB\n")
+        self.assertAlmostEqual(model.scale, 2560 / model._raw_estimate(expr))
+
+        # One outlier stops mattering once enough normal runs are seen
+        model = ecm_runner.MemoryModel()
+        raw = model._raw_estimate(wu)
+        model.observe(wu, 10 * raw)
+        self.assertEqual(model.estimate(wu), math.ceil(10 * raw))
+        for _ in range(20):
+            model.observe(wu, 1.5 * raw)
+        self.assertEqual(model.estimate(wu), math.ceil(1.5 * raw))
+        # and it's forgotten after WINDOW runs
+        for _ in range(ecm_runner.MemoryModel.WINDOW):
+            model.observe(wu, 2 * raw)
+        self.assertEqual(sorted(set(model.ratios)), [2])
+
+        # Never below the model
+        model.observe(wu, 0)
+        for _ in range(ecm_runner.MemoryModel.WINDOW):
+            model.observe(wu, raw / 2)
+        self.assertEqual(model.scale, 1.0)
+
+
+    def test_memory_budget(self):
+        async def admit():
+            budget = ecm_runner.MemoryBudget(1000)
+            order = []
+            done = {name: asyncio.Event() for name in "abcd"}
+
+            async def run(name, mb):
+                await budget.acquire(mb)
+                order.append((name, budget.used))
+                await done[name].wait()
+                await budget.release(mb)
+
+            async def settle():
+                # Every task runs until it waits on the budget or its event
+                for _ in range(10):
+                    await asyncio.sleep(0)
+
+            tasks = [asyncio.create_task(run(name, mb))
+                     for name, mb in (("a", 600), ("b", 300), ("c", 500), ("d", 5000))]
+            await settle()
+            self.assertEqual(order, [("a", 600), ("b", 900)])
+
+            done["a"].set()
+            await settle()
+            # c fits next to b, d is larger than the budget and waits to run alone
+            self.assertEqual(order[2:], [("c", 800)])
+
+            done["b"].set()
+            done["c"].set()
+            await settle()
+            self.assertEqual(order[3:], [("d", 5000)])
+
+            done["d"].set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(budget.used, 0)
+
+        asyncio.run(admit())
+
+
+    def test_async_memory_measured(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fn = os.path.join(tmp, "resume.txt")
+            with open(resume_fn, "w") as f:
+                f.write(f"METHOD=ECM; PARAM=1; SIGMA=1; B1=1000; N={N}; X=0x1f;\n")
+            args = runner_args("-r", resume_fn, "--B1", "1000", "--B2", "50000",
+                               "--ram_budget", "4000")
+            runner = ecm_runner.AsyncRunner(args)
+            process_results = ecm_runner.ProcessResults(ecm_runner.get_log_fn(args))
+
+            # ecm's own estimate is 0 so only the measured peak is learned,
+            # it doesn't finish stage 1 before being sampled
+            release_fn = os.path.join(tmp, "release")
+            peak_rss_mb = ecm_runner.peak_rss_mb
+            def sample(pid):
+                mb = peak_rss_mb(pid)
+                if mb > 0:
+                    open(release_fn, "w").close()
+                return mb
+
+            with mock.patch.dict(os.environ, FAKE_ECM_WAIT=release_fn, FAKE_ECM_MEMORY_KB="0"), \
+                    mock.patch.object(ecm_runner, "peak_rss_mb", side_effect=sample):
+                asyncio.run(runner.run(process_results))
+            process_results.close()
+
+            # Peak RSS of the (Python) fake ecm was measured
+            self.assertEqual(len(runner.memory.ratios), 1)
+            self.assertGreater(runner.memory.ratios[0], 0)
+
+
+    def test_async_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fn = os.path.join(tmp, "resume.txt")
+            with open(resume_fn, "w") as f:
+                for i in range(5):
+                    f.write(f"METHOD=ECM; PARAM=1; SIGMA={1000 + i}; B1=1000; N={N}; X=0x1f;\n")
+
+            ecm_runner.async_main_loop(runner_args("-r", resume_fn, "--B2", "50000", "-t", "2"))
+
+            results = read_json_log(resume_fn + ".json.log")
+            self.assertEqual(sorted(result["using"].split("sigma=")[1] for _, result in results),
+                             [f"1:{1000 + i}" for i in range(5)])
+            self.assertTrue(all(result["timings"] == [0, 0] for _, result in results))
+            with open(resume_fn + ".journal") as f:
+                self.assertEqual(sum(line.startswith("C ") for line in f), 5)
+
+
+    def test_async_cancel_on_factor(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            started = os.path.join(tmp, "started")
+            os.mkdir(started)
+            killed_fn = os.path.join(tmp, "killed")
+            # The first ecm finds a factor once the other two are running, they never finish
+            ecm = write_wrapper(os.path.join(tmp, "ecm"), f"""
+import subprocess, time
+try:
+    os.mkdir({os.path.join(tmp, "first")!r})
+except FileExistsError:
+    os.environ.update(FAKE_ECM_STARTED={started!r}, FAKE_ECM_WAIT={os.path.join(tmp, "never")!r})
+    os.execv(sys.executable, [sys.executable, {FAKE_ECM!r}] + sys.argv[1:])
+
+def wait(done):
+    deadline = time.monotonic() + 10
+    while not done() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return done()
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+wait(lambda: len(os.listdir({started!r})) == 2)
+os.environ["FAKE_ECM_FACTOR_RATE"] = "1"
+returncode = subprocess.run([sys.executable, {FAKE_ECM!r}] + sys.argv[1:]).returncode
+# Killed when the factor was printed, not when this ecm exited
+if wait(lambda: not any(alive(int(pid)) for pid in os.listdir({started!r}))):
+    open({killed_fn!r}, "w").close()
+sys.exit(returncode)
+""")
+            log_fn = os.path.join(tmp, "factor")
+            args = runner_args("-N", N, "--B1", "1000", "-t", "3", "--log_name", log_fn)
+            args.ecm_binary = ecm
+            ecm_runner.async_main_loop(args)
+
+            self.assertTrue(os.path.exists(killed_fn))
+            pids = started_pids(started)
+            self.assertEqual(len(pids), 2)
+            self.assertKilled(pids)
+            results = read_json_log(log_fn + ".json.log")
+            self.assertEqual(len(results), 1)
+            self.assertTrue(results[0][1]["factors"])
+
+
+    def test_async_interrupt(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            started = os.path.join(tmp, "started")
+            os.mkdir(started)
+            args = runner_args("-N", N, "--B1", "1000", "-t", "2",
+                               "--log_name", os.path.join(tmp, "interrupt"))
+            runner = ecm_runner.AsyncRunner(args)
+            process_results = ecm_runner.ProcessResults(ecm_runner.get_log_fn(args))
+
+            async def interrupt():
+                task = asyncio.create_task(runner.run(process_results))
+                while len(os.listdir(started)) < 2:
+                    await asyncio.sleep(0.01)
+                # What asyncio.run does on Ctrl-C
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            # ecm never gets past stage 1
+            with mock.patch.dict(os.environ, FAKE_ECM_STARTED=started,
+                                 FAKE_ECM_WAIT=os.path.join(tmp, "never")):
+                asyncio.run(interrupt())
+            process_results.close()
+
+            self.assertEqual((runner.running, runner.curves), (set(), {}))
+            self.assertKilled(started_pids(started))
+            self.assertFalse(os.path.exists(os.path.join(tmp, "interrupt.json.log")))
+
+
+    def test_async_pipeline(self):
+        units = [ecm_runner.WorkUnit(i, N, ("-v",), "1000", "50000") for i in range(6)]
+        runs = []
+        running = {"stage 2": 0, "max stage 2": 0}
+        run_async = ecm_runner.run_async
+
+        async def tracked(wu, env, on_line=None, on_start=None):
+            stage = "stage 2" if wu.resume_line else "stage 1"
+            runs.append((wu.uid, stage, wu.params))
+            if stage == "stage 2":
+                # Its save file was read and removed
+                self.assertFalse([fn for fn in os.listdir(runner.save_dir)
+                                  if fn.startswith(f"{wu.uid}_")])
+                running["stage 2"] += 1
+                running["max stage 2"] = max(running["max stage 2"], running["stage 2"])
+            try:
+                return await run_async(wu, env, on_line, on_start)
+            finally:
+                if stage == "stage 2":
+                    running["stage 2"] -= 1
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.dict(os.environ, FAKE_ECM_STAGE1_MS="50", FAKE_ECM_STAGE2_MS="30"), \
+                mock.patch.object(ecm_runner, "run_async", tracked), \
+                mock.patch.object(ecm_runner, "get_work_units", side_effect=[units, []]):
+            log_fn = os.path.join(tmp, "pipeline")
+            args = runner_args("-N", N, "--B1", "1000", "--B2", "50000", "-t", "3",
+                               "--pipeline", "--stage2_threads", "1", "--log_name", log_fn)
+            runner = ecm_runner.AsyncRunner(args)
+            process_results = ecm_runner.ProcessResults(ecm_runner.get_log_fn(args))
+            asyncio.run(runner.run(process_results))
+            process_results.close()
+
+            # Each curve ran stage 1 with -save then stage 2 from its residue, once
+            self.assertEqual(sorted((uid, stage) for uid, stage, _ in runs),
+                             sorted((wu.uid, stage) for wu in units
+                                    for stage in ("stage 1", "stage 2")))
+            self.assertTrue(all("-save" in params for _, stage, params in runs
+                                if stage == "stage 1"))
+            self.assertEqual(running["max stage 2"], 1)
+            self.assertEqual(runner.in_stage2, 0)
+            # Save files are removed as they're read, and the directory at the end
+            self.assertFalse(os.path.exists(runner.save_dir))
+
+            results = read_json_log(log_fn + ".json.log")
+            self.assertEqual(sorted(wu["uid"] for wu, _ in results), list(range(6)))
+            self.assertEqual({tuple(result["timings"]) for _, result in results}, {(50, 30)})
+            self.assertTrue(all(wu["B2"] == "50000" for wu, _ in results))
+
+
+    def test_async_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ecm = write_wrapper(os.path.join(tmp, "ecm"), """
+sys.stdin.read()
+print("GMP-ECM 7.0.5 [configured with GMP 6.2.1] [ECM]")
+sys.exit(1)
+""")
+            args = runner_args("-N", N, "--B1", "1000", "-t", "2",
+                               "--log_name", os.path.join(tmp, "error"))
+            args.ecm_binary = ecm
+            runner = ecm_runner.AsyncRunner(args)
+            process_results = ecm_runner.ProcessResults(ecm_runner.get_log_fn(args))
+
+            with self.assertRaisesRegex(ValueError, "exit_status"):
+                asyncio.run(runner.run(process_results))
+            process_results.close()
+            self.assertEqual(runner.running, set())
+
+
+    def test_run_async_long_lines(self):
+        # Far over asyncio's default 64 KiB line limit
+        n = "1" + "0" * 99999 + "7"
+        with tempfile.TemporaryDirectory() as tmp:
+            ecm = write_wrapper(os.path.join(tmp, "ecm"), """
+n = sys.stdin.read().strip()
+print(f"Input number is {n} ({len(n)} digits)")
+print("x=0x" + "f" * 300000)
+""")
+            wu = ecm_runner.WorkUnit(1, n, (), "1000", None)
+            lines = []
+            output = asyncio.run(ecm_runner.run_async(wu, ecm_runner.Env(ecm, ()), lines.append))
+
+        self.assertEqual(output.returncode, 0)
+        self.assertEqual(lines, [f"Input number is {n} ({len(n)} digits)\n",
+                                 "x=0x" + "f" * 300000 + "\n"])
+        self.assertEqual(output.stdout, "".join(lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,32 @@
 from ecmdb.ecmserver import EcmServer
 
+import json
 import os
 import logging
 import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+
+def json_log_line(n, B1, B2, timings=(120, 80), sigma=2052817217):
+    """A line like ecm_runner's json_result_format"""
+    wu = {"uid": 1, "n": "(expr)", "params": ["-v"], "B1": str(B1), "B2": None,
+          "resume_line": ""}
+    using = f"Using B1={B1}, B2={B2}, polynomial x^1, sigma=1:{sigma}"
+    output = "\n".join([
+        "GMP-ECM 7.0.5 [configured with GMP 6.2.1] [ECM]",
+        f"Input number is {n} ({len(str(n))} digits)",
+        using,
+        f"Step 1 took {timings[0]}ms",
+        f"Step 2 took {timings[1]}ms",
+    ])
+    result = {"factors": [], "exit_status": 0, "resume_line": "", "using": using,
+              "version": "GMP-ECM 7.0.5 [configured with GMP 6.2.1] [ECM]",
+              "output": output, "timings": list(timings), "runtime": 0.2}
+    return json.dumps([wu, result]) + "\n"
+
 
 class TestEcmServer(unittest.TestCase):
     """EcmServer test cases."""
@@ -68,6 +90,85 @@ class TestEcmServer(unittest.TestCase):
         self.assertEqual(len(numbers), 1)
 
 
+    def test_journal_mode(self):
+        with self.server.cursor() as cur:
+            cur.execute("PRAGMA journal_mode")
+            self.assertEqual(cur.fetchone()[0], "wal")
+
+
+    def test_add_numbers(self):
+        big = 2 ** 127 - 1
+        records = self.server.add_numbers(["37", 370, "37", big])
+
+        self.assertEqual([r['n'] for r in records], ["37", "370", "37", str(big)])
+        self.assertEqual(records[0], records[2])
+        self.assertEqual(records[3]['status'], EcmServer.Status.PRP.value)
+
+        with self.server.cursor() as cur:
+            cur.execute("SELECT count(*) FROM numbers")
+            self.assertEqual(cur.fetchone()[0], 3)
+
+
+    def test_add_numbers_parallel(self):
+        primes = [2 ** 521 - 1, 2 ** 607 - 1]
+        composites = [(2 ** 521 - 1) * (2 ** 607 - 1), 2 ** 1000 + 1]
+
+        with mock.patch.object(EcmServer, "PARALLEL_CLASSIFY_DIGITS", 100):
+            records = self.server.add_numbers(primes + composites, processes=2)
+
+        self.assertEqual([r['status'] for r in records],
+                         [EcmServer.Status.PRP.value] * 2 + [EcmServer.Status.C.value] * 2)
+
+
+    def test_add_numbers_status_cache(self):
+        with self.assertRaises(ValueError):
+            with self.server.transaction() as cur:
+                self.server._add_numbers(cur, [41, 42])
+                raise ValueError("rollback")
+
+        # Numbers tested before the rollback aren't tested again.
+        with mock.patch.object(EcmServer, "_classify", side_effect=AssertionError):
+            records = self.server.add_numbers([41, 42])
+        self.assertEqual([r['status'] for r in records],
+                         [EcmServer.Status.PRP.value, EcmServer.Status.C.value])
+
+
+    def test_record_curves(self):
+        record = self.server.add_number("370")
+        num_id = record['num_id']
+
+        curves = [{"n": "370", "B1": 11000, "B2": 1873422}] * 3
+        curves.append({"num_id": num_id, "B1": 50000, "B2": 12746592,
+                       "stage1_ms": 10, "stage2_ms": 20, "timestamp": 1234})
+        self.assertEqual(self.server.record_curves(curves), 4)
+        self.assertEqual(self.server.record_curves(curves[:1]), 1)
+
+        with self.server.cursor() as cur:
+            cur.execute("SELECT curve_id, B1, stage1_ms, timestamp FROM ecm_curves "
+                        "WHERE num_id = ? ORDER BY curve_id", (num_id,))
+            rows = list(map(tuple, cur.fetchall()))
+
+        self.assertEqual([r[0] for r in rows], [0, 1, 2, 3, 4])
+        self.assertEqual(rows[3][1:], (50000, 10, 1234))
+        self.assertEqual(rows[4][1], 11000)
+
+
+    def test_record_curves_unknown_number(self):
+        with self.assertRaises(ValueError):
+            self.server.record_curves([{"n": "371", "B1": 11000, "B2": 1873422}])
+
+        # Whole batch is rolled back
+        self.server.add_number("370")
+        with self.assertRaises(ValueError):
+            self.server.record_curves([
+                {"n": "370", "B1": 11000, "B2": 1873422},
+                {"n": "371", "B1": 11000, "B2": 1873422},
+            ])
+        with self.server.cursor() as cur:
+            cur.execute("SELECT count(*) FROM ecm_curves")
+            self.assertEqual(cur.fetchone()[0], 0)
+
+
     def test_find_number(self):
         add = self.server.add_number("37")
         find = self.server.find_number(37)
@@ -75,5 +176,380 @@ class TestEcmServer(unittest.TestCase):
         self.assertEqual(add, find)
 
 
+    def test_find_number_index(self):
+        with self.server.cursor() as cur:
+            cur.execute("EXPLAIN QUERY PLAN SELECT num_id FROM numbers WHERE n_digest = ?",
+                        (b"",))
+            plan = " ".join(row['detail'] for row in cur.fetchall())
+        self.assertIn("numbers_n_digest", plan)
+
+
+    def test_find_number_cache(self):
+        self.assertIsNone(self.server.find_number(37))
+        add = self.server.add_number(37)
+        self.assertEqual(self.server.find_number("37"), add)
+
+        # Cache must not hold num_ids from a rolled back transaction.
+        with self.assertRaises(ValueError):
+            with self.server.transaction() as cur:
+                self.server._add_numbers(cur, [41])
+                self.assertIsNotNone(self.server._find_num_id(cur, 41))
+                raise ValueError("rollback")
+        self.assertIsNone(self.server.find_number(41))
+        self.assertEqual(self.server.find_number(37), add)
+
+
+    def test_stats(self):
+        self.assertEqual(self.server.stats(370), [])
+
+        self.server.add_number(370)
+        self.server.record_curves(
+            [{"n": 370, "B1": 11000, "B2": 1873422, "stage1_ms": 10, "stage2_ms": 5}] * 3 +
+            [{"n": 370, "B1": 50000, "B2": 12746592, "stage1_ms": 40, "stage2_ms": 20}])
+        self.server.record_curves(
+            [{"n": 370, "B1": 11000, "B2": 1873422, "stage1_ms": 12, "stage2_ms": 6}])
+
+        stats = [(r['B1'], r['B2'], r['curves'], r['stage1_ms'], r['stage2_ms'])
+                 for r in self.server.stats(370)]
+        self.assertEqual(stats, [
+            (11000, 1873422, 4, 42, 21),
+            (50000, 12746592, 1, 40, 20),
+        ])
+
+        curves = list(self.server.iter_curves(370, batch_size=2))
+        self.assertEqual(len(curves), 5)
+        self.assertEqual(sorted(r['curve_id'] for r in curves), list(range(5)))
+
+        self.server.add_number(371)
+        self.server.record_curves(
+            [{"n": 371, "B1": 11000, "B2": 1873422, "stage1_ms": 10, "stage2_ms": 7}])
+        timings = [tuple(r) for r in self.server.stage2_timings()]
+        self.assertEqual(timings, [
+            (3, 11000, 1873422, 5, 28),
+            (3, 50000, 12746592, 1, 20),
+        ])
+
+
+    def test_import_json_log(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json.log") as log_f:
+            for B1 in (1000, 2000, 3000):
+                log_f.write(json_log_line(2 ** 67 - 1, B1, 50 * B1))
+            log_f.write(json_log_line(370, 11000, 1873422)[:-20])
+            log_f.flush()
+
+            # Partial last line isn't imported
+            self.assertEqual(self.server.import_json_log(log_f.name, chunk_size=2), 3)
+            self.assertEqual(self.server.import_json_log(log_f.name), 0)
+
+            log_f.write(json_log_line(370, 11000, 1873422)[-20:])
+            log_f.flush()
+            self.assertEqual(self.server.import_json_log(log_f.name), 1)
+
+        with self.server.cursor() as cur:
+            cur.execute("SELECT n, B1, B2, stage1_ms, stage2_ms FROM ecm_curves "
+                        "JOIN numbers USING (num_id) ORDER BY B1")
+            rows = list(map(tuple, cur.fetchall()))
+
+        self.assertEqual(rows, [
+            (str(2 ** 67 - 1), 1000, 50000, 120, 80),
+            (str(2 ** 67 - 1), 2000, 100000, 120, 80),
+            (str(2 ** 67 - 1), 3000, 150000, 120, 80),
+            ("370", 11000, 1873422, 120, 80),
+        ])
+
+
+    def test_import_json_log_expression(self):
+        expr = "(2^349-1)/1779973928671"
+        with tempfile.NamedTemporaryFile("w", suffix=".json.log") as log_f:
+            log_f.write(json_log_line(expr, 11000, 1873422))
+            log_f.write(json_log_line("2^349-x", 11000, 1873422))
+            log_f.write(json_log_line(370, 11000, 1873422))
+            log_f.flush()
+
+            # The bad line is skipped (and not read again), the rest imported
+            with self.assertLogs(level="WARNING") as logs:
+                self.assertEqual(self.server.import_json_log(log_f.name), 2)
+            self.assertIn("skipping bad line", logs.output[0])
+            self.assertEqual(self.server.import_json_log(log_f.name), 0)
+
+        n = (2 ** 349 - 1) // 1779973928671
+        self.assertEqual([r['curves'] for r in self.server.stats(n)], [1])
+        self.assertEqual([r['curves'] for r in self.server.stats(370)], [1])
+
+
+    def test_import_resume_file(self):
+        n = 2 ** 89 - 1
+        lines = [
+            f"METHOD=ECM; PARAM=3; SIGMA=1234; B1=11000; N={n}; X=0x1f2e; "
+            "CHECKSUM=1; PROGRAM=GMP-ECM 7.0.5; Y=0x0; X0=0x0; Y0=0x0; "
+            "WHO=test; TIME=Sat Jan  2 11:00:00 2021;\n",
+            f"METHOD=ECM; PARAM=0; SIGMA=5678; B1=11000; N={hex(n)}; X=0x3c4d; "
+            "CHECKSUM=2; PROGRAM=GMP-ECM 7.0.5; X0=0x0; Y0=0x0;\n",
+            "METHOD=P-1; B1=50000; N=370; X=0x5; PROGRAM=GMP-ECM 7.0.5;\n",
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as resume_f:
+            resume_f.writelines(lines)
+            resume_f.flush()
+
+            self.assertEqual(self.server.import_resume_file(resume_f.name, chunk_size=2), 3)
+            self.assertEqual(self.server.import_resume_file(resume_f.name), 0)
+
+        with self.server.cursor() as cur:
+            cur.execute("SELECT n, B1, B2, x, method, param, sigma "
+                        "FROM ecm_curves JOIN numbers USING (num_id) "
+                        "JOIN residues USING (residue_id) ORDER BY sigma")
+            rows = list(map(tuple, cur.fetchall()))
+
+        self.assertEqual(rows, [
+            ("370", 50000, 50000, b"\x05", EcmServer.Method.PM1.value, None, None),
+            (str(n), 11000, 11000, b"\x1f\x2e", EcmServer.Method.ECM.value, 3, "1234"),
+            (str(n), 11000, 11000, b"\x3c\x4d", EcmServer.Method.ECM.value, 0, "5678"),
+        ])
+
+
+    def test_import_resume_file_expression(self):
+        lines = [
+            "METHOD=ECM; PARAM=1; SIGMA=11; B1=11000; N=(2^349-1)/1779973928671; X=0x1f2e;\n",
+            "METHOD=ECM; PARAM=1; SIGMA=12; B1=11000; N=2^349-x; X=0x3c4d;\n",
+            "METHOD=ECM; PARAM=1; SIGMA=13; B1=11000; N=2^127-1; X=0x5;\n",
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as resume_f:
+            resume_f.writelines(lines)
+            resume_f.flush()
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(self.server.import_resume_file(resume_f.name), 2)
+            self.assertEqual(self.server.import_resume_file(resume_f.name), 0)
+
+        for n, sigma in [((2 ** 349 - 1) // 1779973928671, "11"), (2 ** 127 - 1, "13")]:
+            self.assertEqual([r['sigma'] for r in self.server.iter_curves(n)], [sigma])
+
+
+    def test_resume_then_stage2(self):
+        n = 2 ** 89 - 1
+        line = (f"METHOD=ECM; PARAM=1; SIGMA=2052817217; B1=11000; N={n}; X=0x1f2e; "
+                "CHECKSUM=1; PROGRAM=GMP-ECM 7.0.5;\n")
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as resume_f:
+            resume_f.write(line)
+            resume_f.flush()
+            self.assertEqual(self.server.import_resume_file(resume_f.name), 1)
+        self.assertEqual(len(list(self.server.iter_resume_lines())), 1)
+
+        # Stage 2 of the same curve completes the stage 1 row
+        # Importing it again (another log) is a duplicate
+        for imported in (1, 0):
+            with tempfile.NamedTemporaryFile("w", suffix=".json.log") as log_f:
+                log_f.write(json_log_line(n, 11000, 1873422, timings=(0, 80)))
+                log_f.flush()
+                self.assertEqual(self.server.import_json_log(log_f.name), imported)
+
+        stats = [(r['B1'], r['B2'], r['curves'], r['stage2_ms']) for r in self.server.stats(n)]
+        self.assertEqual(stats, [(11000, 1873422, 1, 80)])
+        curves = [(r['B2'], r['residue_id'] is not None) for r in self.server.iter_curves(n)]
+        self.assertEqual(curves, [(1873422, True)])
+        self.assertEqual(list(self.server.iter_resume_lines()), [])
+        self.assertEqual(len(list(self.server.iter_resume_lines(stage2_done=True))), 1)
+
+        # Another curve (sigma) is a new row, a resume line for a finished curve is not
+        self.assertEqual(self.server.record_curves([
+            {"n": n, "B1": 11000, "B2": 11000, "param": 1, "sigma": "2052817217",
+             "stage1_chkpnt": "0x1f2e"},
+            {"n": n, "B1": 11000, "B2": 1873422, "param": 1, "sigma": "42"},
+        ]), 1)
+        self.assertEqual([r['curves'] for r in self.server.stats(n)], [2])
+
+
+    def test_export_resume_file(self):
+        n = 2 ** 89 - 1
+        x = 3 ** 200
+        self.server.add_numbers([n, 370])
+        self.server.record_curves([
+            {"n": n, "B1": 11000, "B2": 11000, "stage1_chkpnt": hex(x), "param": 1,
+             "sigma": "1234"},
+            {"n": n, "B1": 50000, "B2": 50000, "stage1_chkpnt": x, "param": 1, "sigma": "1234"},
+            # Stage 2 already done
+            {"n": n, "B1": 11000, "B2": 1873422, "stage1_chkpnt": "12345"},
+            {"n": 370, "B1": 50000, "B2": 50000, "stage1_chkpnt": "0x5",
+             "method": EcmServer.Method.PM1},
+            # No residue
+            {"n": n, "B1": 11000, "B2": 11000},
+        ])
+
+        # Identical residues are stored once
+        with self.server.cursor() as cur:
+            cur.execute("SELECT count(*) FROM residues")
+            self.assertEqual(cur.fetchone()[0], 3)
+
+        lines = list(self.server.iter_resume_lines(n, B1=11000))
+        self.assertEqual(lines, [
+            f"METHOD=ECM; PARAM=1; SIGMA=1234; B1=11000; N={n}; X={hex(x)}; PROGRAM=ecm-db;\n"])
+        self.assertEqual(len(list(self.server.iter_resume_lines(stage2_done=True))), 4)
+        self.assertEqual(list(self.server.iter_resume_lines(371)), [])
+
+        # Exported file imports back into another database
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, "export.save")
+            self.assertEqual(self.server.export_resume_file(fn, batch_size=1), 3)
+
+            other = EcmServer(os.path.join(tmp, "other.db"))
+            self.assertEqual(other.import_resume_file(fn), 3)
+            self.assertEqual(list(other.iter_resume_lines()), list(self.server.iter_resume_lines()))
+
+
+    def test_record_factors(self):
+        p1, p2, p3 = 1000003, 2 ** 61 - 1, 2 ** 89 - 1
+        n = p1 * p2 * p3
+        C, CF, FF = (EcmServer.Status[s].value for s in ("C", "CF", "FF"))
+        self.server.add_numbers([n])
+        self.server.record_curves([{"n": n, "B1": 11000, "B2": 1873422}] * 3)
+
+        self.assertEqual(self.server.record_factor(n, p1), 1)
+        self.assertEqual(self.server.find_number(n)['status'], CF)
+        self.assertEqual(self.server.find_number(p2 * p3)['status'], C)
+        self.assertFalse(self.server.fully_factored(n))
+        # Already known
+        self.assertEqual(self.server.record_factor(n, p1), 0)
+        with self.assertRaisesRegex(ValueError, "isn't a factor"):
+            self.server.record_factor(n, 7)
+
+        # Cofactor inherits the effort on n
+        self.server.record_curves([{"n": p2 * p3, "B1": 50000, "B2": 12746592}])
+        effort = [tuple(row)[:4] for row in self.server.lineage_effort(p2 * p3)]
+        self.assertEqual(effort, [(EcmServer.Method.ECM.value, 11000, 1873422, 3),
+                                  (EcmServer.Method.ECM.value, 50000, 12746592, 1)])
+        self.assertEqual(len(self.server.lineage_effort(n)), 1)
+        groups = self.server.effort_groups(
+            [self.server.find_number(p2 * p3)['num_id']], inherited=True)
+        self.assertEqual(sorted(group['curves'] for group in groups), [1, 3])
+
+        # Found on n, splits the composite leaf p2 * p3
+        self.assertEqual(self.server.record_factors([(n, p3)]), 1)
+        self.assertEqual([self.server.find_number(x)['status'] for x in (n, p2 * p3)], [FF, FF])
+        self.assertTrue(self.server.fully_factored(n))
+        self.assertTrue(self.server.fully_factored(p1))
+
+        with self.server.cursor() as cur:
+            cur.execute("SELECT count(*) from number_lineage")
+            # n over 4 numbers, p2 * p3 over 2
+            self.assertEqual(cur.fetchone()[0], 6)
+
+
+    def test_record_curves_factors(self):
+        p, q = 1000003, 2 ** 89 - 1
+        self.server.add_numbers([p * q])
+        with tempfile.NamedTemporaryFile("w", suffix=".json.log") as log_f:
+            for sigma, factor in ((1234, p), (5678, 7)):
+                # 7 isn't a divisor, skipped
+                line = json.loads(json_log_line(p * q, 11000, 1873422, sigma=sigma))
+                line[1]["factors"] = [factor]
+                log_f.write(json.dumps(line) + "\n")
+            log_f.flush()
+            self.assertEqual(self.server.import_json_log(log_f.name), 2)
+
+        self.assertTrue(self.server.fully_factored(p * q))
+        self.assertEqual(self.server.find_number(p * q)['status'], EcmServer.Status.FF.value)
+        effort = self.server.lineage_effort(q)
+        self.assertEqual([row['curves'] for row in effort], [2])
+
+
+    def test_record_curves_classify_before_write(self):
+        p, q = 1000003, 2 ** 89 - 1
+        self.server.add_numbers([p * q, 3 * p * q])
+
+        in_write = []
+        write = self.server._write
+        def wrapped_write(*args):
+            in_write.append(True)
+            try:
+                return write(*args)
+            finally:
+                in_write.pop()
+
+        classify = EcmServer._classify
+        large_in_write = []
+        def checked_classify(n):
+            if n > 10 ** 10 and in_write:
+                large_in_write.append(n)
+            return classify(n)
+
+        with mock.patch.object(self.server, "_write", wrapped_write), \
+             mock.patch.object(EcmServer, "_classify", side_effect=checked_classify) as m, \
+             mock.patch.object(EcmServer, "PARALLEL_CLASSIFY_DIGITS", 10):
+            num_id = self.server.find_number(p * q)['num_id']
+            curve = {"num_id": num_id, "B1": 11000, "B2": 1873422, "sigma": 1, "factors": [p]}
+            self.assertEqual(self.server.record_curves([curve]), 1)
+
+            with tempfile.NamedTemporaryFile("w", suffix=".json.log") as log_f:
+                line = json.loads(json_log_line(3 * p * q, 11000, 1873422, sigma=2))
+                line[1]["factors"] = [3 * p]
+                log_f.write(json.dumps(line) + "\n")
+                log_f.flush()
+                self.assertEqual(self.server.import_json_log(log_f.name), 1)
+
+        self.assertIn(mock.call(q), m.call_args_list)
+        self.assertEqual(large_in_write, [])
+        self.assertTrue(self.server.fully_factored(p * q))
+        self.assertEqual(self.server.find_number(q)['status'], EcmServer.Status.PRP.value)
+        self.assertEqual(self.server.find_number(3 * p)['status'], EcmServer.Status.C.value)
+
+
+    def test_concurrent(self):
+        server = EcmServer(self.tmp_path, readers=4)
+        ns = list(range(1000003, 1000003 + 2 * 8, 2))
+        server.add_numbers(ns)
+
+        errors = []
+        def ingest(n):
+            try:
+                for _ in range(20):
+                    server.record_curves([{"n": n, "B1": 11000, "B2": 1873422}] * 5)
+                    server.stats(n)
+                    self.assertIsNotNone(server.find_number(n))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=ingest, args=(n,)) for n in ns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.assertEqual([server.stats(n)[0]['curves'] for n in ns], [100] * len(ns))
+        # Curve ids are still assigned per number without gaps
+        with server.cursor() as cur:
+            cur.execute("SELECT max(curve_id) FROM ecm_curves GROUP BY num_id")
+            self.assertEqual([row[0] for row in cur.fetchall()], [99] * len(ns))
+
+            # Readers are read only
+            with self.assertRaises(sqlite3.OperationalError):
+                cur.execute("DELETE FROM ecm_curves")
+
+        # A failing write doesn't roll back writes committed with it
+        with self.assertRaises(ValueError):
+            server.record_curves([{"n": "371", "B1": 11000, "B2": 1873422}])
+        self.assertEqual(server.record_curves([{"n": ns[0], "B1": 1, "B2": 1}]), 1)
+        self.assertEqual(len(server.stats(ns[0])), 2)
+
+        # Writes queued behind a running transaction are committed together
+        writer = server._writer
+        commits, writes = writer.commits, writer.writes
+        record = lambda: server.record_curves([{"n": ns[1], "B1": 1, "B2": 1}])
+        with server._write_lock:
+            threads = [threading.Thread(target=record)]
+            threads[0].start()
+            while writer.queue.qsize() or not threads[0].is_alive():
+                time.sleep(0.001)
+            threads += [threading.Thread(target=record) for _ in range(3)]
+            for thread in threads[1:]:
+                thread.start()
+            while writer.queue.qsize() < 3:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        self.assertEqual((writer.commits - commits, writer.writes - writes), (2, 4))
+        self.assertEqual(server.stats(ns[1])[0]['curves'], 4)
+        server.close()
+
+
 if __name__ == '__main__':
     unittest.main()
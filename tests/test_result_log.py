@@ -0,0 +1,103 @@
+from client import ecm_runner
+from client import result_log
+from ecmdb.ecmserver import EcmServer
+
+import logging
+import os
+import tempfile
+import unittest
+
+
+def result(n, sigma, factors=()):
+    using = f"Using B1=11000, B2=1873422, polynomial x^1, sigma=1:{sigma}"
+    version = "GMP-ECM 7.0.5 [configured with GMP 6.2.1] [ECM]"
+    return ecm_runner.EcmOutput(
+        factors=factors,
+        exit_status=2 if factors else 0,
+        resume_line="",
+        using=using,
+        version=version,
+        output=f"{version}\nInput number is {n} ({len(str(n))} digits)\n{using}\nStep 1 took 30ms\n",
+        timings=(30, 20),
+        runtime=0.05,
+        sigma=f"1:{sigma}")
+
+
+class TestResultLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, "test.rlog")
+        self.wu = ecm_runner.WorkUnit(7, "(10^51+7)", ("-v",), "11000", None)
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def test_round_trip(self):
+        n = 10 ** 51 + 7
+        writer = result_log.ResultLogWriter(self.fn, block_records=4)
+        for i in range(10):
+            writer.write(self.wu, result(n, i, (17,) if i == 5 else ()))
+        writer.close()
+
+        blocks = list(result_log.read_blocks(self.fn))
+        self.assertEqual([len(records) for _, records in blocks], [4, 4, 2])
+        self.assertEqual(blocks[-1][0], os.path.getsize(self.fn))
+
+        records = list(result_log.iter_records(self.fn))
+        self.assertEqual([r.sigma for r in records], [f"1:{i}" for i in range(10)])
+        self.assertEqual(records[0].n, "(10^51+7)")
+        self.assertIsNone(records[0].B2)
+        self.assertEqual(records[0].input_number, str(n))
+        self.assertEqual((records[0].step1_ms, records[0].step2_ms), (30, 20))
+
+        # Output is only kept for the curve with a factor
+        self.assertEqual([r.factors for r in records if r.output], [(17,)])
+
+        # Resume after the first block
+        self.assertEqual(
+            sum(len(records) for _, records in result_log.read_blocks(self.fn, blocks[0][0])), 6)
+
+
+    def test_append_after_partial_block(self):
+        writer = result_log.ResultLogWriter(self.fn, block_records=2)
+        for i in range(4):
+            writer.write(self.wu, result(1007, i))
+        writer.close()
+
+        # Crash part way through writing a block
+        with open(self.fn, "ab") as f:
+            f.write(b"\x10\x00\x00\x00\x02\x00")
+        self.assertEqual(len(list(result_log.iter_records(self.fn))), 4)
+
+        writer = result_log.ResultLogWriter(self.fn)
+        writer.write(self.wu, result(1007, 4))
+        writer.close()
+        self.assertEqual(len(list(result_log.iter_records(self.fn))), 5)
+
+
+    def test_import(self):
+        writer = result_log.ResultLogWriter(self.fn, block_records=3)
+        for i in range(5):
+            writer.write(self.wu, result(10 ** 51 + 7, i))
+        writer.flush()
+
+        logging.basicConfig(level=logging.ERROR)
+        server = EcmServer(os.path.join(self.tmp.name, "test.db"))
+        logging.basicConfig(level=logging.WARN)
+
+        self.assertEqual(server.import_result_blocks(self.fn, result_log.read_json_blocks), 5)
+        self.assertEqual(server.import_result_blocks(self.fn, result_log.read_json_blocks), 0)
+
+        writer.write(self.wu, result(10 ** 51 + 7, 5))
+        writer.close()
+        self.assertEqual(server.import_result_blocks(self.fn, result_log.read_json_blocks), 1)
+
+        stats = [(r['B1'], r['B2'], r['curves']) for r in server.stats(10 ** 51 + 7)]
+        self.assertEqual(stats, [(11000, 1873422, 6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
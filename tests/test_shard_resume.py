@@ -0,0 +1,139 @@
+from tools import shard_resume
+
+import collections
+import contextlib
+import io
+import math
+import os
+import random
+import tempfile
+import unittest
+
+
+RESUME_LINE = "METHOD=ECM; PARAM=1; SIGMA={sigma}; B1={B1}; N={N}; X=0x1; CHECKSUM=1; PROGRAM=GMP-ECM 7.0.5;\n"
+
+
+class TestShardResume(unittest.TestCase):
+
+    def test_cost_model_unfitted(self):
+        model = shard_resume.CostModel({})
+        self.assertFalse(model.fitted)
+        # Relative cost from the prior exponents
+        self.assertAlmostEqual(model.ms(2e6, None, 200) / model.ms(1e6, None, 100),
+                               2 ** (shard_resume.PRIOR_B2 + shard_resume.PRIOR_DIGITS))
+
+
+    def test_cost_model_single_group(self):
+        model = shard_resume.CostModel({(100, 10 ** 6, 10 ** 9): (10, 5000)})
+        self.assertTrue(model.fitted)
+        self.assertEqual(model.ratio, 1000)
+        self.assertAlmostEqual(model.b, shard_resume.PRIOR_B2)
+        self.assertAlmostEqual(model.d, shard_resume.PRIOR_DIGITS)
+        self.assertAlmostEqual(model.ms(10 ** 6, 10 ** 9, 100), 500)
+        self.assertAlmostEqual(model.ms(10 ** 6, None, 100), 500)
+
+
+    def test_cost_model_fit(self):
+        def ms(B2, digits):
+            return 1e-3 * B2 ** 0.5 * digits ** 2
+
+        groups = {}
+        for digits in (100, 150, 200, 300):
+            for B1 in (10 ** 5, 10 ** 6, 10 ** 7):
+                B2 = 100 * B1
+                groups[(digits, B1, B2)] = (1000, 1000 * ms(B2, digits))
+        # A few curves with a different ratio
+        groups[(100, 10 ** 6, 10 ** 10)] = (10, 10 * ms(10 ** 10, 100))
+
+        model = shard_resume.CostModel(groups)
+        self.assertEqual(model.ratio, 100)
+        self.assertAlmostEqual(model.b, 0.5, places=2)
+        self.assertAlmostEqual(model.d, 2, places=2)
+        self.assertAlmostEqual(model.ms(10 ** 6, 10 ** 8, 200) / ms(10 ** 8, 200), 1, places=1)
+
+
+    def test_shard(self):
+        rand = random.Random(11)
+        model = shard_resume.CostModel({})
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fns = [os.path.join(tmp, f"resume_{i}.txt") for i in range(2)]
+            lines = []
+            costs = {}
+            for fn in resume_fns:
+                with open(fn, "w") as f:
+                    for sigma in range(500):
+                        B1 = rand.choice([10 ** 5, 10 ** 6, 3 * 10 ** 6])
+                        N = rand.choice([10 ** 60 + 7, 10 ** 90 + 7, hex(10 ** 120 + 7)])
+                        line = RESUME_LINE.format(sigma=sigma, B1=B1, N=N)
+                        digits = shard_resume.line_digits(str(N).encode())
+                        costs[line] = model.ms(B1, None, digits)
+                        lines.append(line)
+                        f.write(line)
+                    # Not dropped even though they can't be costed
+                    for line in ("# comment\n", "METHOD=ECM; N=17; X=0x1;\n"):
+                        costs[line] = 0
+                        lines.append(line)
+                        f.write(line)
+
+            prefix = os.path.join(tmp, "shard")
+            args = shard_resume.get_argparser().parse_args(
+                ["-k", "3", "--output_prefix", prefix] + resume_fns)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                shard_resume.shard(args, model, None)
+            self.assertIn("4 lines without N= and B1=", out.getvalue())
+
+            shards = []
+            for i in range(3):
+                with open(f"{prefix}.{i}") as f:
+                    shards.append(f.readlines())
+
+        # Every line in exactly one shard
+        self.assertEqual(collections.Counter(line for s in shards for line in s),
+                         collections.Counter(lines))
+
+        # Greedy assignment keeps shards within one line's cost of each other
+        loads = [math.fsum(costs[line] for line in s) for s in shards]
+        self.assertLessEqual(max(loads) - min(loads), max(costs.values()))
+        self.assertLess(max(loads) / min(loads), 1.05)
+
+
+    def test_shard_expressions(self):
+        self.assertEqual(shard_resume.line_digits(b"2^1277-1"), 385)
+        self.assertEqual(shard_resume.line_digits(b"(2^349-1)/1779973928671"), 93)
+        with self.assertRaises(ValueError):
+            shard_resume.line_digits(b"2^x-1")
+
+        model = shard_resume.CostModel({})
+        numbers = {"2^1277-1": 2 ** 1277 - 1, "3*10^200+1": 3 * 10 ** 200 + 1,
+                   str(10 ** 60 + 7): 10 ** 60 + 7}
+        with tempfile.TemporaryDirectory() as tmp:
+            resume_fn = os.path.join(tmp, "resume.txt")
+            costs = {}
+            with open(resume_fn, "w") as f:
+                for sigma in range(600):
+                    N = list(numbers)[sigma % 3]
+                    line = RESUME_LINE.format(sigma=sigma, B1=10 ** 6, N=N)
+                    costs[line] = model.ms(10 ** 6, None, len(str(numbers[N])))
+                    f.write(line)
+                line = RESUME_LINE.format(sigma=0, B1=10 ** 6, N="2^x-1")
+                costs[line] = 0
+                f.write(line)
+
+            prefix = os.path.join(tmp, "shard")
+            args = shard_resume.get_argparser().parse_args(
+                ["-k", "4", "--output_prefix", prefix, resume_fn])
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                shard_resume.shard(args, model, None)
+            self.assertIn("1 lines without N= and B1=", out.getvalue())
+
+            loads = []
+            for i in range(4):
+                with open(f"{prefix}.{i}") as f:
+                    loads.append(math.fsum(costs[line] for line in f))
+
+        # 2^1277-1 costs as 385 digits, not as the 8 characters of the expression
+        self.assertLessEqual(max(loads) - min(loads), max(costs.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from ecmdb.ecmserver import EcmServer
+from ecmdb import tlevel
+
+import logging
+import tempfile
+import unittest
+
+import numpy as np
+
+
+class TestTLevel(unittest.TestCase):
+    """t-level and probability test cases."""
+
+    def test_dickman_rho(self):
+        rho = tlevel.dickman_rho([0.5, 1, 2, 3, 4, 10])
+        expected = [1, 1, 0.3068528194, 0.0486083883, 0.0049109256, 2.77017183e-11]
+        np.testing.assert_allclose(rho, expected, rtol=1e-3)
+
+
+    def test_expected_curves(self):
+        # GMP-ECM 7 -v reports roughly these for the recommended bounds.
+        curves = tlevel.expected_curves(
+            [11e3, 1e6, 11e6], [1873422, 1045563762, 35133391030], [20, 35, 45])
+        np.testing.assert_allclose(curves, [74, 904, 4480], rtol=0.15)
+
+        # No stage 2 (B2 = B1) is always worse.
+        self.assertGreater(tlevel.expected_curves(1e6, 1e6, 35), curves[1])
+
+
+    def test_t_levels(self):
+        curves_t35 = tlevel.expected_curves(1e6, 1045563762, 35)
+        levels = tlevel.t_levels(
+            [0, 1, 1, 2],
+            [1e6, 1e6, 11e3, 11e3],
+            [1045563762, 1045563762, 1873422, 1873422],
+            [curves_t35, 2 * curves_t35, 100, 1],
+            count=4)
+
+        self.assertAlmostEqual(levels[0], 35, places=1)
+        self.assertGreater(levels[1], levels[0])
+        self.assertLess(levels[2], 20)
+        self.assertEqual(levels[3], 0)
+
+        found = tlevel.factor_found_probability([0], [1e6], [1045563762], [curves_t35], 35)
+        self.assertAlmostEqual(found[0, 0], 1 - np.exp(-1), places=3)
+
+
+    def test_server_t_levels(self):
+        with tempfile.NamedTemporaryFile() as tmp_f:
+            logging.basicConfig(level=logging.ERROR)
+            server = EcmServer(tmp_f.name)
+
+            n = 2 ** 521 + 1
+            server.add_numbers([n, 370])
+            server.record_curves([{"n": n, "B1": 11000, "B2": 1873422}] * 74)
+
+            levels = tlevel.server_t_levels(server, [n, 370, 371])
+            self.assertEqual(set(levels), {str(n), "370"})
+            self.assertAlmostEqual(levels[str(n)], 20, delta=0.5)
+            self.assertEqual(levels["370"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
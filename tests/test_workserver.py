@@ -0,0 +1,202 @@
+from client import ecm_runner
+from ecmdb.ecmserver import EcmServer
+from ecmdb.workserver import WorkServer
+from tools import upload_results
+
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+
+def ecm_output(n, B1, B2, sigma=2052817217):
+    using = f"Using B1={B1}, B2={B2}, polynomial x^1, sigma=1:{sigma}"
+    return ecm_runner.EcmOutput(
+        factors=tuple(),
+        exit_status=0,
+        resume_line="",
+        using=using,
+        version="GMP-ECM 7.0.5 [configured with GMP 6.2.1] [ECM]",
+        output=f"Input number is {n} ({len(str(n))} digits)\n{using}\n",
+        timings=(100, 50),
+        runtime=0.2)
+
+
+class TestWorkServer(unittest.TestCase):
+    """WorkServer test cases, against a localhost instance."""
+
+    def setUp(self):
+        self.tmp_f = tempfile.NamedTemporaryFile()
+
+        logging.basicConfig(level=logging.ERROR)
+        self.server = EcmServer(self.tmp_f.name, readers=2)
+
+        self.httpd = WorkServer(("127.0.0.1", 0), self.server, lease_seconds=3600)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+        host, port = self.httpd.server_address
+        self.client = ecm_runner.WorkClient(f"http://{host}:{port}")
+
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self.server.close()
+
+
+    def test_lease_and_upload(self):
+        n = 2 ** 89 + 1
+        wu_ids = self.server.add_work(n, 11000, 1873422, count=5)
+        self.assertEqual(len(wu_ids), 5)
+
+        units = self.client.lease(3)
+        self.assertEqual([wu.uid for wu in units], wu_ids[:3])
+        self.assertEqual(units[0].n, str(n))
+        self.assertEqual((units[0].B1, units[0].B2), ("11000", "1873422"))
+
+        # Leased units aren't handed out again.
+        self.assertEqual([wu.uid for wu in self.client.lease(10)], wu_ids[3:])
+        self.assertEqual(self.client.lease(10), [])
+
+        results = [(wu, ecm_output(n, 11000, 1873422, sigma=1000 + wu.uid)) for wu in units]
+        self.assertEqual(self.client.upload(results), 3)
+
+        self.assertEqual(self.server.work_status(), {"QUEUED": 0, "LEASED": 2, "DONE": 3})
+        stats = self.server.stats(n)
+        self.assertEqual((stats[0]['B1'], stats[0]['curves']), (11000, 3))
+
+
+    def test_upload_retry(self):
+        n = 2 ** 89 + 1
+        self.server.add_work(n, 11000, 1873422, count=4)
+        units = self.client.lease(4)
+        results = [(wu, ecm_output(n, 11000, 1873422, sigma=1000 + wu.uid)) for wu in units]
+
+        # A transient error is retried
+        urlopen = urllib.request.urlopen
+        errors = [urllib.error.URLError("connection refused")]
+        def flaky(*args, **kwargs):
+            if errors:
+                raise errors.pop()
+            return urlopen(*args, **kwargs)
+        with mock.patch.object(ecm_runner.WorkClient, "RETRY_SECONDS", 0), \
+                mock.patch.object(urllib.request, "urlopen", flaky):
+            self.assertEqual(self.client.upload(results[:2]), 2)
+
+        # Repeating an upload (e.g. the response was lost) doesn't record curves twice
+        self.assertEqual(self.client.upload(results[:2]), 0)
+        self.assertEqual(self.server.stats(n)[0]['curves'], 2)
+
+        # Results are kept while the server is down and saved on close
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(ecm_runner.WorkClient, "RETRY_SECONDS", 0):
+            log_fn = os.path.join(tmp, "r.log")
+            down = ecm_runner.WorkClient("http://127.0.0.1:1")
+            process_results = ecm_runner.ProcessResults(log_fn, down, upload_batch=1)
+            for wu, result in results[2:]:
+                process_results.process(wu, result)
+                process_results.finished(wu)
+            self.assertEqual(len(process_results.pending), 2)
+            self.assertEqual(process_results.upload_failures, 1)
+            process_results.close()
+
+            unsent = os.path.join(tmp, "r.unsent.json.log")
+            self.assertEqual(upload_results.upload_log(self.client, unsent, batch=1), 2)
+            self.assertEqual(upload_results.upload_log(self.client, unsent, batch=1), 0)
+
+            # The local log has everything
+            with open(os.path.join(tmp, "r.json.log")) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+        self.assertEqual(self.server.work_status()["DONE"], 4)
+        self.assertEqual(self.server.stats(n)[0]['curves'], 4)
+
+
+    def test_lease_backoff(self):
+        n = 10 ** 51 + 7
+        wu_ids = self.server.add_work(n, 1000, 50000, count=2)
+
+        requests = []
+        def down(request, *args, **kwargs):
+            requests.append(request.full_url)
+            raise urllib.error.URLError("connection refused")
+        with mock.patch.object(ecm_runner.WorkClient, "RETRY_SECONDS", 0), \
+                mock.patch.object(urllib.request, "urlopen", down):
+            self.assertIsNone(self.client.lease(2))
+            # The server isn't asked again until the backoff is over
+            self.assertIsNone(self.client.lease(2))
+            self.assertEqual(len(requests), ecm_runner.WorkClient.ATTEMPTS)
+            self.assertGreater(self.client.lease_wait(), 0)
+
+            self.client.next_lease = 0
+            self.assertIsNone(self.client.lease(2))
+            self.assertGreater(self.client.lease_wait(), ecm_runner.WorkClient.LEASE_BACKOFF)
+
+        self.client.next_lease = 0
+        self.assertEqual([wu.uid for wu in self.client.lease(2)], wu_ids)
+        self.assertEqual(self.client.lease_failures, 0)
+
+        # Both runners wait out a failed lease instead of stopping
+        post = ecm_runner.WorkClient._post
+        failures = []
+        def flaky(client, path, obj):
+            if path == "/lease" and failures:
+                raise failures.pop()
+            return post(client, path, obj)
+        fake_ecm = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ecm.py")
+        for main_loop, mode in [(ecm_runner.async_main_loop, ["--asyncio"]),
+                                (ecm_runner.main_loop, [])]:
+            self.server.add_work(n, 1000, 50000)
+            failures.append(urllib.error.URLError("connection refused"))
+            with tempfile.TemporaryDirectory() as tmp, \
+                    mock.patch.object(ecm_runner.WorkClient, "_post", flaky), \
+                    mock.patch.object(ecm_runner.WorkClient, "LEASE_BACKOFF", 0.01):
+                args = ecm_runner.get_argparser().parse_args(
+                    ["-b", fake_ecm, "-s", self.client.url, "-t", "1",
+                     "--log_name", os.path.join(tmp, "lease")] + mode)
+                main_loop(args)
+            self.assertEqual(failures, [])
+            self.assertEqual(self.server.work_status()["QUEUED"], 0)
+        self.assertEqual(self.server.stats(n)[0]['curves'], 2)
+
+
+    def test_expired_lease_requeued(self):
+        wu_ids = self.server.add_work(370, 11000, count=2)
+
+        self.httpd.lease_seconds = -1
+        self.assertEqual(len(self.client.lease(2)), 2)
+
+        # Expired leases are requeued on the next lease.
+        self.httpd.lease_seconds = 3600
+        units = self.client.lease(10)
+        self.assertEqual([wu.uid for wu in units], wu_ids)
+        self.assertIsNone(units[0].B2)
+
+
+    def test_concurrent_leases(self):
+        wu_ids = self.server.add_work(370, 11000, count=100)
+
+        leased = []
+        def lease():
+            for _ in range(5):
+                leased.extend(wu.uid for wu in self.client.lease(3))
+
+        threads = [threading.Thread(target=lease) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each unit is leased once
+        self.assertEqual(sorted(leased), wu_ids[:len(leased)])
+        self.assertEqual(len(leased), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
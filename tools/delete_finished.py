@@ -1,80 +1,152 @@
-"""Removes lines from a partial file that have already been processed in a ecm_runner_X.log file."""
+"""Removes lines from resume files that have already been processed in ecm_runner_X.log files."""
 
 import argparse
+import os
 import re
 import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client import ecm_output
+from client import result_log
+
+
+# First "Input number is N (D digits)" in a text or json log line, N can be an expression.
+RE_INPUT_NUMBER = re.compile(rb"Input number is (.+?) \([0-9]+ digits\)")
+
+BUFFER_SIZE = 1 << 20
 
 
 def get_argparser():
-    parser = argparse.ArgumentParser(description='delete finished lines from a resume file.')
+    parser = argparse.ArgumentParser(description='delete finished lines from resume files.')
     parser.add_argument('-n', '--dry-run', action='store_true',
                         help="Dry Run, don't save file")
-    parser.add_argument('resume_file', type=str,
-                        help='resume file, finished lines will be deleted from this file.')
-    parser.add_argument('log_file', type=str,
-                        help='log file to serach for finished results.')
+    parser.add_argument('-i', '--in-place', action='store_true',
+                        help="replace the resume files instead of writing <resume_file>.filtered")
+    parser.add_argument('files', type=str, nargs='+',
+                        help=('resume files followed by log files (*.log, *.json.log or *.rlog) '
+                              'to search for finished results.'))
     return parser
 
 
-def read_log(fn):
-  INPUT_MATCH = re.compile(r"^Input number is (.*) \([0-9]+ digits\)$")
+def normalize_number(N):
+  """ecm_output.normalize_number of bytes N, as bytes"""
+  return ecm_output.normalize_number(N.decode()).encode()
+
+
+def read_logs(fns):
+  """Set of finished N (see normalize_number, as bytes) from text, json or binary logs"""
   finished = set()
-  with open(fn) as f:
-    for line in f:
-      if line.startswith("Input number is"):
-        match = INPUT_MATCH.match(line)
-        assert match
-        N = match.group(1)
-        finished.add(N)
-  return sorted(finished)
-
-
-def N_matches(line, finished):
-  match = re.search("N=([^;]*);", line)
-  if match:
+  for fn in fns:
+    lines = 0
+    t0 = time.time()
+    if fn.endswith(".rlog"):
+      for record in result_log.iter_records(fn):
+        lines += 1
+        if record.input_number:
+          finished.add(normalize_number(record.input_number.encode()))
+      t1 = time.time()
+      print(f"Read {lines} records from {fn!r} ({lines / max(t1 - t0, 1e-6):.0f} records/sec)")
+      continue
+
+    with open(fn, "rb", buffering=BUFFER_SIZE) as f:
+      for line in f:
+        lines += 1
+        # Text logs have the output on its own lines, json logs one result per line.
+        if b"Input number is" in line:
+          match = RE_INPUT_NUMBER.search(line)
+          if not match:
+            print(f"Skipping unparsed line {lines} in {fn!r}: {line[:200]!r}")
+            continue
+          finished.add(normalize_number(match.group(1)))
+    t1 = time.time()
+    print(f"Read {lines} lines from {fn!r} ({lines / max(t1 - t0, 1e-6):.0f} lines/sec)")
+  return finished
+
+
+class FinishedFilter:
+  """Matches resume lines against finished N, each distinct N is normalized once."""
+
+  def __init__(self, finished):
+    self.finished = finished
+    # raw N from a resume line -> finished
+    self.seen = {}
+
+
+  def __call__(self, line):
+    match = ecm_output.RE_RESUME_N_BYTES.search(line)
+    if not match:
+      return False
+
     N = match.group(1)
-    if N in finished:
-      return True
-    if N.startswith("0x") and str(int(N, 16)) in finished:
-      return True
-  return False
+    is_finished = self.seen.get(N)
+    if is_finished is None:
+      is_finished = self.seen[N] = normalize_number(N) in self.finished
+    return is_finished
 
 
-def remove_matched(args, result_fn, finished):
+def remove_matched(args, resume_fn, result_fn, is_finished):
   saved = 0
   filtered = 0
 
   should_save = not args.dry_run
+  t0 = time.time()
 
-  with open(args.resume_file) as f:
-    if should_save:
-      print(f"Saving filtered results to {result_fn!r}")
-      copy_f =  open(result_fn, "w")
-
-    for line in f:
-      if N_matches(line, finished):
-        filtered += 1
-        continue
-
-      saved += 1
-      if should_save:
-        copy_f.write(line)
-
+  copy_f = None
   if should_save:
+    print(f"Saving filtered results to {result_fn!r}")
+    # Written next to the result so the rename is atomic
+    fd, tmp_fn = tempfile.mkstemp(
+        prefix=os.path.basename(result_fn) + ".", suffix=".tmp",
+        dir=os.path.dirname(os.path.abspath(result_fn)))
+    copy_f = os.fdopen(fd, "wb", buffering=BUFFER_SIZE)
+
+  try:
+    with open(resume_fn, "rb", buffering=BUFFER_SIZE) as f:
+      for line in f:
+        if is_finished(line):
+          filtered += 1
+          continue
+
+        saved += 1
+        if copy_f:
+          copy_f.write(line)
+
+    if copy_f:
+      copy_f.flush()
+      os.fsync(copy_f.fileno())
+      copy_f.close()
+      os.replace(tmp_fn, result_fn)
+  except:
+    if copy_f:
       copy_f.close()
+      os.remove(tmp_fn)
+    raise
 
+  t1 = time.time()
   n = saved + filtered
-  print(f"Removed {filtered}/{n} finished results, {saved}/{n} remaining lines")
+  print(f"Removed {filtered}/{n} finished results, {saved}/{n} remaining lines "
+        f"({n / max(t1 - t0, 1e-6):.0f} lines/sec)")
 
 
 def main(args):
-  finished = read_log(args.log_file)
+  log_fns = [fn for fn in args.files if fn.endswith((".log", ".rlog"))]
+  resume_fns = [fn for fn in args.files if not fn.endswith((".log", ".rlog"))]
+  if not log_fns or not resume_fns:
+    print("Need at least one resume file and one log file")
+    sys.exit(1)
+
+  finished = read_logs(log_fns)
   if not finished:
-    print(f"No finished results in {args.log_file!r}")
-    exit(1)
+    print(f"No finished results in {log_fns}")
+    sys.exit(1)
 
-  new_name = args.resume_file + ".filtered"
-  remove_matched(args, new_name, finished)
+  is_finished = FinishedFilter(finished)
+  for resume_fn in resume_fns:
+    new_name = resume_fn if args.in_place else resume_fn + ".filtered"
+    remove_matched(args, resume_fn, new_name, is_finished)
 
 
 
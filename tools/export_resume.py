@@ -0,0 +1,42 @@
+"""Writes stage 1 residues stored in an ecm-db database as a GMP-ECM resume file."""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ecmdb.ecmserver import EcmServer
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='export stored residues for ecm -resume.')
+    parser.add_argument('--db', default='./ecm-server.db',
+                        help='database file')
+    parser.add_argument('-n', '-N', help='only residues of this number')
+    parser.add_argument('--B1', '--b1', help='only residues with this stage 1 bound')
+    parser.add_argument('--stage2_done', action='store_true',
+                        help='include curves that already ran stage 2')
+    parser.add_argument('resume_file', type=str,
+                        help='resume file to write')
+    return parser
+
+
+def main(args):
+    server = EcmServer(args.db)
+
+    t0 = time.time()
+    count = server.export_resume_file(
+        args.resume_file, expr=args.n,
+        B1=int(float(args.B1)) if args.B1 else None,
+        stage2_done=args.stage2_done)
+    t1 = time.time()
+    print(f"Wrote {count} resume lines to {args.resume_file!r} in {t1 - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,57 @@
+"""Imports ecm_runner results into an ecm-db database."""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client import result_log
+from ecmdb.ecmserver import EcmServer
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='import ecm_runner results into ecm-db.')
+    parser.add_argument('--db', default='./ecm-server.db',
+                        help='database file')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='keep importing new lines as the logs grow')
+    parser.add_argument('--interval', type=float, default=30,
+                        help='seconds between imports with --follow')
+    parser.add_argument('log_files', type=str, nargs='+',
+                        help='ecm_runner .json.log or .rlog files or GMP-ECM resume files')
+    return parser
+
+
+def import_all(server, log_files):
+    total = 0
+    for fn in log_files:
+        t0 = time.time()
+        if fn.endswith(".json.log"):
+            count = server.import_json_log(fn)
+        elif fn.endswith(".rlog"):
+            count = server.import_result_blocks(fn, result_log.read_json_blocks)
+        else:
+            count = server.import_resume_file(fn)
+        t1 = time.time()
+        if count:
+            print(f"Imported {count} curves from {fn!r} in {t1 - t0:.1f}s")
+        total += count
+    return total
+
+
+def main(args):
+    server = EcmServer(args.db)
+
+    import_all(server, args.log_files)
+    while args.follow:
+        time.sleep(args.interval)
+        import_all(server, args.log_files)
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,239 @@
+"""Splits resume files into shards with equal estimated stage 2 time.
+
+Stage 2 time per curve is modeled as
+
+    ms = exp(c) * B2^b * digits^d
+
+fit (weighted least squares in log space) to past timings from ecm_runner
+.json.log files and/or an ecm-db database. Exponents are pulled towards
+typical values so one or two distinct (B2, digits) groups still give a
+usable model, with no timings at all only relative costs are known.
+
+Lines are streamed and each goes to the currently least loaded shard, memory
+use doesn't depend on the size of the input. Every input line ends up in
+exactly one shard, lines without N= and B1= count as no cost. N can be
+decimal, hex or an input expression like 2^1277-1.
+"""
+
+import argparse
+import functools
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client import ecm_output
+from ecmdb.ecmserver import EcmServer
+
+
+RE_RESUME_B1 = re.compile(rb"(?:^|[; ])B1=([0-9]+);")
+RE_INPUT_DIGITS = re.compile(r"Input number is [0-9]+ \(([0-9]+) digits\)")
+
+# Prior exponents of B2 and digits, stage 2 is about sqrt(B2) steps of
+# multiplications that grow a bit faster than linearly with size.
+PRIOR_B2 = 0.55
+PRIOR_DIGITS = 1.6
+# Weight (in curves) of the prior exponents against the data.
+PRIOR_WEIGHT = 10
+
+BUFFER_SIZE = 1 << 20
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='split resume files into equal cost shards.')
+    parser.add_argument('-k', '--shards', type=int, required=True,
+                        help='number of shards to write')
+    parser.add_argument('--B2', '--b2',
+                        help='B2 the shards will be run with (default: B2/B1 seen in timings)')
+    parser.add_argument('--db',
+                        help='ecm-db database with past stage 2 timings')
+    parser.add_argument('--log', action='append', default=[],
+                        help='ecm_runner .json.log with past timings (repeatable)')
+    parser.add_argument('--output_prefix',
+                        help='shards are written to <prefix>.<i>, default first resume file')
+    parser.add_argument('resume_files', type=str, nargs='+',
+                        help='GMP-ECM resume files')
+    return parser
+
+
+def log_timings(fn):
+    """(digits, B1, B2) -> [curves, stage2_ms] from an ecm_runner .json.log"""
+    groups = defaultdict(lambda: [0, 0])
+    with open(fn) as f:
+        for line in f:
+            try:
+                wu, result = json.loads(line)
+            except ValueError:
+                # Partial last line of a running log
+                continue
+            stage2_ms = result['timings'][1]
+            bounds = ecm_output.RE_USING_BOUNDS.search(result['using'])
+            digits = RE_INPUT_DIGITS.search(result['output'])
+            if stage2_ms <= 0 or not bounds or not digits:
+                continue
+            group = groups[(int(digits.group(1)), int(bounds.group(1)), int(bounds.group(2)))]
+            group[0] += 1
+            group[1] += stage2_ms
+    return groups
+
+
+class CostModel:
+    """Estimated stage 2 ms per curve from B2 and digits."""
+
+    def __init__(self, groups):
+        """groups: {(digits, B1, B2): (curves, stage2_ms)}"""
+        self.c, self.b, self.d = 0.0, PRIOR_B2, PRIOR_DIGITS
+        self.ratio = None
+        # Without timings ms() is only a relative cost
+        self.fitted = bool(groups)
+        if not groups:
+            return
+
+        keys = np.array(list(groups.keys()), dtype=np.float64)
+        values = np.array(list(groups.values()), dtype=np.float64)
+        digits, B1, B2 = keys.T
+        curves, stage2_ms = values.T
+
+        # Fit the residual from the prior exponents, regularized towards 0.
+        x = np.column_stack([np.log(B2), np.log(digits)])
+        x_mean = np.average(x, axis=0, weights=curves)
+        X = np.column_stack([np.ones(len(x)), x - x_mean])
+        y = np.log(stage2_ms / curves) - x @ [PRIOR_B2, PRIOR_DIGITS]
+
+        W = curves[:, None] * X
+        A = X.T @ W + PRIOR_WEIGHT * np.diag([0, 1, 1])
+        beta = np.linalg.solve(A, W.T @ y)
+
+        self.b = PRIOR_B2 + beta[1]
+        self.d = PRIOR_DIGITS + beta[2]
+        self.c = beta[0] - x_mean @ beta[1:]
+
+        # Most common B2 / B1 if shards don't say
+        ratios = defaultdict(int)
+        for b1, b2, count in zip(B1, B2, curves):
+            ratios[b2 / b1] += count
+        self.ratio = max(ratios, key=ratios.get)
+
+
+    def __str__(self):
+        return f"stage2_ms = {math.exp(self.c):.3g} * B2^{self.b:.3f} * digits^{self.d:.3f}"
+
+
+    def ms(self, B1, B2, digits):
+        if not B2:
+            # Relative costs are all that matter without a ratio
+            B2 = B1 * (self.ratio or 100)
+        return math.exp(self.c + self.b * math.log(B2) + self.d * math.log(digits))
+
+
+def line_digits(N):
+    """Decimal digits of N (decimal, 0x hex or an expression), ValueError if N isn't a number.
+
+    Decimal and hex N are sized from their length, expressions are evaluated;
+    hex and expressions can be one digit short.
+    """
+    N = N.strip()
+    if N.isdigit():
+        return len(N)
+    if N.startswith(b"0x"):
+        return max(1, math.ceil((len(N) - 2) * math.log10(16)))
+    return _expression_digits(N)
+
+
+@functools.lru_cache(maxsize=1024)
+def _expression_digits(N):
+    # Resume files repeat the same few N, each is evaluated once
+    n = abs(ecm_output.parse_number(N.decode()))
+    return int((max(1, n.bit_length()) - 1) * math.log10(2)) + 1
+
+
+def shard(args, model, B2):
+    prefix = args.output_prefix or args.resume_files[0]
+    names = [f"{prefix}.{i}" for i in range(args.shards)]
+    shard_fs = [open(fn, "wb", buffering=BUFFER_SIZE) for fn in names]
+
+    # (estimated ms, shard index) min heap
+    loads = [(0.0, i) for i in range(args.shards)]
+    counts = [0] * args.shards
+    # (B1, digits) -> ms, few distinct values in practice
+    costs = {}
+
+    t0 = time.time()
+    lines = 0
+    unparsed = 0
+    try:
+        for fn in args.resume_files:
+            with open(fn, "rb", buffering=BUFFER_SIZE) as f:
+                for line in f:
+                    n_match = ecm_output.RE_RESUME_N_BYTES.search(line)
+                    b1_match = RE_RESUME_B1.search(line)
+                    digits = None
+                    if n_match and b1_match:
+                        try:
+                            digits = line_digits(n_match.group(1))
+                        except ValueError:
+                            pass
+                    if digits:
+                        key = (int(b1_match.group(1)), digits)
+                        cost = costs.get(key)
+                        if cost is None:
+                            cost = costs[key] = model.ms(key[0], B2, key[1])
+                    else:
+                        # Kept (with no cost) so ecm can report on it, never dropped
+                        cost = 0
+                        unparsed += 1
+
+                    load, i = heapq.heappop(loads)
+                    heapq.heappush(loads, (load + cost, i))
+                    shard_fs[i].write(line)
+                    counts[i] += 1
+                    lines += 1
+    finally:
+        for shard_f in shard_fs:
+            shard_f.close()
+
+    t1 = time.time()
+    print(f"Sharded {lines} lines in {t1 - t0:.1f}s ({lines / max(t1 - t0, 1e-6):.0f} lines/sec)")
+    if unparsed:
+        print(f"\t{unparsed} lines without N= and B1= (or N that isn't a number) were added with no cost")
+    total = sum(load for load, _ in loads) or 1
+    for load, i in sorted(loads, key=lambda load_i: load_i[1]):
+        hours = f", {load / 3600e3:.2f} estimated stage 2 hours" if model.fitted else ""
+        print(f"\t{names[i]!r}: {counts[i]} lines, {load / total:.1%} of cost{hours}")
+
+
+def main(args):
+    groups = defaultdict(lambda: [0, 0])
+    if args.db:
+        for row in EcmServer(args.db).stage2_timings():
+            group = groups[(row['digits'], row['B1'], row['B2'])]
+            group[0] += row['curves']
+            group[1] += row['stage2_ms']
+    for fn in args.log:
+        for key, (curves, stage2_ms) in log_timings(fn).items():
+            groups[key][0] += curves
+            groups[key][1] += stage2_ms
+
+    model = CostModel(groups)
+    if groups:
+        print(f"Cost model from {sum(c for c, _ in groups.values())} curves: {model}")
+    else:
+        print("No past timings, shards are balanced on relative cost only")
+
+    B2 = int(float(args.B2)) if args.B2 else None
+    shard(args, model, B2)
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)
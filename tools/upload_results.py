@@ -0,0 +1,57 @@
+"""Uploads ecm_runner .json.log results to an ecm-db work server.
+
+For the <log>.unsent.json.log a runner leaves when its server was down.
+The server skips work units it already has, so uploading twice is safe.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client.ecm_runner import WorkClient
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description='upload ecm_runner results to a work server.')
+    parser.add_argument('-s', '--server', required=True,
+                        help='ecm-db work server url (e.g. http://localhost:8419)')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='results per request')
+    parser.add_argument('log_files', type=str, nargs='+',
+                        help='ecm_runner .json.log files')
+    return parser
+
+
+def upload_log(client, fn, batch):
+    """Upload fn in batches that don't split a work unit, returns curves recorded"""
+    recorded = 0
+    pairs = []
+    with open(fn) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            pair = json.loads(line)
+            if len(pairs) >= batch and pair[0]["uid"] != pairs[-1][0]["uid"]:
+                recorded += client.upload_json(pairs)
+                pairs = []
+            pairs.append(pair)
+    if pairs:
+        recorded += client.upload_json(pairs)
+    return recorded
+
+
+def main(args):
+    client = WorkClient(args.server)
+    for fn in args.log_files:
+        recorded = upload_log(client, fn, args.batch)
+        print(f"Uploaded {fn!r}, server recorded {recorded} new curves")
+
+
+if __name__ == "__main__":
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    main(args)